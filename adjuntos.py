@@ -0,0 +1,307 @@
+"""
+Fotos y documentos adjuntos a vehículos e intervenciones.
+
+Los ficheros se guardan por contenido: cada uno una sola vez en
+`<directorio>/<taller>/<hh>/<sha256>`, aunque se adjunte a varios registros (la
+tabla `archivos` tiene una fila por hash y `adjuntos` una por cada vez que se
+adjunta). La subida no pasa por memoria ni se copia dos veces: el parser de
+formularios de Werkzeug escribe cada fichero directamente en un temporal del
+almacén (`FicheroEntrante`, ver `PeticionTaller` en app.py) que calcula el hash
+mientras se escribe; al terminar basta con renombrarlo, o borrarlo si ese
+contenido ya estaba.
+
+Guardar una subida (que puede reutilizar un fichero existente y descartar la
+suya) y confirmar su fila en `archivos` se hace con un bloqueo compartido del
+almacén, y la purga de archivos sin adjuntos con el bloqueo exclusivo: así la
+purga no puede borrar un fichero que una subida en curso acaba de dar por bueno.
+
+Las miniaturas (JPEG de `lado` píxeles como máximo) se generan en un pool de
+hilos en segundo plano al subir la foto, fuera de la petición. Si se pide una
+que aún no existe (el proceso se reinició antes de generarla), se encola y se
+espera a esa.
+
+Las URL de originales y miniaturas no cambian de contenido, así que se sirven con
+caché de larga duración, ETag y peticiones por rangos.
+"""
+import fcntl
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as EsperaAgotada
+from contextlib import contextmanager
+
+from sqlalchemy import delete, func, or_, select
+
+from models import db, Adjunto, Archivo, Intervencion
+
+logger = logging.getLogger(__name__)
+
+FilaAdjunto = namedtuple('FilaAdjunto', 'id nombre tipo tamaño hash subido_en intervencion_id '
+                                        'intervencion_fecha intervencion_descripcion')
+
+# Tipos admitidos, reconocidos por los primeros bytes y no por lo que declare el navegador
+FIRMAS = (
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+    (b'II*\x00', 'image/tiff'),
+    (b'MM\x00*', 'image/tiff'),
+    (b'%PDF-', 'application/pdf'),
+)
+# Tipos de los que se genera miniatura
+CON_MINIATURA = ('image/jpeg', 'image/png', 'image/gif', 'image/webp', 'image/tiff')
+
+
+def tipo_contenido(cabecera):
+    if cabecera[:4] == b'RIFF' and cabecera[8:12] == b'WEBP':
+        return 'image/webp'
+    for firma, tipo in FIRMAS:
+        if cabecera.startswith(firma):
+            return tipo
+    return None
+
+
+class FicheroEntrante:
+    """Temporal del almacén en el que se escribe una subida, con su hash y tamaño."""
+
+    def __init__(self, directorio):
+        self._fichero = tempfile.NamedTemporaryFile(dir=directorio, prefix='subida-', delete=False)
+        self.ruta = self._fichero.name
+        self.tamaño = 0
+        self.cabecera = b''
+        self._hash = hashlib.sha256()
+
+    def write(self, datos):
+        if len(self.cabecera) < 16:
+            self.cabecera += datos[:16 - len(self.cabecera)]
+        self._hash.update(datos)
+        self.tamaño += len(datos)
+        return self._fichero.write(datos)
+
+    def __getattr__(self, nombre):
+        # seek, read, tell... los usa Werkzeug tras escribir y FileStorage después
+        if nombre.startswith('_'):
+            raise AttributeError(nombre)
+        return getattr(self._fichero, nombre)
+
+    @property
+    def hash(self):
+        return self._hash.hexdigest()
+
+    @property
+    def tipo(self):
+        return tipo_contenido(self.cabecera)
+
+    def close(self):
+        """Cierra y borra el temporal si no ha pasado al almacén (Werkzeug lo llama al acabar la petición)"""
+        self._fichero.close()
+        if self.ruta is not None:
+            try:
+                os.unlink(self.ruta)
+            except FileNotFoundError:
+                pass
+            self.ruta = None
+
+
+class Almacen:
+    """Ficheros por contenido y pool de miniaturas; uno por proceso."""
+
+    def __init__(self, directorio, hilos=2, lado=320):
+        self.directorio = directorio
+        self.hilos = hilos
+        self.lado = lado
+        self._pool = None
+        self._pid = None
+        self._en_curso = {}  # ruta de la miniatura -> Future
+        self._lock = threading.Lock()
+
+    def _raiz(self, taller):
+        return os.path.join(self.directorio, taller) if taller else self.directorio
+
+    def ruta(self, hash, taller=None):
+        return os.path.join(self._raiz(taller), hash[:2], hash)
+
+    def ruta_miniatura(self, hash, taller=None):
+        return os.path.join(self._raiz(taller), 'miniaturas', hash[:2], hash + '.jpg')
+
+    @contextmanager
+    def bloqueo(self, taller=None, exclusivo=False):
+        """Compartido para guardar subidas y confirmarlas, exclusivo para purgar (entre procesos)"""
+        raiz = self._raiz(taller)
+        os.makedirs(raiz, exist_ok=True)
+        with open(os.path.join(raiz, '.bloqueo'), 'a') as fichero:
+            fcntl.flock(fichero, fcntl.LOCK_EX if exclusivo else fcntl.LOCK_SH)
+            yield
+
+    def fichero_entrante(self, taller=None):
+        directorio = os.path.join(self._raiz(taller), 'subidas')
+        os.makedirs(directorio, exist_ok=True)
+        return FicheroEntrante(directorio)
+
+    def guardar(self, entrante, taller=None):
+        """Pasa la subida a su sitio definitivo; si el contenido ya estaba, se queda el existente"""
+        entrante.flush()
+        destino = self.ruta(entrante.hash, taller)
+        if os.path.exists(destino):
+            entrante.close()
+        else:
+            os.makedirs(os.path.dirname(destino), exist_ok=True)
+            os.replace(entrante.ruta, destino)
+            entrante.ruta = None
+            entrante.close()
+        return destino
+
+    def borrar(self, hash, taller=None):
+        for ruta in (self.ruta(hash, taller), self.ruta_miniatura(hash, taller)):
+            try:
+                os.unlink(ruta)
+            except FileNotFoundError:
+                pass
+
+    # ----- Miniaturas -----
+
+    def _hilos(self):
+        # Los hilos no sobreviven a fork(): cada worker crea su propio pool
+        if self._pid != os.getpid():
+            self._pool = ThreadPoolExecutor(max_workers=self.hilos, thread_name_prefix='miniaturas')
+            self._pid = os.getpid()
+            self._en_curso = {}
+        return self._pool
+
+    def encolar_miniatura(self, hash, taller=None):
+        """Encola la miniatura si falta. Devuelve el Future, o None si ya existe."""
+        destino = self.ruta_miniatura(hash, taller)
+        if os.path.exists(destino):
+            return None
+        with self._lock:
+            futuro = self._en_curso.get(destino)
+            if futuro is None:
+                futuro = self._en_curso[destino] = self._hilos().submit(self._generar, self.ruta(hash, taller),
+                                                                         destino)
+        return futuro
+
+    def miniatura(self, hash, taller=None, plazo=30):
+        """
+        Ruta de la miniatura, generándola (y esperándola) si aún no existe; None si
+        no se puede generar.
+
+        Raises:
+            TimeoutError: Si no está lista en `plazo` segundos (se sigue generando)
+        """
+        futuro = self.encolar_miniatura(hash, taller)
+        if futuro is not None:
+            try:
+                generada = futuro.result(timeout=plazo)
+            except EsperaAgotada:
+                raise TimeoutError(f'La miniatura de {hash} no está lista') from None
+            if not generada:
+                return None
+        return self.ruta_miniatura(hash, taller)
+
+    def _generar(self, origen, destino):
+        from PIL import Image as ImagenPIL, ImageOps
+
+        try:
+            with ImagenPIL.open(origen) as imagen:
+                # Los JPEG se decodifican ya reducidos (mucho más rápido en fotos de móvil)
+                imagen.draft('RGB', (self.lado * 2, self.lado * 2))
+                imagen = ImageOps.exif_transpose(imagen)
+                imagen.thumbnail((self.lado, self.lado))
+                if imagen.mode != 'RGB':
+                    fondo = ImagenPIL.new('RGB', imagen.size, 'white')
+                    fondo.paste(imagen, mask=imagen.convert('RGBA').getchannel('A'))
+                    imagen = fondo
+                os.makedirs(os.path.dirname(destino), exist_ok=True)
+                temporal = f'{destino}.{os.getpid()}.{threading.get_ident()}'
+                imagen.save(temporal, 'JPEG', quality=80, optimize=True)
+            os.replace(temporal, destino)
+            return True
+        except Exception:
+            logger.exception('No se ha podido generar la miniatura de %s', origen)
+            return False
+        finally:
+            with self._lock:
+                self._en_curso.pop(destino, None)
+
+    def cerrar(self):
+        if self._pool is not None and self._pid == os.getpid():
+            self._pool.shutdown()
+
+
+def adjuntar(entrante, nombre, coche_id=None, intervencion_id=None):
+    """
+    Registra la subida como adjunto (reutilizando el archivo si ese contenido ya
+    estaba). No confirma la transacción.
+
+    Returns:
+        Adjunto
+    """
+    archivo = db.session.execute(select(Archivo).where(Archivo.hash == entrante.hash)).scalar_one_or_none()
+    if archivo is None:
+        archivo = Archivo(hash=entrante.hash, tamaño=entrante.tamaño, tipo=entrante.tipo)
+        db.session.add(archivo)
+    adjunto = Adjunto(archivo=archivo, nombre=os.path.basename(nombre or '')[:200] or archivo.hash[:12],
+                      coche_id=coche_id, intervencion_id=intervencion_id)
+    db.session.add(adjunto)
+    return adjunto
+
+
+def de_coche(coche_id):
+    """Adjuntos del vehículo y de sus intervenciones, los más recientes primero"""
+    filas = db.session.execute(
+        select(Adjunto.id, Adjunto.nombre, Archivo.tipo, Archivo.tamaño, Archivo.hash, Adjunto.subido_en,
+               Adjunto.intervencion_id, Intervencion.fecha, Intervencion.descripcion)
+        .join(Archivo, Adjunto.archivo_id == Archivo.id)
+        .outerjoin(Intervencion, Adjunto.intervencion_id == Intervencion.id)
+        .where(or_(Adjunto.coche_id == coche_id, Intervencion.coche_id == coche_id))
+        .order_by(Adjunto.subido_en.desc(), Adjunto.id.desc())
+    )
+    return [FilaAdjunto(*fila) for fila in filas]
+
+
+def intervenciones_de_coche(coche_id):
+    """(id, fecha, descripción) de las intervenciones del vehículo, para elegir a cuál adjuntar"""
+    return db.session.execute(
+        select(Intervencion.id, Intervencion.fecha, Intervencion.descripcion)
+        .where(Intervencion.coche_id == coche_id)
+        .order_by(Intervencion.fecha.desc(), Intervencion.id.desc())
+    ).all()
+
+
+def archivos_sin_adjuntos():
+    """Archivos que ya no están adjuntos a nada; se borran con sus ficheros al purgar"""
+    usados = select(Adjunto.archivo_id)
+    return db.session.execute(select(Archivo.id, Archivo.hash).where(Archivo.id.not_in(usados))).all()
+
+
+def purgar(almacen, taller=None):
+    """
+    Borra los archivos sin adjuntos y sus ficheros, con el almacén bloqueado para
+    las subidas. Confirma la transacción antes de borrar los ficheros.
+
+    Returns:
+        int: Archivos borrados
+    """
+    with almacen.bloqueo(taller, exclusivo=True):
+        huerfanos = archivos_sin_adjuntos()
+        if not huerfanos:
+            db.session.rollback()
+            return 0
+        db.session.execute(delete(Archivo).where(Archivo.id.in_([id for id, _ in huerfanos])))
+        db.session.commit()
+        for _, hash in huerfanos:
+            almacen.borrar(hash, taller)
+    return len(huerfanos)
+
+
+def espacio():
+    """Bytes adjuntados (contando cada vez) y bytes en disco (cada contenido una vez)"""
+    adjuntado = db.session.execute(
+        select(func.coalesce(func.sum(Archivo.tamaño), 0)).join(Adjunto, Adjunto.archivo_id == Archivo.id)
+    ).scalar()
+    en_disco = db.session.execute(select(func.coalesce(func.sum(Archivo.tamaño), 0))).scalar()
+    return adjuntado, en_disco
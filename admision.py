@@ -0,0 +1,178 @@
+"""
+Control de admisión y plazos para los endpoints pesados.
+
+Cada grupo de endpoints (PDF, informes, sincronización...) tiene un máximo de
+peticiones en curso por proceso y una cola acotada. Cuando el grupo está lleno
+la petición espera en la cola; si la cola también está llena, o si la espera
+supera el plazo, se responde 503 con Retry-After en lugar de ocupar un worker.
+Como las peticiones en cola también ocupan un hilo mientras esperan, hay además
+un máximo `total` de peticiones de todos los grupos (en curso más en cola) por
+proceso, por debajo del número de hilos: el resto de hilos queda siempre libre
+para las páginas normales.
+
+Cada petición admitida tiene además un plazo. `plazo_vencido()` lo comprueba y
+app.py lo usa como progress handler de SQLite, de modo que una consulta que se
+alarga más del plazo se interrumpe ("interrupted") y la petición termina con 503.
+"""
+import functools
+import threading
+import time
+
+from flask import g, has_app_context
+from sqlalchemy.exc import OperationalError
+from werkzeug.exceptions import ServiceUnavailable
+
+
+class Saturado(ServiceUnavailable):
+    description = 'El servidor está atendiendo demasiadas peticiones de este tipo. Inténtelo de nuevo en unos segundos.'
+
+
+class PlazoAgotado(ServiceUnavailable):
+    description = 'La petición ha tardado demasiado y se ha cancelado. Inténtelo de nuevo en unos minutos.'
+
+
+def plazo_vencido():
+    """True si la petición en curso tiene plazo y ya ha pasado"""
+    if not has_app_context():
+        return False
+    plazo = g.get('plazo_peticion')
+    return plazo is not None and time.monotonic() > plazo
+
+
+class Grupo:
+    """Límite de concurrencia con cola acotada para un grupo de endpoints."""
+
+    def __init__(self, nombre, maximo, cola, plazo):
+        self.nombre = nombre
+        self.maximo = maximo
+        self.cola = cola
+        self.plazo = plazo
+        self.en_curso = 0
+        self.en_cola = 0
+        self._condicion = threading.Condition()
+
+    def entrar(self, limite):
+        """
+        Ocupa un hueco, esperando como mucho hasta el instante `limite` (monotonic).
+        Devuelve False si la cola está llena o se agota la espera.
+        """
+        with self._condicion:
+            if self.en_curso < self.maximo and not self.en_cola:
+                self.en_curso += 1
+                return True
+            if self.en_cola >= self.cola:
+                return False
+            self.en_cola += 1
+            try:
+                while self.en_curso >= self.maximo:
+                    restante = limite - time.monotonic()
+                    if restante <= 0:
+                        return False
+                    self._condicion.wait(restante)
+                self.en_curso += 1
+                return True
+            finally:
+                self.en_cola -= 1
+
+    def salir(self):
+        with self._condicion:
+            self.en_curso -= 1
+            self._condicion.notify()
+
+
+class ControlAdmision:
+    """Grupos de endpoints limitados y decorador para aplicarlos."""
+
+    def __init__(self, app=None, metricas=None):
+        self.metricas = metricas
+        self.grupos = {}
+        self.total = None  # hilos que pueden ocupar entre todos los grupos (None: sin límite)
+        self.ocupados = 0
+        self._lock = threading.Lock()
+        if app is not None:
+            app.teardown_request(self._liberar)
+
+    def _ocupar_hilo(self):
+        with self._lock:
+            if self.total is not None and self.ocupados >= self.total:
+                return False
+            self.ocupados += 1
+            return True
+
+    def _liberar_hilo(self):
+        with self._lock:
+            self.ocupados -= 1
+
+    def _liberar(self, error=None):
+        grupo = g.pop('grupo_admision', None)
+        if grupo is not None:
+            grupo.salir()
+            self._liberar_hilo()
+            self._cambiar(grupo, 'taller_admision_en_curso', -1)
+
+    def configurar(self, grupos, total=None):
+        """
+        Args:
+            grupos: {nombre: {'maximo': int, 'cola': int, 'plazo': segundos}}
+            total: Máximo de peticiones de todos los grupos, en curso o en cola, por proceso
+        """
+        self.limitar_total(total)
+        for nombre, opciones in grupos.items():
+            self.grupos[nombre] = Grupo(nombre, opciones['maximo'], opciones['cola'], opciones['plazo'])
+            if self.metricas:
+                self.metricas.fijar('taller_admision_limite', opciones['maximo'], grupo=nombre)
+                self.metricas.fijar('taller_admision_cola_maxima', opciones['cola'], grupo=nombre)
+
+    def limitar_total(self, total):
+        self.total = total
+        if self.metricas and total is not None:
+            self.metricas.fijar('taller_admision_total_maximo', total)
+
+    def _rechazar(self, grupo, motivo, excepcion):
+        if self.metricas:
+            self.metricas.incrementar('taller_admision_rechazos_total', grupo=grupo.nombre, motivo=motivo)
+        # Sugerencia de reintento: lo que tardaría en vaciarse la cola, como mínimo 1 segundo
+        raise excepcion(retry_after=max(1, int(grupo.plazo / max(grupo.maximo, 1))))
+
+    def _cambiar(self, grupo, nombre, valor):
+        if self.metricas:
+            self.metricas.incrementar(nombre, valor, grupo=grupo.nombre)
+
+    def limitar(self, nombre):
+        """
+        Decorador de vista: la petición ocupa un hueco del grupo `nombre` hasta que
+        termina (en las respuestas con stream_with_context, hasta que se ha enviado
+        el cuerpo, que es cuando se cierra el contexto de la petición).
+        """
+        def decorador(vista):
+            @functools.wraps(vista)
+            def envoltura(*args, **kwargs):
+                grupo = self.grupos[nombre]
+                inicio = time.monotonic()
+                g.plazo_peticion = inicio + grupo.plazo
+
+                if not self._ocupar_hilo():
+                    g.plazo_peticion = None
+                    self._rechazar(grupo, 'total', Saturado)
+                self._cambiar(grupo, 'taller_admision_en_cola', 1)
+                try:
+                    admitida = grupo.entrar(g.plazo_peticion)
+                finally:
+                    self._cambiar(grupo, 'taller_admision_en_cola', -1)
+                if self.metricas:
+                    self.metricas.observar('taller_admision_espera_segundos', time.monotonic() - inicio, grupo=nombre)
+                if not admitida:
+                    self._liberar_hilo()
+                    g.plazo_peticion = None
+                    self._rechazar(grupo, 'saturado', Saturado)
+
+                self._cambiar(grupo, 'taller_admision_en_curso', 1)
+                g.grupo_admision = grupo
+                try:
+                    return vista(*args, **kwargs)
+                except OperationalError as e:
+                    if 'interrupted' in str(e.orig) and plazo_vencido():
+                        self._rechazar(grupo, 'plazo', PlazoAgotado)
+                    raise
+            return envoltura
+        return decorador
@@ -1,7 +1,36 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, send_file, current_app
-from models import db, Cliente, Coche, Intervencion, Factura
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, send_file, current_app, g, abort, send_from_directory, Request
+from models import db, Cliente, Coche, Intervencion, Factura, Pago, Vencimiento, ArticuloCatalogo, Adjunto, Archivo
+from cache import CacheFragmentos, CacheReferencias, crear_backend
+from metricas import Metricas, BUCKETS_BYTES
+from dinero import a_decimal, calcular_totales
+import consultas
+import sincronizacion
+import cambios
+import saldos
+import mantenimiento
+import duplicados
+import catalogo
+import correo
+import verifactu
+import adjuntos
+from tablero import DifusorTablero
+from talleres import PoolTalleres, PrefijoTaller, taller_de_host
+from admision import ControlAdmision, plazo_vencido
+from trazas import CapturaTrazas
+from perfilado import PerfilPeticion, listar_perfiles, purgar_perfiles
 from datetime import datetime
 import os
+import time
+import hmac
+import functools
+import threading
+from contextlib import contextmanager
+import click
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm.exc import StaleDataError
+from sqlalchemy.pool import Pool, QueuePool
+from werkzeug.exceptions import ServiceUnavailable
 from reportlab.lib.pagesizes import A4
 from reportlab.lib import colors
 from reportlab.lib.units import cm
@@ -9,16 +38,267 @@ from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph,
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib.enums import TA_RIGHT, TA_LEFT, TA_CENTER
 from io import BytesIO
+from collections import namedtuple
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'tu-clave-secreta-aqui-cambiar-en-produccion'
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///taller.db'
+app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL', 'sqlite:///taller.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
+# Caché de fragmentos de los listados: 'memoria' (un proceso), 'fichero' o 'redis' (varios workers)
+app.config['CACHE_BACKEND'] = os.getenv('CACHE_BACKEND', 'memoria')
+app.config['CACHE_DIR'] = os.getenv('CACHE_DIR', os.path.join(app.instance_path, 'cache'))
+app.config['CACHE_REDIS_URL'] = os.getenv('CACHE_REDIS_URL', 'redis://localhost:6379/0')
+
+# Métricas: directorio compartido para sumar las de todos los workers (sin él, solo las del proceso)
+app.config['METRICAS_DIR'] = os.getenv('METRICAS_DIR')
+# Segundos que SQLite espera a que se libere un bloqueo antes de dar "database is locked"
+app.config['SQLITE_BUSY_TIMEOUT'] = float(os.getenv('SQLITE_BUSY_TIMEOUT', '5'))
+
+# Perfilado bajo demanda: desactivado si no hay token
+app.config['PERFIL_TOKEN'] = os.getenv('PERFIL_TOKEN')
+
+# Sincronización de tablets: filas por tabla y página, y retraso de seguridad en segundos
+app.config['SYNC_LIMITE'] = int(os.getenv('SYNC_LIMITE', '500'))
+app.config['SYNC_MARGEN_SEGUNDOS'] = float(os.getenv('SYNC_MARGEN_SEGUNDOS', app.config['SQLITE_BUSY_TIMEOUT'] + 10))
+# Ficha de cliente: intervenciones y facturas por página
+app.config['FICHA_CLIENTE_POR_PAGINA'] = int(os.getenv('FICHA_CLIENTE_POR_PAGINA', '25'))
+
+# Días que se conservan completas las entradas del registro de cambios pendientes de algún consumidor
+app.config['CAMBIOS_RETENCION_DIAS'] = float(os.getenv('CAMBIOS_RETENCION_DIAS', '7'))
+
+# Segundos entre lecturas del registro de cambios para el tablero en vivo
+app.config['TABLERO_INTERVALO'] = float(os.getenv('TABLERO_INTERVALO', '1'))
+
+# PDF compacto: logo reducido a JPEG y compresión de página (1/0)
+app.config['PDF_COMPACTO'] = os.getenv('PDF_COMPACTO', '1').lower() in ('1', 'true', 'si', 'sí')
+
+# Control de admisión por grupo de endpoints pesados: "máximo en curso,cola,plazo en segundos" por proceso
+def leer_limites_admision(grupo, por_defecto):
+    maximo, cola, plazo = os.getenv(f'ADMISION_{grupo.upper()}', por_defecto).split(',')
+    return {'maximo': int(maximo), 'cola': int(cola), 'plazo': float(plazo)}
+
+app.config['ADMISION'] = {
+    'pdf': leer_limites_admision('pdf', '2,4,30'),
+    'informes': leer_limites_admision('informes', '1,2,120'),
+    'sincronizacion': leer_limites_admision('sincronizacion', '2,8,60'),
+}
+# Varios talleres en un despliegue: '' (uno solo, taller.db), 'host' (<taller>.TALLERES_DOMINIO) o 'ruta' (/t/<taller>/...)
+app.config['TALLERES_MODO'] = os.getenv('TALLERES_MODO', '')
+app.config['TALLERES_DIR'] = os.getenv('TALLERES_DIR', os.path.join(app.instance_path, 'talleres'))
+app.config['TALLERES_DOMINIO'] = os.getenv('TALLERES_DOMINIO')
+# Bases de datos de talleres abiertas a la vez por proceso y segundos sin uso tras los que se cierran
+app.config['TALLERES_MAX_ABIERTOS'] = int(os.getenv('TALLERES_MAX_ABIERTOS', '32'))
+app.config['TALLERES_INACTIVIDAD'] = float(os.getenv('TALLERES_INACTIVIDAD', '300'))
+# Taller sobre el que trabajan los comandos `flask ...` con varios talleres
+app.config['TALLER'] = os.getenv('TALLER')
+
+# Servidor de producción (`flask --app app serve`): dirección, procesos, hilos por proceso,
+# peticiones tras las que se recicla cada worker y segundos de espera al parar
+app.config['SERVIR_DIRECCION'] = os.getenv('SERVIR_DIRECCION', '127.0.0.1:8000')
+app.config['SERVIR_WORKERS'] = int(os.getenv('SERVIR_WORKERS', str(os.cpu_count() or 2)))
+app.config['SERVIR_HILOS'] = int(os.getenv('SERVIR_HILOS', '8'))
+app.config['SERVIR_MAX_PETICIONES'] = int(os.getenv('SERVIR_MAX_PETICIONES', '2000'))
+app.config['SERVIR_GRACIA'] = float(os.getenv('SERVIR_GRACIA', '30'))
+# Peticiones pesadas por proceso entre todos los grupos de admisión, en curso más en cola (cada una
+# ocupa un hilo): por defecto la mitad de los hilos, para que el resto quede libre para las páginas normales
+app.config['ADMISION_TOTAL'] = int(os.getenv('ADMISION_TOTAL', str(max(1, app.config['SERVIR_HILOS'] // 2))))
+
+# Captura de trazas de peticiones para reproducirlas (desactivada si no hay directorio),
+# fracción de peticiones capturadas y tamaño máximo de cada fichero en MB
+app.config['TRAZAS_DIR'] = os.getenv('TRAZAS_DIR')
+app.config['TRAZAS_MUESTREO'] = float(os.getenv('TRAZAS_MUESTREO', '1'))
+app.config['TRAZAS_MAX_MB'] = float(os.getenv('TRAZAS_MAX_MB', '50'))
+
+# Correo saliente para enviar facturas: servidor, puerto, usuario, clave, cifrado ('', 'starttls' o 'ssl') y remitente
+app.config['SMTP_SERVIDOR'] = os.getenv('SMTP_SERVIDOR', 'localhost')
+app.config['SMTP_PUERTO'] = int(os.getenv('SMTP_PUERTO', '25'))
+app.config['SMTP_USUARIO'] = os.getenv('SMTP_USUARIO')
+app.config['SMTP_CLAVE'] = os.getenv('SMTP_CLAVE')
+app.config['SMTP_CIFRADO'] = os.getenv('SMTP_CIFRADO', '')
+app.config['SMTP_REMITENTE'] = os.getenv('SMTP_REMITENTE', 'facturas@localhost')
+# Límites del servidor SMTP: conexiones simultáneas, mensajes por conexión y por minuto (0: sin límite)
+app.config['SMTP_CONEXIONES'] = int(os.getenv('SMTP_CONEXIONES', '2'))
+app.config['SMTP_MENSAJES_POR_CONEXION'] = int(os.getenv('SMTP_MENSAJES_POR_CONEXION', '100'))
+app.config['SMTP_MENSAJES_POR_MINUTO'] = int(os.getenv('SMTP_MENSAJES_POR_MINUTO', '60'))
+# Worker de correo: segundos entre lecturas de la cola, envíos por lote, intentos
+# antes de dar un envío por fallido y segundos de espera tras el primer fallo temporal
+app.config['CORREO_INTERVALO'] = float(os.getenv('CORREO_INTERVALO', '5'))
+app.config['CORREO_LOTE'] = int(os.getenv('CORREO_LOTE', '50'))
+app.config['CORREO_MAX_INTENTOS'] = int(os.getenv('CORREO_MAX_INTENTOS', '5'))
+app.config['CORREO_REINTENTO'] = float(os.getenv('CORREO_REINTENTO', '60'))
+
+# Fotos y documentos adjuntos: directorio, tamaño máximo de una subida en MB, hilos que generan
+# miniaturas y segundos de caché en el navegador de originales y miniaturas
+app.config['ADJUNTOS_DIR'] = os.getenv('ADJUNTOS_DIR', os.path.join(app.instance_path, 'adjuntos'))
+app.config['MAX_CONTENT_LENGTH'] = int(float(os.getenv('ADJUNTOS_MAX_MB', '100')) * 1024 * 1024)
+app.config['ADJUNTOS_HILOS_MINIATURAS'] = int(os.getenv('ADJUNTOS_HILOS_MINIATURAS', '2'))
+app.config['ADJUNTOS_CACHE_SEGUNDOS'] = int(os.getenv('ADJUNTOS_CACHE_SEGUNDOS', str(365 * 24 * 3600)))
+
+app.config['PERFILES_DIR'] = os.getenv('PERFILES_DIR', os.path.join(app.instance_path, 'perfiles'))
+
+metricas = Metricas(app.config['METRICAS_DIR'])
+metricas.contador('taller_peticiones_total', 'Peticiones atendidas por endpoint, método y estado')
+metricas.histograma('taller_peticion_segundos', 'Duración de las peticiones por endpoint')
+metricas.histograma('taller_db_peticion_segundos', 'Tiempo de base de datos por petición y endpoint')
+metricas.histograma('taller_pdf_segundos', 'Tiempo de generación de PDFs de factura por modo')
+metricas.histograma('taller_pdf_bytes', 'Tamaño de los PDFs de factura por modo', BUCKETS_BYTES)
+metricas.contador('taller_verifactu_envios_total', 'Envíos a Verifactu por resultado')
+metricas.histograma('taller_verifactu_segundos', 'Duración de los envíos a Verifactu')
+metricas.indicador('taller_db_conexiones_en_uso', 'Conexiones del pool prestadas en este momento')
+metricas.histograma('taller_db_espera_pool_segundos', 'Espera para obtener una conexión del pool')
+metricas.histograma('taller_sqlite_escritura_segundos', 'Duración de INSERT/UPDATE/DELETE, incluida la espera del busy timeout')
+metricas.contador('taller_sqlite_bloqueos_total', 'Sentencias fallidas con "database is locked" tras agotar el busy timeout')
+metricas.indicador('taller_tablero_pantallas', 'Pantallas conectadas al tablero de intervenciones sin facturar')
+metricas.contador('taller_tablero_lotes_total', 'Lotes de eventos enviados al tablero')
+metricas.indicador('taller_admision_limite', 'Máximo de peticiones en curso por grupo de endpoints')
+metricas.indicador('taller_admision_cola_maxima', 'Tamaño de la cola de espera por grupo de endpoints')
+metricas.indicador('taller_admision_total_maximo', 'Máximo de peticiones pesadas en curso o en cola por proceso')
+metricas.indicador('taller_admision_en_curso', 'Peticiones en curso por grupo de endpoints')
+metricas.indicador('taller_admision_en_cola', 'Peticiones esperando hueco por grupo de endpoints')
+metricas.histograma('taller_admision_espera_segundos', 'Espera en la cola de admisión por grupo')
+metricas.contador('taller_admision_rechazos_total', 'Peticiones rechazadas con 503 por grupo y motivo')
+metricas.indicador('taller_talleres_abiertos', 'Bases de datos de talleres abiertas en el proceso')
+metricas.contador('taller_talleres_aperturas_total', 'Aperturas de bases de datos de talleres')
+metricas.contador('taller_talleres_cierres_total', 'Cierres de bases de datos de talleres por inactividad o por el límite LRU')
+metricas.contador('taller_conflictos_edicion_total', 'Ediciones rechazadas por haberse modificado el registro entretanto')
+metricas.contador('taller_correo_envios_total', 'Envíos de facturas por correo por resultado (enviado, reintento, error)')
+metricas.contador('taller_correo_conexiones_total', 'Conexiones abiertas con el servidor SMTP')
+metricas.histograma('taller_correo_envio_segundos', 'Duración de la entrega de cada correo al servidor SMTP')
+
+admision = ControlAdmision(app, metricas)
+admision.configurar(app.config['ADMISION'], total=app.config['ADMISION_TOTAL'])
+
+# Registrado antes de abrir la primera conexión para que se aplique a todas las del pool
+@event.listens_for(Engine, 'connect')
+def _limitar_consultas_por_plazo(dbapi_conn, registro):
+    # SQLite llama al handler cada N instrucciones de su máquina virtual; si devuelve
+    # un valor verdadero interrumpe la consulta (OperationalError "interrupted")
+    if hasattr(dbapi_conn, 'set_progress_handler'):
+        dbapi_conn.set_progress_handler(plazo_vencido, 10000)
+
+class PoolMedido(QueuePool):
+    """QueuePool que mide cuánto se espera para obtener una conexión"""
+    def _do_get(self):
+        inicio = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            metricas.observar('taller_db_espera_pool_segundos', time.perf_counter() - inicio)
+
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'poolclass': PoolMedido,
+    'connect_args': {'timeout': app.config['SQLITE_BUSY_TIMEOUT']},
+}
+
 db.init_app(app)
 
+if app.config['TALLERES_MODO']:
+    # Cada taller se inicializa (tablas y migraciones) la primera vez que lo abre el proceso
+    db.pool_talleres = PoolTalleres(app.config['TALLERES_DIR'], app.config['SQLALCHEMY_ENGINE_OPTIONS'],
+                                    maximo=app.config['TALLERES_MAX_ABIERTOS'],
+                                    inactividad=app.config['TALLERES_INACTIVIDAD'],
+                                    inicializar=lambda: inicializar_base_datos(), metricas=metricas)
+    db.taller_por_defecto = app.config['TALLER']
+    if app.config['TALLERES_MODO'] == 'ruta':
+        app.wsgi_app = PrefijoTaller(app.wsgi_app)
+
+# Las claves de la caché llevan el taller para que no se mezclen sus datos
+cache_fragmentos = CacheFragmentos(crear_backend(app.config), espacio=db.taller_activo)
+cache_fragmentos.registrar_eventos(Cliente, Coche, Intervencion, Factura, Pago, ArticuloCatalogo)
+cache_referencias = CacheReferencias(cache_fragmentos)
+sincronizacion.registrar_eliminaciones(Cliente, Coche, Intervencion, Factura)
+cambios.registrar_cambios(Cliente, Coche, Intervencion, Factura, Pago)
+saldos.registrar_eventos_saldos()
+mantenimiento.registrar_eventos_vencimientos()
+duplicados.registrar_eventos_claves()
+difusores_tablero = {}
+_difusores_lock = threading.Lock()
+
+METODOS_PAGO = {'efectivo': 'Efectivo', 'tarjeta': 'Tarjeta', 'transferencia': 'Transferencia'}
+
+# Opciones de los desplegables de clientes y vehículos (solo las columnas que usan las plantillas)
+OpcionCliente = namedtuple('OpcionCliente', 'id nombre dni')
+OpcionVehiculo = namedtuple('OpcionVehiculo', 'id matricula')
+
+def opciones_clientes():
+    """Clientes ordenados por nombre para los formularios, desde la caché de referencias"""
+    return cache_referencias.obtener('clientes', lambda: (
+        OpcionCliente(*fila) for fila in
+        db.session.query(Cliente.id, Cliente.nombre, Cliente.dni).order_by(Cliente.nombre)
+    ))
+
+def opciones_vehiculos():
+    """Vehículos ordenados por matrícula para los formularios, desde la caché de referencias"""
+    return cache_referencias.obtener('coches', lambda: (
+        OpcionVehiculo(*fila) for fila in
+        db.session.query(Coche.id, Coche.matricula).order_by(Coche.matricula)
+    ))
+
+def indice_catalogo():
+    """Índice de sugerencias del catálogo; cada worker lo reconstruye cuando cambia la tabla"""
+    return cache_referencias.obtener('catalogo', lambda: [catalogo.IndiceCatalogo(catalogo.articulos_activos())])[0]
+
+def respuesta_en_flujo(plantilla, tamaño_bloque=16384, **contexto):
+    """
+    Renderiza la plantilla por partes y la envía a medida que se genera. Con un
+    generador de filas en el contexto, ni el tiempo hasta el primer byte ni la
+    memoria dependen del número de filas. Los fragmentos de Jinja se agrupan en
+    bloques de `tamaño_bloque` caracteres para no enviar miles de trozos pequeños.
+    """
+    from flask import Response, stream_template
+    
+    def agrupar(partes):
+        bloque, tamaño = [], 0
+        for parte in partes:
+            bloque.append(parte)
+            tamaño += len(parte)
+            if tamaño >= tamaño_bloque:
+                yield ''.join(bloque)
+                bloque, tamaño = [], 0
+        if bloque:
+            yield ''.join(bloque)
+    
+    return Response(agrupar(stream_template(plantilla, **contexto)))
+
+def migrar_columnas_a_centimos(conn, tabla, columnas):
+    """
+    Convierte columnas de importe FLOAT (euros) en INTEGER (céntimos).
+    SQLite no permite cambiar el tipo de una columna, así que se crea la tabla
+    nueva, se copian los datos, se borra la antigua y se renombra la nueva.
+    
+    Returns:
+        bool: True si hubo que convertir la tabla
+    """
+    from sqlalchemy import text, inspect, Integer
+    from sqlalchemy.schema import CreateTable
+    
+    existentes = {col['name']: col['type'] for col in inspect(conn).get_columns(tabla.name)}
+    if all(isinstance(existentes[c], Integer) for c in columnas if c in existentes):
+        return False
+    
+    nueva = tabla.to_metadata(tabla.metadata, name=f'{tabla.name}_nueva')
+    try:
+        conn.execute(text(f'DROP TABLE IF EXISTS {nueva.name}'))
+        conn.execute(CreateTable(nueva))
+    finally:
+        tabla.metadata.remove(nueva)
+    
+    comunes = [col.name for col in tabla.columns if col.name in existentes]
+    origen = [f'CAST(ROUND(COALESCE("{c}", 0) * 100) AS INTEGER)' if c in columnas else f'"{c}"' for c in comunes]
+    conn.execute(text(
+        f'INSERT INTO {nueva.name} ({", ".join(chr(34) + c + chr(34) for c in comunes)}) '
+        f'SELECT {", ".join(origen)} FROM {tabla.name}'
+    ))
+    conn.execute(text(f'DROP TABLE {tabla.name}'))
+    conn.execute(text(f'ALTER TABLE {nueva.name} RENAME TO {tabla.name}'))
+    for indice in tabla.indexes:
+        indice.create(conn, checkfirst=True)
+    return True
+
 # Inicializar base de datos
-with app.app_context():
+def inicializar_base_datos():
+    """Crea las tablas y aplica las migraciones pendientes en la base de datos activa"""
     db.create_all()
     
     # Migración: añadir columna cliente_id a coches si no existe
@@ -37,13 +317,28 @@ with app.app_context():
         if 'no such table' not in str(e).lower():
             print(f"Error en migración (puede ser normal si la columna ya existe): {e}")
     
+    # Migración: saldos de clientes (se calculan al final, cuando los importes de las facturas son definitivos)
+    saldos_añadidos = False
+    try:
+        from sqlalchemy import text, inspect
+        columns = [col['name'] for col in inspect(db.engine).get_columns('clientes')]
+        with db.engine.begin() as conn:
+            for columna in ('total_facturado', 'total_pagado'):
+                if columna not in columns:
+                    conn.execute(text(f'ALTER TABLE clientes ADD COLUMN {columna} INTEGER NOT NULL DEFAULT 0'))
+                    saldos_añadidos = True
+        if saldos_añadidos:
+            print("Migración: columnas de saldo añadidas a la tabla clientes")
+    except Exception as e:
+        print(f"Error en migración de saldos de clientes: {e}")
+    
     # Migración: añadir columnas de IVA y descuento a facturas si no existen
+    columnas_añadidas = False
     try:
         from sqlalchemy import text, inspect
         inspector = inspect(db.engine)
         columns = [col['name'] for col in inspector.get_columns('facturas')]
         
-        columnas_añadidas = False
         with db.engine.begin() as conn:
             if 'base_imponible' not in columns:
                 conn.execute(text('ALTER TABLE facturas ADD COLUMN base_imponible FLOAT DEFAULT 0.0'))
@@ -69,40 +364,364 @@ with app.app_context():
                 conn.execute(text('ALTER TABLE facturas ADD COLUMN iva_importe FLOAT DEFAULT 0.0'))
                 print("Migración: columna iva_importe añadida a la tabla facturas")
                 columnas_añadidas = True
-        
-        # Actualizar facturas existentes si se añadieron columnas
-        if columnas_añadidas:
-            facturas = Factura.query.all()
-            for factura in facturas:
-                # Calcular base imponible desde las intervenciones
-                base_imponible = sum(interv.precio for interv in factura.intervenciones)
-                factura.base_imponible = base_imponible
-                
+    except Exception as e:
+        # Si la tabla no existe o hay otro error, lo ignoramos
+        if 'no such table' not in str(e).lower():
+            print(f"Error en migración de facturas (puede ser normal si las columnas ya existen): {e}")
+    
+    # Migración: importes en céntimos (enteros) en lugar de FLOAT.
+    # Debe ejecutarse antes de leer importes con el ORM.
+    try:
+        with db.engine.begin() as conn:
+            if migrar_columnas_a_centimos(conn, Intervencion.__table__, ['precio']):
+                print("Migración: importes de intervenciones convertidos a céntimos")
+            if migrar_columnas_a_centimos(conn, Factura.__table__, ['base_imponible', 'descuento_importe', 'iva_importe', 'total']):
+                print("Migración: importes de facturas convertidos a céntimos")
+    except Exception as e:
+        print(f"Error en migración de importes a céntimos: {e}")
+    
+    # Migración: columna updated_at para la sincronización incremental de las tablets
+    try:
+        from sqlalchemy import text, inspect
+        inspector = inspect(db.engine)
+        with db.engine.begin() as conn:
+            for tabla, fecha_inicial in (('clientes', 'fecha_registro'), ('coches', 'fecha_registro'),
+                                         ('intervenciones', 'fecha'), ('facturas', 'fecha')):
+                if 'updated_at' not in [col['name'] for col in inspector.get_columns(tabla)]:
+                    conn.execute(text(f'ALTER TABLE {tabla} ADD COLUMN updated_at DATETIME'))
+                    conn.execute(text(f'CREATE INDEX IF NOT EXISTS ix_{tabla}_updated_at ON {tabla}(updated_at)'))
+                    print(f"Migración: columna updated_at añadida a la tabla {tabla}")
+                # También cubre las tablas reconstruidas por otras migraciones
+                conn.execute(text(f'UPDATE {tabla} SET updated_at = COALESCE({fecha_inicial}, CURRENT_TIMESTAMP) '
+                                  f'WHERE updated_at IS NULL'))
+    except Exception as e:
+        print(f"Error en migración de updated_at: {e}")
+    
+    # Migración: columna version para el control de concurrencia optimista en las ediciones
+    try:
+        from sqlalchemy import text, inspect
+        inspector = inspect(db.engine)
+        with db.engine.begin() as conn:
+            for tabla in ('clientes', 'coches', 'intervenciones'):
+                if 'version' not in [col['name'] for col in inspector.get_columns(tabla)]:
+                    conn.execute(text(f'ALTER TABLE {tabla} ADD COLUMN version INTEGER NOT NULL DEFAULT 1'))
+                    print(f"Migración: columna version añadida a la tabla {tabla}")
+    except Exception as e:
+        print(f"Error en migración de version: {e}")
+    
+    # Migración: claves normalizadas de nombre y DNI para buscar clientes duplicados
+    try:
+        from sqlalchemy import text, inspect
+        inspector = inspect(db.engine)
+        with db.engine.begin() as conn:
+            existentes = [col['name'] for col in inspector.get_columns('clientes')]
+            for columna, tamaño in (('clave_nombre', 100), ('clave_dni', 20)):
+                if columna not in existentes:
+                    conn.execute(text(f'ALTER TABLE clientes ADD COLUMN {columna} VARCHAR({tamaño})'))
+                    conn.execute(text(f'CREATE INDEX IF NOT EXISTS ix_clientes_{columna} ON clientes({columna})'))
+                    print(f"Migración: columna {columna} añadida a la tabla clientes")
+            # Los UPDATE de la fusión y los recuentos de candidatos filtran por cliente_id
+            for tabla in ('intervenciones', 'facturas'):
+                conn.execute(text(f'CREATE INDEX IF NOT EXISTS ix_{tabla}_cliente_id ON {tabla}(cliente_id)'))
+            rellenados = duplicados.rellenar_claves(conn)
+            if rellenados:
+                print(f"Migración: claves de duplicados calculadas para {rellenados} clientes")
+    except Exception as e:
+        print(f"Error en migración de claves de clientes: {e}")
+    
+    # Actualizar facturas existentes si se añadieron columnas de IVA y descuento
+    if columnas_añadidas:
+        try:
+            from sqlalchemy import func
+            # Base imponible de todas las facturas con una sola consulta agregada
+            bases = dict(db.session.query(Intervencion.factura_id, func.sum(Intervencion.precio))
+                         .filter(Intervencion.factura_id.isnot(None))
+                         .group_by(Intervencion.factura_id).all())
+            for factura in Factura.query.all():
                 # Si no tiene IVA configurado, usar 21% por defecto
                 if factura.iva_porcentaje is None or factura.iva_porcentaje == 0:
                     factura.iva_porcentaje = 21.0
-                
-                # Calcular descuento
-                descuento_importe = base_imponible * (factura.descuento_porcentaje / 100) if factura.descuento_porcentaje else 0.0
-                factura.descuento_importe = descuento_importe
-                
-                # Base después de descuento
-                base_despues_descuento = base_imponible - descuento_importe
-                
-                # Calcular IVA
-                iva_importe = base_despues_descuento * (factura.iva_porcentaje / 100)
-                factura.iva_importe = iva_importe
-                
-                # Actualizar total
-                nuevo_total = base_despues_descuento + iva_importe
-                factura.total = nuevo_total
+                totales = calcular_totales([bases.get(factura.id, 0)], factura.descuento_porcentaje, factura.iva_porcentaje)
+                for campo, valor in totales.items():
+                    setattr(factura, campo, valor)
             
             db.session.commit()
             print("Migración: facturas existentes actualizadas con IVA y descuento")
+        except Exception as e:
+            db.session.rollback()
+            print(f"Error al actualizar importes de facturas existentes: {e}")
+    
+    if saldos_añadidos:
+        try:
+            print(f"Migración: saldos calculados para {len(saldos.conciliar(corregir=True))} clientes")
+        except Exception as e:
+            db.session.rollback()
+            print(f"Error al calcular los saldos de clientes: {e}")
+    
+    # Previsión de mantenimientos: se calcula una vez para los datos ya existentes
+    try:
+        if not db.session.query(Vencimiento.id).first() and db.session.query(Intervencion.id).first():
+            print(f"Migración: vencimientos calculados para {mantenimiento.recalcular_todos(db.session)} vehículos")
+            db.session.commit()
     except Exception as e:
-        # Si la tabla no existe o hay otro error, lo ignoramos
-        if 'no such table' not in str(e).lower():
-            print(f"Error en migración de facturas (puede ser normal si las columnas ya existen): {e}")
+        db.session.rollback()
+        print(f"Error al calcular los vencimientos de mantenimiento: {e}")
+    
+    # Catálogo de precios: se crea una vez con las descripciones más frecuentes del histórico
+    try:
+        if not db.session.query(ArticuloCatalogo.id).first() and db.session.query(Intervencion.id).first():
+            print(f"Migración: {catalogo.sembrar()} artículos añadidos al catálogo desde el histórico")
+            db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        print(f"Error al crear el catálogo de precios: {e}")
+    
+    # Migración: registro encadenado de Verifactu en facturas (las anteriores quedan fuera de la cadena)
+    try:
+        from sqlalchemy import text, inspect
+        inspector = inspect(db.engine)
+        with db.engine.begin() as conn:
+            existentes = [col['name'] for col in inspector.get_columns('facturas')]
+            for columna, tamaño in (('emisor_nif', 20), ('huella', 64), ('huella_anterior', 64),
+                                    ('registro_generado', 30)):
+                if columna not in existentes:
+                    conn.execute(text(f'ALTER TABLE facturas ADD COLUMN {columna} VARCHAR({tamaño})'))
+                    print(f"Migración: columna {columna} añadida a la tabla facturas")
+            conn.execute(text('CREATE INDEX IF NOT EXISTS ix_facturas_emisor_nif ON facturas(emisor_nif)'))
+    except Exception as e:
+        print(f"Error en migración de Verifactu: {e}")
+    
+    # Migración: NIF del taller tomado de su cadena Verifactu (antes venía de VERIFACTU_NIF, común a todos los talleres)
+    try:
+        from sqlalchemy import text
+        with db.engine.begin() as conn:
+            if conn.execute(text('SELECT COUNT(*) FROM datos_taller')).scalar() == 0:
+                nif = conn.execute(text("SELECT emisor_nif FROM cadenas_verifactu WHERE emisor_nif != '' "
+                                        "ORDER BY actualizado_en DESC LIMIT 1")).scalar()
+                if nif:
+                    conn.execute(text('INSERT INTO datos_taller (nif, actualizado_en) VALUES (:nif, :ahora)'),
+                                 {'nif': nif, 'ahora': datetime.utcnow()})
+                    print(f"Migración: NIF del taller {nif} tomado de la cadena Verifactu")
+    except Exception as e:
+        print(f"Error en migración del NIF del taller: {e}")
+    
+    # Migración: índice por fecha en facturas para los informes por periodo
+    try:
+        from sqlalchemy import text
+        with db.engine.begin() as conn:
+            conn.execute(text('CREATE INDEX IF NOT EXISTS ix_facturas_fecha ON facturas(fecha)'))
+    except Exception as e:
+        print(f"Error en migración del índice de fecha de facturas: {e}")
+
+if not app.config['TALLERES_MODO']:
+    with app.app_context():
+        inicializar_base_datos()
+
+# ========== TALLERES ==========
+
+# Endpoints que no usan la base de datos y se atienden sin taller
+ENDPOINTS_SIN_TALLER = {'static', 'exportar_metricas'}
+
+@app.before_request
+def resolver_taller():
+    if not app.config['TALLERES_MODO'] or request.endpoint in ENDPOINTS_SIN_TALLER:
+        return
+    if app.config['TALLERES_MODO'] == 'host':
+        nombre = taller_de_host(request.host, app.config['TALLERES_DOMINIO'])
+    else:
+        nombre = request.environ.get('taller.nombre')
+    if not db.pool_talleres.existe(nombre):
+        abort(404)
+    g.taller = nombre
+    db.pool_talleres.adquirir(nombre)
+
+@app.teardown_request
+def liberar_taller(error=None):
+    nombre = g.pop('taller', None)
+    if nombre is not None and db.pool_talleres is not None:
+        # La conexión vuelve al pool antes de que el engine del taller pueda cerrarse
+        db.session.remove()
+        db.pool_talleres.liberar(nombre)
+
+@contextmanager
+def contexto_taller(nombre):
+    """Contexto de petición con el taller activo, para hilos en segundo plano"""
+    with app.test_request_context('/'):
+        if nombre is not None:
+            g.taller = nombre
+            db.pool_talleres.adquirir(nombre)
+        yield
+
+def difusor_tablero():
+    """Difusor del tablero en vivo del taller activo (uno por taller y proceso)"""
+    taller = db.taller_activo()
+    with _difusores_lock:
+        difusor = difusores_tablero.get(taller)
+        if difusor is None:
+            difusor = difusores_tablero[taller] = DifusorTablero(
+                app, intervalo=app.config['TABLERO_INTERVALO'], metricas=metricas,
+                contexto=lambda: contexto_taller(taller))
+        return difusor
+
+@app.cli.command('crear-taller')
+@click.argument('nombre')
+@click.option('--datos-prueba', is_flag=True, help='Inserta los datos de prueba en el taller nuevo')
+def crear_taller(nombre, datos_prueba):
+    """Da de alta un taller con su base de datos vacía."""
+    from talleres import nombre_valido
+    if db.pool_talleres is None:
+        raise click.ClickException('Defina TALLERES_MODO para trabajar con varios talleres')
+    if not nombre_valido(nombre):
+        raise click.ClickException('Nombre no válido: minúsculas, números y guiones (máximo 40)')
+    if db.pool_talleres.existe(nombre):
+        raise click.ClickException(f'El taller {nombre} ya existe')
+    os.makedirs(app.config['TALLERES_DIR'], exist_ok=True)
+    with contexto_taller(nombre):
+        if datos_prueba:
+            insertar_datos_prueba()
+    click.echo(f'Taller {nombre} creado en {db.pool_talleres.ruta(nombre)}')
+
+@app.cli.command('listar-talleres')
+def listar_talleres():
+    """Muestra los talleres dados de alta (uno por línea, para usar con TALLER=...)."""
+    if db.pool_talleres is None:
+        raise click.ClickException('Defina TALLERES_MODO para trabajar con varios talleres')
+    for nombre in db.pool_talleres.talleres():
+        click.echo(nombre)
+
+# ========== MÉTRICAS ==========
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _inicio_consulta(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('inicio_consulta', []).append(time.perf_counter())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _fin_consulta(conn, cursor, statement, parameters, context, executemany):
+    duracion = time.perf_counter() - conn.info['inicio_consulta'].pop()
+    if g:
+        g.tiempo_db = g.get('tiempo_db', 0.0) + duracion
+    if statement.lstrip()[:6].upper() in ('INSERT', 'UPDATE', 'DELETE'):
+        metricas.observar('taller_sqlite_escritura_segundos', duracion)
+
+@event.listens_for(Engine, 'handle_error')
+def _error_consulta(contexto):
+    if contexto.connection is not None and contexto.connection.info.get('inicio_consulta'):
+        contexto.connection.info['inicio_consulta'].pop()
+    if 'database is locked' in str(contexto.original_exception):
+        metricas.incrementar('taller_sqlite_bloqueos_total')
+
+@event.listens_for(Pool, 'checkout')
+def _conexion_prestada(dbapi_conn, registro, proxy):
+    metricas.incrementar('taller_db_conexiones_en_uso', 1)
+
+@event.listens_for(Pool, 'checkin')
+def _conexion_devuelta(dbapi_conn, registro):
+    metricas.incrementar('taller_db_conexiones_en_uso', -1)
+
+def al_terminar_respuesta(response, funcion):
+    """
+    Ejecuta `funcion` cuando la respuesta está completa: enseguida si ya lo está o,
+    si se genera por partes (respuesta_en_flujo), cuando el servidor cierra el flujo
+    tras enviar el último bloque. `funcion` no puede depender del contexto de la
+    petición, que para entonces puede haberse cerrado. Los ficheros de send_file
+    (direct_passthrough) llegan al servidor sin pasar por Response.close, así que
+    se dan por terminados aquí como las respuestas completas.
+    """
+    if response.is_streamed and not response.direct_passthrough:
+        response.call_on_close(funcion)
+    else:
+        funcion()
+
+@app.before_request
+def iniciar_medicion():
+    g.inicio_peticion = time.perf_counter()
+    g.tiempo_db = 0.0
+
+@app.after_request
+def registrar_metricas_peticion(response):
+    inicio = g.get('inicio_peticion')
+    if inicio is None:
+        metricas.tal_vez_volcar()
+        return response
+    endpoint = request.endpoint or 'desconocido'
+    metodo, estado = request.method, response.status_code
+    # Las consultas del cuerpo generado por partes siguen sumando en este mismo g
+    medicion = g._get_current_object()
+    
+    def registrar():
+        metricas.incrementar('taller_peticiones_total', endpoint=endpoint, metodo=metodo, estado=estado)
+        metricas.observar('taller_peticion_segundos', time.perf_counter() - inicio, endpoint=endpoint)
+        metricas.observar('taller_db_peticion_segundos', medicion.get('tiempo_db', 0.0), endpoint=endpoint)
+        metricas.tal_vez_volcar()
+    
+    al_terminar_respuesta(response, registrar)
+    return response
+
+@app.route('/metrics')
+def exportar_metricas():
+    """Métricas en formato de texto de Prometheus"""
+    return metricas.exportar(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+# ========== PERFILADO BAJO DEMANDA ==========
+
+def perfilado_autorizado():
+    """True si la petición trae el token de perfilado (cabecera X-Perfil o parámetro _perfil)"""
+    token = app.config['PERFIL_TOKEN']
+    enviado = request.headers.get('X-Perfil') or request.args.get('_perfil')
+    return bool(token and enviado and hmac.compare_digest(enviado, token))
+
+@app.before_request
+def iniciar_perfil():
+    if request.endpoint in ('listar_perfiles_peticiones', 'descargar_perfil') or not perfilado_autorizado():
+        return
+    g.perfil = PerfilPeticion.iniciar(app.config['PERFILES_DIR'], request.method,
+                                      request.full_path, request.endpoint)
+
+def terminar_perfil(perfil=None):
+    perfil = perfil or g.pop('perfil', None)
+    if perfil is None:
+        return None
+    nombre = perfil.terminar()
+    purgar_perfiles(app.config['PERFILES_DIR'])
+    return nombre
+
+@app.after_request
+def guardar_perfil(response):
+    perfil = g.pop('perfil', None)
+    if perfil is not None:
+        perfil.estado = response.status_code
+        response.headers['X-Perfil-Nombre'] = perfil.nombre
+        # Con respuesta_en_flujo el perfil incluye el renderizado y las consultas del cuerpo
+        al_terminar_respuesta(response, lambda: terminar_perfil(perfil))
+    return response
+
+@app.teardown_request
+def cerrar_perfil(error=None):
+    # Por si after_request no llegó a ejecutarse
+    terminar_perfil()
+
+@app.route('/admin/perfiles')
+def listar_perfiles_peticiones():
+    """Perfiles de peticiones guardados recientemente"""
+    if not perfilado_autorizado():
+        abort(403)
+    perfiles = listar_perfiles(app.config['PERFILES_DIR'])
+    return render_template('admin/perfiles.html', perfiles=perfiles, token=app.config['PERFIL_TOKEN'])
+
+@app.route('/admin/perfiles/<nombre>.<any(json, "cpu.folded", "mem.folded"):extension>')
+def descargar_perfil(nombre, extension):
+    if not perfilado_autorizado():
+        abort(403)
+    return send_from_directory(app.config['PERFILES_DIR'], f'{nombre}.{extension}', as_attachment=True)
+
+# ========== CAPTURA DE TRAZAS ==========
+
+# Sin la métrica ni los flujos de eventos, que no forman parte de la carga a reproducir
+if app.config['TRAZAS_DIR']:
+    captura_trazas = CapturaTrazas(app, app.config['TRAZAS_DIR'], muestreo=app.config['TRAZAS_MUESTREO'],
+                                   max_bytes=int(app.config['TRAZAS_MAX_MB'] * 1024 * 1024),
+                                   excluir={'static', 'exportar_metricas', 'eventos_tablero',
+                                            'listar_perfiles_peticiones', 'descargar_perfil'})
 
 # ========== RUTAS PRINCIPALES ==========
 
@@ -110,12 +729,66 @@ with app.app_context():
 def index():
     return render_template('index.html')
 
+# ========== EDICIÓN CONCURRENTE ==========
+# Los formularios de edición envían la versión del registro que mostraron. Si ya no es
+# la actual, otra persona lo guardó entretanto y se muestra la página de conflicto en
+# lugar de sobrescribir sus cambios. Si la versión cambia entre la lectura y el commit
+# (otra petición en otro worker), el UPDATE ... WHERE version = ? no encuentra la fila
+# y SQLAlchemy lanza StaleDataError, que lleva a la misma página. No se bloquea nada.
+
+CAMPOS_CLIENTE = [('nombre', 'Nombre'), ('dni', 'DNI'), ('telefono', 'Teléfono'), ('email', 'Email'),
+                  ('direccion', 'Dirección'), ('codigo_postal', 'Código Postal'),
+                  ('poblacion', 'Población'), ('provincia', 'Provincia')]
+CAMPOS_COCHE = [('matricula', 'Matrícula'), ('marca', 'Marca'), ('modelo', 'Modelo'), ('tipo', 'Tipo'),
+                ('año', 'Año'), ('color', 'Color'), ('cliente_id', 'Propietario')]
+CAMPOS_INTERVENCION = [('fecha', 'Fecha'), ('km', 'Kilómetros'), ('cliente_id', 'Cliente'),
+                       ('descripcion', 'Descripción'), ('precio', 'Precio'), ('horas_trabajo', 'Horas de trabajo')]
+
+def version_obsoleta(registro):
+    """True si el formulario enviado se rellenó a partir de una versión anterior del registro"""
+    version = request.form.get('version', '')
+    return version.isdigit() and int(version) != registro.version
+
+def valor_formulario(campo, valor):
+    """Valor tal como lo muestran los formularios de edición (el cliente, por su nombre)"""
+    if valor is None or valor == '':
+        return ''
+    if campo == 'cliente_id':
+        cliente = db.session.get(Cliente, int(valor))
+        return cliente.nombre if cliente else str(valor)
+    if isinstance(valor, datetime):
+        return valor.strftime('%Y-%m-%d')
+    return str(valor)
+
+def conflicto_edicion(modelo, id, campos, titulo, url_volver):
+    """
+    Página de conflicto (409): valores enviados junto a los guardados por la otra
+    persona, con la opción de recargar el formulario o guardar los propios igualmente.
+    """
+    db.session.rollback()
+    actual = db.session.get(modelo, id)
+    filas = []
+    if actual is not None:
+        for campo, etiqueta in campos:
+            enviado = valor_formulario(campo, request.form.get(campo, '').strip())
+            guardado = valor_formulario(campo, getattr(actual, campo))
+            filas.append((etiqueta, enviado, guardado, enviado.lower() != guardado.lower()))
+    metricas.incrementar('taller_conflictos_edicion_total', tabla=modelo.__tablename__)
+    enviados = [(campo, valor) for campo, valor in request.form.items(multi=True) if campo != 'version']
+    return render_template('conflicto.html', titulo=titulo, actual=actual, filas=filas, enviados=enviados,
+                           url_volver=url_volver), 409
+
 # ========== RUTAS DE CLIENTES ==========
 
 @app.route('/clientes')
 def listar_clientes():
-    clientes = Cliente.query.order_by(Cliente.nombre).all()
-    return render_template('clientes/listar.html', clientes=clientes)
+    def renderizar_tabla():
+        return render_template('clientes/_tabla.html', clientes=consultas.filas_clientes())
+    
+    # Los saldos cambian con cada factura o pago. La tabla no depende de ningún parámetro:
+    # pasar request.args crearía una entrada nueva por cada parámetro ajeno (_perfil, etc.)
+    tabla = cache_fragmentos.obtener('clientes', ('clientes', 'facturas', 'pagos'), {}, renderizar_tabla)
+    return render_template('clientes/listar.html', tabla=tabla)
 
 @app.route('/clientes/nuevo', methods=['GET', 'POST'])
 def nuevo_cliente():
@@ -167,6 +840,8 @@ def editar_cliente(id):
     cliente = Cliente.query.get_or_404(id)
     
     if request.method == 'POST':
+        if version_obsoleta(cliente):
+            return conflicto_edicion(Cliente, id, CAMPOS_CLIENTE, 'el cliente', url_for('listar_clientes'))
         cliente.nombre = request.form['nombre']
         cliente.dni = request.form.get('dni') or None
         cliente.telefono = request.form.get('telefono') or None
@@ -180,12 +855,38 @@ def editar_cliente(id):
             db.session.commit()
             flash('Cliente actualizado correctamente', 'success')
             return redirect(url_for('listar_clientes'))
+        except StaleDataError:
+            return conflicto_edicion(Cliente, id, CAMPOS_CLIENTE, 'el cliente', url_for('listar_clientes'))
         except Exception as e:
             db.session.rollback()
             flash(f'Error al actualizar cliente: {str(e)}', 'error')
     
     return render_template('clientes/editar.html', cliente=cliente)
 
+@app.route('/clientes/<int:id>/historial')
+def historial_cliente(id):
+    cliente = Cliente.query.get_or_404(id)
+    return respuesta_en_flujo('clientes/historial.html', cliente=cliente,
+                              intervenciones=consultas.iterar_intervenciones(cliente_id=id))
+
+@app.route('/clientes/<int:id>')
+def ficha_cliente(id):
+    """Vehículos, historial, facturas y totales del cliente con un número fijo de consultas (ver consultas.py)"""
+    cliente = consultas.cliente_con_vehiculos(id)
+    if cliente is None:
+        abort(404)
+    totales = consultas.totales_cliente(id)
+    tamaño = app.config['FICHA_CLIENTE_POR_PAGINA']
+    # Se acotan a la última página de cada sección en consultas.py
+    pagina_intervenciones = request.args.get('pagina_intervenciones', 1, type=int)
+    pagina_facturas = request.args.get('pagina_facturas', 1, type=int)
+    return render_template(
+        'clientes/ficha.html', cliente=cliente, totales=totales,
+        resumen=consultas.resumen_vehiculos(id),
+        intervenciones=consultas.pagina_intervenciones_cliente(id, pagina_intervenciones, tamaño, totales.intervenciones),
+        facturas=consultas.pagina_facturas_cliente(id, pagina_facturas, tamaño, totales.facturas),
+    )
+
 @app.route('/clientes/<int:id>/eliminar', methods=['POST'])
 def eliminar_cliente(id):
     cliente = Cliente.query.get_or_404(id)
@@ -199,13 +900,45 @@ def eliminar_cliente(id):
     
     return redirect(url_for('listar_clientes'))
 
+# ========== CLIENTES DUPLICADOS ==========
+
+@app.route('/clientes/duplicados')
+def clientes_duplicados():
+    return render_template('clientes/duplicados.html', grupos=duplicados.candidatos())
+
+@app.route('/clientes/fusionar', methods=['POST'])
+def fusionar_clientes():
+    destino_id = request.form.get('destino', type=int)
+    duplicado_ids = [id for id in request.form.getlist('duplicados', type=int) if id != destino_id]
+    if destino_id is None or not duplicado_ids:
+        flash('Elige el cliente que se conserva y al menos otro que fusionar con él', 'error')
+        return redirect(url_for('clientes_duplicados'))
+    
+    try:
+        trasladadas = duplicados.fusionar(destino_id, duplicado_ids)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        flash(f'Error al fusionar clientes: {str(e)}', 'error')
+        return redirect(url_for('clientes_duplicados'))
+    
+    # Los UPDATE masivos no pasan por los eventos del ORM que invalidan la caché
+    cache_fragmentos.invalidar('coches', 'intervenciones', 'facturas')
+    flash(f'{len(duplicado_ids)} cliente(s) fusionado(s): {trasladadas.get("coches", 0)} vehículos, '
+          f'{trasladadas.get("intervenciones", 0)} intervenciones y {trasladadas.get("facturas", 0)} facturas '
+          f'trasladados', 'success')
+    return redirect(url_for('ficha_cliente', id=destino_id))
+
 # ========== RUTAS DE VEHÍCULOS ==========
 
 @app.route('/coches')
 def listar_coches():
-    from sqlalchemy.orm import joinedload
-    coches = Coche.query.options(joinedload(Coche.cliente)).order_by(Coche.matricula).all()
-    return render_template('vehiculos/listar.html', coches=coches)
+    def renderizar_tabla():
+        return render_template('vehiculos/_tabla.html', coches=consultas.filas_coches())
+    
+    # La tabla muestra el nombre del cliente, así que también depende de 'clientes'
+    tabla = cache_fragmentos.obtener('coches', ('coches', 'clientes'), {}, renderizar_tabla)
+    return render_template('vehiculos/listar.html', tabla=tabla)
 
 @app.route('/coches/nuevo', methods=['GET', 'POST'])
 def nuevo_coche():
@@ -231,7 +964,7 @@ def nuevo_coche():
             db.session.rollback()
             flash(f'Error al registrar vehículo: {str(e)}', 'error')
     
-    clientes = Cliente.query.order_by(Cliente.nombre).all()
+    clientes = opciones_clientes()
     return render_template('vehiculos/nuevo.html', clientes=clientes)
 
 @app.route('/coches/nuevo/ajax', methods=['POST'])
@@ -262,6 +995,8 @@ def editar_coche(id):
     coche = Coche.query.get_or_404(id)
     
     if request.method == 'POST':
+        if version_obsoleta(coche):
+            return conflicto_edicion(Coche, id, CAMPOS_COCHE, 'el vehículo', url_for('listar_coches'))
         coche.matricula = request.form['matricula'].upper()
         coche.marca = request.form.get('marca') or None
         coche.modelo = request.form.get('modelo') or None
@@ -276,11 +1011,13 @@ def editar_coche(id):
             db.session.commit()
             flash('Vehículo actualizado correctamente', 'success')
             return redirect(url_for('listar_coches'))
+        except StaleDataError:
+            return conflicto_edicion(Coche, id, CAMPOS_COCHE, 'el vehículo', url_for('listar_coches'))
         except Exception as e:
             db.session.rollback()
             flash(f'Error al actualizar vehículo: {str(e)}', 'error')
     
-    clientes = Cliente.query.order_by(Cliente.nombre).all()
+    clientes = opciones_clientes()
     return render_template('vehiculos/editar.html', coche=coche, clientes=clientes)
 
 @app.route('/coches/<int:id>/eliminar', methods=['POST'])
@@ -299,25 +1036,162 @@ def eliminar_coche(id):
 @app.route('/coches/<int:id>/ficha')
 def ficha_coche(id):
     coche = Coche.query.get_or_404(id)
-    intervenciones = Intervencion.query.filter_by(coche_id=id).order_by(Intervencion.fecha.desc()).all()
-    return render_template('vehiculos/ficha.html', coche=coche, intervenciones=intervenciones)
+    vencimientos = Vencimiento.query.filter_by(coche_id=id).order_by(Vencimiento.fecha_prevista).all()
+    return respuesta_en_flujo('vehiculos/ficha.html', coche=coche, vencimientos=vencimientos,
+                              servicios=mantenimiento.NOMBRES_SERVICIOS, hoy=datetime.now().date(),
+                              intervenciones=consultas.iterar_intervenciones(coche_id=id),
+                              adjuntos=adjuntos.de_coche(id), tipos_miniatura=adjuntos.CON_MINIATURA,
+                              intervenciones_adjuntables=adjuntos.intervenciones_de_coche(id))
+
+# ========== FOTOS Y DOCUMENTOS ==========
+
+almacen_adjuntos = adjuntos.Almacen(app.config['ADJUNTOS_DIR'], hilos=app.config['ADJUNTOS_HILOS_MINIATURAS'])
+
+class PeticionTaller(Request):
+    """Petición que escribe los ficheros subidos directamente en el almacén de adjuntos"""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if self.endpoint == 'subir_adjuntos':
+            return almacen_adjuntos.fichero_entrante(db.taller_activo())
+        return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+
+app.request_class = PeticionTaller
+
+def enviar_inmutable(ruta, tipo, etag, nombre=None):
+    """Sirve un fichero que no cambia nunca: caché larga, ETag y peticiones por rangos"""
+    respuesta = send_file(ruta, mimetype=tipo, conditional=True, etag=etag, download_name=nombre,
+                          max_age=app.config['ADJUNTOS_CACHE_SEGUNDOS'])
+    respuesta.cache_control.public = False
+    respuesta.cache_control.private = True
+    respuesta.cache_control.immutable = True
+    return respuesta
+
+@app.route('/coches/<int:id>/adjuntos', methods=['POST'])
+def subir_adjuntos(id):
+    """Adjunta los ficheros del campo `archivos` al vehículo o, con `intervencion_id`, a una de sus intervenciones"""
+    coche = Coche.query.get_or_404(id)
+    intervencion_id = request.form.get('intervencion_id', type=int)
+    if intervencion_id and not Intervencion.query.filter_by(id=intervencion_id, coche_id=coche.id).first():
+        abort(404)
+    taller = db.taller_activo()
+    subidos, rechazados, miniaturas = 0, [], set()
+    # Hasta el commit, una purga no puede borrar los ficheros que se reutilizan
+    with almacen_adjuntos.bloqueo(taller):
+        for fichero in request.files.getlist('archivos'):
+            entrante = fichero.stream
+            if not fichero.filename or not isinstance(entrante, adjuntos.FicheroEntrante):
+                continue
+            if entrante.tipo is None:
+                rechazados.append(fichero.filename)
+                continue
+            almacen_adjuntos.guardar(entrante, taller)
+            adjuntos.adjuntar(entrante, fichero.filename, coche_id=None if intervencion_id else coche.id,
+                              intervencion_id=intervencion_id)
+            if entrante.tipo in adjuntos.CON_MINIATURA:
+                miniaturas.add(entrante.hash)
+            subidos += 1
+        try:
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            flash(f'Error al guardar los adjuntos: {str(e)}', 'error')
+            return redirect(url_for('ficha_coche', id=coche.id))
+    for hash in miniaturas:
+        almacen_adjuntos.encolar_miniatura(hash, taller)
+    if subidos:
+        flash(f'{subidos} fichero(s) adjuntado(s)', 'success')
+    if rechazados:
+        flash(f'Tipo de fichero no admitido (solo fotos y PDF): {", ".join(rechazados)}', 'error')
+    if not subidos and not rechazados:
+        flash('No se ha seleccionado ningún fichero', 'info')
+    return redirect(url_for('ficha_coche', id=coche.id))
+
+def adjunto_o_404(id, hash):
+    # SQLite reutiliza el id del último adjunto borrado: con el hash en la URL, la que
+    # los navegadores guardan como inmutable no puede pasar a servir otro contenido
+    fila = db.session.execute(
+        db.select(Adjunto.nombre, Archivo.hash, Archivo.tipo).join(Archivo, Adjunto.archivo_id == Archivo.id)
+        .where(Adjunto.id == id, Archivo.hash == hash)
+    ).first()
+    if fila is None:
+        abort(404)
+    return fila
+
+@app.route('/adjuntos/<int:id>/<string(length=64):hash>')
+def ver_adjunto(id, hash):
+    nombre, hash, tipo = adjunto_o_404(id, hash)
+    return enviar_inmutable(almacen_adjuntos.ruta(hash, db.taller_activo()), tipo, hash, nombre)
+
+@app.route('/adjuntos/<int:id>/<string(length=64):hash>/miniatura')
+def miniatura_adjunto(id, hash):
+    _, hash, tipo = adjunto_o_404(id, hash)
+    if tipo not in adjuntos.CON_MINIATURA:
+        abort(404)
+    try:
+        ruta = almacen_adjuntos.miniatura(hash, db.taller_activo(), plazo=10)
+    except TimeoutError:
+        # Sigue generándose en el pool: no se retiene el hilo más tiempo
+        raise ServiceUnavailable(retry_after=5)
+    if ruta is None:
+        abort(404)
+    return enviar_inmutable(ruta, 'image/jpeg', f'{hash}-{almacen_adjuntos.lado}')
+
+@app.route('/adjuntos/<int:id>/eliminar', methods=['POST'])
+def eliminar_adjunto(id):
+    """Quita el adjunto; el fichero se borra al purgar si ya no está adjunto a nada"""
+    adjunto = Adjunto.query.get_or_404(id)
+    coche_id = adjunto.coche_id or db.session.get(Intervencion, adjunto.intervencion_id).coche_id
+    try:
+        db.session.delete(adjunto)
+        db.session.commit()
+        flash('Adjunto eliminado correctamente', 'success')
+    except Exception as e:
+        db.session.rollback()
+        flash(f'Error al eliminar adjunto: {str(e)}', 'error')
+    return redirect(url_for('ficha_coche', id=coche_id))
+
+@app.cli.command('purgar-adjuntos')
+def purgar_adjuntos():
+    """Borra del disco los ficheros que ya no están adjuntos a nada."""
+    borrados = adjuntos.purgar(almacen_adjuntos, db.taller_activo())
+    adjuntado, en_disco = adjuntos.espacio()
+    click.echo(f'{borrados} ficheros borrados; adjuntos: {adjuntado / 1048576:.1f} MB, '
+               f'en disco: {en_disco / 1048576:.1f} MB')
+
+# ========== MANTENIMIENTO ==========
+
+@app.route('/mantenimiento')
+def vencimientos_mantenimiento():
+    """Mantenimientos previstos en un mes (`mes=AAAA-MM`, por defecto el actual) y los ya vencidos"""
+    hoy = datetime.now().date()
+    try:
+        inicio = datetime.strptime(request.args.get('mes', ''), '%Y-%m').date()
+    except ValueError:
+        inicio = hoy.replace(day=1)
+    fin = mantenimiento.sumar_meses(inicio, 1)
+    return render_template('mantenimiento/vencimientos.html',
+                           vencimientos=mantenimiento.vencimientos_entre(inicio, fin),
+                           vencidos=mantenimiento.vencimientos_entre(None, min(hoy, inicio)),
+                           inicio=inicio, anterior=mantenimiento.sumar_meses(inicio, -1), siguiente=fin,
+                           servicios=mantenimiento.NOMBRES_SERVICIOS, hoy=hoy)
+
+@app.cli.command('recalcular-vencimientos')
+def recalcular_vencimientos():
+    """Recalcula la previsión de mantenimientos de todos los vehículos."""
+    total = mantenimiento.recalcular_todos(db.session)
+    db.session.commit()
+    click.echo(f'Vencimientos recalculados para {total} vehículos')
 
 # ========== RUTAS DE INTERVENCIONES ==========
 
 @app.route('/intervenciones')
 def listar_intervenciones():
-    from sqlalchemy.orm import joinedload
-    intervenciones = Intervencion.query.options(
-        joinedload(Intervencion.coche),
-        joinedload(Intervencion.cliente)
-    ).order_by(Intervencion.fecha.desc()).all()
-    return render_template('intervenciones/listar.html', intervenciones=intervenciones)
+    return respuesta_en_flujo('intervenciones/listar.html', intervenciones=consultas.iterar_intervenciones())
 
 @app.route('/intervenciones/nueva/vehiculo')
 def seleccionar_vehiculo_intervencion():
     """Página para seleccionar vehículo antes de crear intervención"""
-    from sqlalchemy.orm import joinedload
-    vehiculos = Coche.query.options(joinedload(Coche.cliente)).order_by(Coche.matricula).all()
+    vehiculos = consultas.filas_coches()
     return render_template('intervenciones/seleccionar_vehiculo.html', vehiculos=vehiculos)
 
 @app.route('/intervenciones/nueva', methods=['GET', 'POST'])
@@ -327,8 +1201,8 @@ def nueva_intervencion():
         coche_id = int(request.form['coche_id']) if request.form.get('coche_id') else None
         if not coche_id:
             flash('Debe seleccionar un vehículo', 'error')
-            vehiculos = Coche.query.order_by(Coche.matricula).all()
-            clientes = Cliente.query.order_by(Cliente.nombre).all()
+            vehiculos = opciones_vehiculos()
+            clientes = opciones_clientes()
             return render_template('intervenciones/nueva.html', vehiculos=vehiculos, clientes=clientes, coche=None)
         
         fecha = datetime.strptime(request.form['fecha'], '%Y-%m-%d')
@@ -341,8 +1215,8 @@ def nueva_intervencion():
         
         if not descripciones or not any(descripciones):
             flash('Debe añadir al menos una línea de intervención', 'error')
-            vehiculos = Coche.query.order_by(Coche.matricula).all()
-            clientes = Cliente.query.order_by(Cliente.nombre).all()
+            vehiculos = opciones_vehiculos()
+            clientes = opciones_clientes()
             coche = Coche.query.get(coche_id)
             return render_template('intervenciones/nueva.html', vehiculos=vehiculos, clientes=clientes, coche=coche)
         
@@ -358,7 +1232,7 @@ def nueva_intervencion():
                         fecha=fecha,
                         km=km,
                         descripcion=descripciones[i].strip(),
-                        precio=float(precios[i].replace(',', '.')) if precios[i] and precios[i].strip() else 0.0,
+                        precio=a_decimal(precios[i]),
                         horas_trabajo=float(horas[i].replace(',', '.')) if horas[i] and horas[i].strip() else 0.0
                     )
                     db.session.add(intervencion)
@@ -371,8 +1245,8 @@ def nueva_intervencion():
             db.session.rollback()
             flash(f'Error al registrar intervención: {str(e)}', 'error')
     
-    vehiculos = Coche.query.order_by(Coche.matricula).all()
-    clientes = Cliente.query.order_by(Cliente.nombre).all()
+    vehiculos = opciones_vehiculos()
+    clientes = opciones_clientes()
     return render_template('intervenciones/nueva.html', vehiculos=vehiculos, clientes=clientes, coche=None)
 
 @app.route('/coches/<int:coche_id>/intervenciones/nueva', methods=['GET', 'POST'])
@@ -391,8 +1265,8 @@ def nueva_intervencion_vehiculo(coche_id):
         
         if not descripciones or not any(descripciones):
             flash('Debe añadir al menos una línea de intervención', 'error')
-            clientes = Cliente.query.order_by(Cliente.nombre).all()
-            vehiculos = Coche.query.order_by(Coche.matricula).all()
+            clientes = opciones_clientes()
+            vehiculos = opciones_vehiculos()
             return render_template('intervenciones/nueva.html', coche=coche, clientes=clientes, vehiculos=vehiculos)
         
         cliente_id = int(request.form['cliente_id']) if request.form.get('cliente_id') else None
@@ -407,7 +1281,7 @@ def nueva_intervencion_vehiculo(coche_id):
                         fecha=fecha,
                         km=km,
                         descripcion=descripciones[i].strip(),
-                        precio=float(precios[i].replace(',', '.')) if precios[i] and precios[i].strip() else 0.0,
+                        precio=a_decimal(precios[i]),
                         horas_trabajo=float(horas[i].replace(',', '.')) if horas[i] and horas[i].strip() else 0.0
                     )
                     db.session.add(intervencion)
@@ -420,22 +1294,25 @@ def nueva_intervencion_vehiculo(coche_id):
             db.session.rollback()
             flash(f'Error al registrar intervención: {str(e)}', 'error')
     
-    clientes = Cliente.query.order_by(Cliente.nombre).all()
-    vehiculos = Coche.query.order_by(Coche.matricula).all()
+    clientes = opciones_clientes()
+    vehiculos = opciones_vehiculos()
     return render_template('intervenciones/nueva.html', coche=coche, clientes=clientes, vehiculos=vehiculos)
 
 @app.route('/intervenciones/<int:id>/editar', methods=['GET', 'POST'])
 def editar_intervencion(id):
     intervencion = Intervencion.query.get_or_404(id)
+    coche_id = intervencion.coche_id
     
     if request.method == 'POST':
+        if version_obsoleta(intervencion):
+            return conflicto_edicion(Intervencion, id, CAMPOS_INTERVENCION, 'la intervención',
+                                     url_for('ficha_coche', id=coche_id))
         intervencion.fecha = datetime.strptime(request.form['fecha'], '%Y-%m-%d')
         intervencion.km = int(request.form['km']) if request.form.get('km') else None
         intervencion.cliente_id = int(request.form['cliente_id']) if request.form.get('cliente_id') else None
         intervencion.descripcion = request.form['descripcion']
-        precio_str = request.form['precio'].replace(',', '.') if request.form.get('precio') else '0'
         horas_str = request.form.get('horas_trabajo', '0').replace(',', '.') if request.form.get('horas_trabajo') else '0'
-        intervencion.precio = float(precio_str)
+        intervencion.precio = a_decimal(request.form.get('precio'))
         intervencion.horas_trabajo = float(horas_str)
         
         try:
@@ -445,11 +1322,14 @@ def editar_intervencion(id):
             if request.referrer and 'intervenciones' in request.referrer:
                 return redirect(url_for('listar_intervenciones'))
             return redirect(url_for('ficha_coche', id=intervencion.coche_id))
+        except StaleDataError:
+            return conflicto_edicion(Intervencion, id, CAMPOS_INTERVENCION, 'la intervención',
+                                     url_for('ficha_coche', id=coche_id))
         except Exception as e:
             db.session.rollback()
             flash(f'Error al actualizar intervención: {str(e)}', 'error')
     
-    clientes = Cliente.query.order_by(Cliente.nombre).all()
+    clientes = opciones_clientes()
     return render_template('intervenciones/editar.html', intervencion=intervencion, clientes=clientes)
 
 @app.route('/intervenciones/<int:id>/eliminar', methods=['POST'])
@@ -472,26 +1352,141 @@ def eliminar_intervencion(id):
     
     return redirect(url_for('ficha_coche', id=coche_id))
 
+# ========== CATÁLOGO DE PRECIOS ==========
+
+def articulo_desde_formulario(articulo):
+    articulo.tipo = request.form.get('tipo') if request.form.get('tipo') in catalogo.TIPOS else 'mano_obra'
+    articulo.descripcion = request.form['descripcion'].strip()
+    articulo.precio = a_decimal(request.form.get('precio'))
+    articulo.horas = float(request.form['horas'].replace(',', '.')) if request.form.get('horas') else 0.0
+    articulo.activo = bool(request.form.get('activo'))
+
+@app.route('/catalogo', methods=['GET', 'POST'])
+def listar_catalogo():
+    if request.method == 'POST':
+        articulo = ArticuloCatalogo()
+        try:
+            articulo_desde_formulario(articulo)
+            db.session.add(articulo)
+            db.session.commit()
+            flash('Artículo añadido al catálogo', 'success')
+            return redirect(url_for('listar_catalogo'))
+        except Exception as e:
+            db.session.rollback()
+            flash(f'Error al añadir el artículo: {str(e)}', 'error')
+    
+    articulos = ArticuloCatalogo.query.order_by(ArticuloCatalogo.tipo, ArticuloCatalogo.descripcion).all()
+    return render_template('catalogo/listar.html', articulos=articulos, tipos=catalogo.TIPOS)
+
+@app.route('/catalogo/<int:id>/editar', methods=['GET', 'POST'])
+def editar_articulo_catalogo(id):
+    articulo = ArticuloCatalogo.query.get_or_404(id)
+    
+    if request.method == 'POST':
+        try:
+            articulo_desde_formulario(articulo)
+            db.session.commit()
+            flash('Artículo actualizado correctamente', 'success')
+            return redirect(url_for('listar_catalogo'))
+        except Exception as e:
+            db.session.rollback()
+            flash(f'Error al actualizar el artículo: {str(e)}', 'error')
+    
+    return render_template('catalogo/editar.html', articulo=articulo, tipos=catalogo.TIPOS)
+
+@app.route('/catalogo/<int:id>/eliminar', methods=['POST'])
+def eliminar_articulo_catalogo(id):
+    articulo = ArticuloCatalogo.query.get_or_404(id)
+    try:
+        db.session.delete(articulo)
+        db.session.commit()
+        flash('Artículo eliminado del catálogo', 'success')
+    except Exception as e:
+        db.session.rollback()
+        flash(f'Error al eliminar el artículo: {str(e)}', 'error')
+    
+    return redirect(url_for('listar_catalogo'))
+
+@app.route('/catalogo/sugerencias')
+def sugerencias_catalogo():
+    """Artículos del catálogo para lo escrito en una descripción (`q`), desde el índice en memoria"""
+    # Entre 1 y 50: se pide en cada pulsación y un límite negativo recortaría por el final
+    limite = max(1, min(request.args.get('limite', 10, type=int), 50))
+    articulos = indice_catalogo().buscar(request.args.get('q', ''), limite=limite)
+    return jsonify([
+        {'id': articulo.id, 'tipo': articulo.tipo, 'descripcion': articulo.descripcion,
+         'precio': f'{articulo.precio:.2f}', 'horas': articulo.horas}
+        for articulo in articulos
+    ])
+
+@app.cli.command('sembrar-catalogo')
+@click.option('--limite', default=200, show_default=True, help='Descripciones frecuentes a considerar')
+@click.option('--minimo', default=2, show_default=True, help='Veces que debe repetirse una descripción')
+def sembrar_catalogo(limite, minimo):
+    """Añade al catálogo las descripciones más frecuentes del histórico que aún no estén."""
+    añadidos = catalogo.sembrar(limite=limite, minimo=minimo)
+    db.session.commit()
+    click.echo(f'{añadidos} artículos añadidos al catálogo')
+
 # ========== RUTAS DE FACTURAS ==========
 
 @app.route('/facturas')
 def listar_facturas():
-    from sqlalchemy.orm import joinedload
-    # Obtener intervenciones sin facturar
-    intervenciones_sin_facturar = Intervencion.query.options(
-        joinedload(Intervencion.coche),
-        joinedload(Intervencion.cliente)
-    ).filter_by(factura_id=None).order_by(Intervencion.fecha.desc()).all()
-    
-    # También obtener facturas para mostrar en otra sección
-    facturas = Factura.query.order_by(Factura.fecha.desc()).all()
+    def renderizar_sin_facturar():
+        # Obtener intervenciones sin facturar
+        intervenciones_sin_facturar = consultas.filas_intervenciones(sin_facturar=True)
+        return render_template('facturas/_tabla_sin_facturar.html',
+                               intervenciones_sin_facturar=intervenciones_sin_facturar)
+    
+    def renderizar_facturas():
+        # También obtener facturas para mostrar en otra sección
+        return render_template('facturas/_tabla_facturas.html', facturas=consultas.filas_facturas())
+    
+    tabla_sin_facturar = cache_fragmentos.obtener(
+        'intervenciones_sin_facturar', ('intervenciones', 'coches', 'clientes'),
+        {}, renderizar_sin_facturar)
+    tabla_facturas = cache_fragmentos.obtener(
+        'facturas', ('facturas', 'clientes'), {}, renderizar_facturas)
     
     return render_template('facturas/listar.html', 
-                         intervenciones_sin_facturar=intervenciones_sin_facturar, 
-                         facturas=facturas)
+                         tabla_sin_facturar=tabla_sin_facturar, 
+                         tabla_facturas=tabla_facturas)
+
+@app.route('/facturas/tablero')
+def tablero_sin_facturar():
+    """Intervenciones sin facturar que se actualizan solas (Server-Sent Events)"""
+    # La secuencia se lee antes que las filas: lo que cambie entre medias llegará como evento
+    secuencia = cambios.ultima_secuencia()
+    return render_template('facturas/tablero.html',
+                           intervenciones_sin_facturar=consultas.filas_intervenciones(sin_facturar=True),
+                           secuencia=secuencia)
+
+@app.route('/facturas/tablero/eventos')
+def eventos_tablero():
+    """Flujo de eventos del tablero desde la secuencia `desde` (o Last-Event-ID al reconectar)"""
+    from flask import Response
+    
+    try:
+        desde = int(request.headers.get('Last-Event-ID') or request.args.get('desde', ''))
+    except ValueError:
+        abort(400)
+    difusor = difusor_tablero()
+    suscripcion = difusor.suscribir(desde)
+    
+    def generar():
+        try:
+            yield from suscripcion.eventos()
+        finally:
+            difusor.cancelar(suscripcion)
+    
+    return Response(generar(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 @app.route('/facturas/nueva', methods=['GET', 'POST'])
 def nueva_factura():
+    if verifactu.nif_emisor() is None:
+        flash('Indique el NIF del taller antes de crear facturas: sin él no se pueden generar los registros Verifactu', 'error')
+        return redirect(url_for('datos_taller'))
     if request.method == 'POST':
         cliente_id = int(request.form['cliente_id'])
         
@@ -534,10 +1529,10 @@ def nueva_factura():
             
             if vehiculo_id and fecha and descripcion and precio:
                 try:
-                    precio_float = float(precio.replace(',', '.')) if precio else 0.0
+                    precio_importe = a_decimal(precio)
                     horas_float = float(horas.replace(',', '.')) if horas else 0.0
                 except (ValueError, AttributeError):
-                    precio_float = 0.0
+                    precio_importe = a_decimal(0)
                     horas_float = 0.0
                 
                 nuevas_intervenciones_data.append({
@@ -546,7 +1541,7 @@ def nueva_factura():
                     'km': int(km) if km and km.strip() else None,
                     'cliente_id': int(cliente_id_interv) if cliente_id_interv and cliente_id_interv.strip() else None,
                     'descripcion': descripcion.strip(),
-                    'precio': precio_float,
+                    'precio': precio_importe,
                     'horas_trabajo': horas_float
                 })
         
@@ -559,9 +1554,6 @@ def nueva_factura():
         descuento_porcentaje = float(request.form.get('descuento_porcentaje', '0').replace(',', '.')) if request.form.get('descuento_porcentaje') else 0.0
         iva_porcentaje = float(request.form.get('iva_porcentaje', '21').replace(',', '.')) if request.form.get('iva_porcentaje') else 21.0
         
-        # Calcular base imponible inicial con intervenciones existentes
-        base_imponible = sum(interv.precio for interv in intervenciones_existentes)
-        
         # Generar número de factura
         ultima_factura = Factura.query.order_by(Factura.id.desc()).first()
         numero_factura = f"FAC-{datetime.now().year}-{ultima_factura.id + 1 if ultima_factura else 1:04d}"
@@ -583,9 +1575,10 @@ def nueva_factura():
             db.session.flush()  # Para obtener el ID
             
             # Asociar intervenciones existentes
+            importes = []
             for interv in intervenciones_existentes:
                 interv.factura_id = factura.id
-                base_imponible += interv.precio
+                importes.append(interv.precio)
             
             # Crear nuevas intervenciones desde el modal
             for interv_data in nuevas_intervenciones_data:
@@ -602,25 +1595,15 @@ def nueva_factura():
                     factura_id=factura.id
                 )
                 db.session.add(nueva_intervencion)
-                base_imponible += nueva_intervencion.precio
-            
-            # Calcular descuento
-            descuento_importe = base_imponible * (descuento_porcentaje / 100)
-            
-            # Base después de descuento
-            base_despues_descuento = base_imponible - descuento_importe
+                importes.append(nueva_intervencion.precio)
             
-            # Calcular IVA sobre la base después de descuento
-            iva_importe = base_despues_descuento * (iva_porcentaje / 100)
-            
-            # Total final
-            total = base_despues_descuento + iva_importe
-            
-            # Actualizar valores de la factura
-            factura.base_imponible = base_imponible
-            factura.descuento_importe = descuento_importe
-            factura.iva_importe = iva_importe
-            factura.total = total
+            # Base imponible, descuento, IVA sobre la base después de descuento y total
+            totales = calcular_totales(importes, descuento_porcentaje, iva_porcentaje)
+            factura.base_imponible = totales['base_imponible']
+            factura.descuento_importe = totales['descuento_importe']
+            factura.iva_importe = totales['iva_importe']
+            factura.total = totales['total']
+            verifactu.encadenar(factura)
             
             db.session.commit()
             flash('Factura creada correctamente', 'success')
@@ -630,8 +1613,8 @@ def nueva_factura():
             flash(f'Error al crear factura: {str(e)}', 'error')
     
     # GET: mostrar formulario
-    clientes = Cliente.query.order_by(Cliente.nombre).all()
-    vehiculos = Coche.query.order_by(Coche.matricula).all()
+    clientes = opciones_clientes()
+    vehiculos = opciones_vehiculos()
     
     # Obtener intervenciones precargadas desde query string
     intervenciones_precargadas = []
@@ -696,7 +1679,117 @@ def nueva_factura():
 @app.route('/facturas/<int:id>')
 def ver_factura(id):
     factura = Factura.query.get_or_404(id)
-    return render_template('facturas/ver.html', factura=factura)
+    pagado = sum((pago.importe for pago in factura.pagos), a_decimal(0))
+    return render_template('facturas/ver.html', factura=factura, pagado=pagado,
+                           pendiente=factura.total - pagado, metodos_pago=METODOS_PAGO,
+                           hoy=datetime.now().strftime('%Y-%m-%d'),
+                           envios=correo.envios_de_factura(id), estados_envio=correo.ESTADOS)
+
+@app.route('/facturas/<int:id>/pagos', methods=['POST'])
+def registrar_pago(id):
+    factura = Factura.query.get_or_404(id)
+    pendiente = factura.total - sum((pago.importe for pago in factura.pagos), a_decimal(0))
+    try:
+        importe = a_decimal(request.form.get('importe'))
+        fecha = datetime.strptime(request.form['fecha'], '%Y-%m-%d') if request.form.get('fecha') else datetime.now()
+    except ValueError as e:
+        flash(f'Datos del pago no válidos: {e}', 'error')
+        return redirect(url_for('ver_factura', id=id))
+    metodo = request.form.get('metodo', 'efectivo')
+    
+    if importe <= 0:
+        flash('El importe del pago debe ser mayor que cero', 'error')
+    elif importe > pendiente:
+        flash(f'El importe supera lo pendiente de la factura ({pendiente:.2f} €)', 'error')
+    elif metodo not in METODOS_PAGO:
+        flash('Método de pago no válido', 'error')
+    else:
+        try:
+            db.session.add(Pago(factura_id=id, fecha=fecha, importe=importe, metodo=metodo,
+                                notas=request.form.get('notas') or None))
+            db.session.commit()
+            flash('Pago registrado correctamente', 'success')
+        except Exception as e:
+            db.session.rollback()
+            flash(f'Error al registrar pago: {str(e)}', 'error')
+    return redirect(url_for('ver_factura', id=id))
+
+@app.route('/pagos/<int:id>/eliminar', methods=['POST'])
+def eliminar_pago(id):
+    pago = Pago.query.get_or_404(id)
+    factura_id = pago.factura_id
+    try:
+        db.session.delete(pago)
+        db.session.commit()
+        flash('Pago eliminado correctamente', 'success')
+    except Exception as e:
+        db.session.rollback()
+        flash(f'Error al eliminar pago: {str(e)}', 'error')
+    return redirect(url_for('ver_factura', id=factura_id))
+
+@app.cli.command('conciliar-saldos')
+@click.option('--corregir', is_flag=True, help='Recalcula los saldos descuadrados')
+def conciliar_saldos(corregir):
+    """Comprueba los saldos de clientes contra facturas y pagos."""
+    descuadres = saldos.conciliar(corregir=corregir)
+    for d in descuadres:
+        click.echo(f"{d.cliente_id} {d.nombre}: facturado {d.facturado_guardado} (real {d.facturado_real}), "
+                   f"pagado {d.pagado_guardado} (real {d.pagado_real})")
+    if not descuadres:
+        click.echo('Todos los saldos cuadran')
+    elif corregir:
+        click.echo(f'{len(descuadres)} saldos corregidos')
+    else:
+        click.echo(f'{len(descuadres)} saldos descuadrados (use --corregir para recalcularlos)')
+
+@app.route('/taller/datos', methods=['GET', 'POST'])
+def datos_taller():
+    """NIF del taller, con el que se emiten y encadenan sus facturas"""
+    if request.method == 'POST':
+        try:
+            nif = verifactu.guardar_nif(request.form.get('nif'))
+            db.session.commit()
+            flash(f'NIF del taller guardado: {nif}', 'success')
+            return redirect(url_for('datos_taller'))
+        except ValueError as e:
+            db.session.rollback()
+            flash(str(e), 'error')
+    return render_template('taller/datos.html', nif=verifactu.nif_emisor(),
+                           facturas_encadenadas=Factura.query.filter(Factura.huella.isnot(None)).count())
+
+@app.cli.command('nif-taller')
+@click.argument('nif', required=False)
+def nif_taller(nif):
+    """Muestra o cambia el NIF del taller (con varios talleres, el de TALLER)."""
+    if nif is not None:
+        try:
+            verifactu.guardar_nif(nif)
+        except ValueError as e:
+            raise click.ClickException(str(e))
+        db.session.commit()
+    click.echo(verifactu.nif_emisor() or '(sin NIF)')
+
+@app.cli.command('verificar-verifactu')
+@click.option('--emisor', help='NIF del emisor (por defecto, todos)')
+@click.option('--incremental', is_flag=True, help='Solo los registros posteriores a la última verificación correcta')
+def verificar_verifactu(emisor, incremental):
+    """Recorre la cadena de registros Verifactu y muestra el primer eslabón roto."""
+    rotas = 0
+    for nif in [emisor] if emisor is not None else verifactu.emisores():
+        inicio = time.perf_counter()
+        resultado = verifactu.verificar(nif, incremental=incremental)
+        segundos = time.perf_counter() - inicio
+        if resultado.roto:
+            rotas += 1
+            roto = resultado.roto
+            click.echo(f"{nif or '(sin NIF)'}: eslabón roto en la factura {roto.numero_factura or '-'} "
+                       f"(id {roto.factura_id}): {roto.motivo}")
+        else:
+            click.echo(f"{nif or '(sin NIF)'}: cadena correcta, {resultado.comprobados} registros comprobados "
+                       f"de {resultado.registros} en {segundos:.2f} s")
+    db.session.commit()
+    if rotas:
+        raise SystemExit(1)
 
 @app.route('/facturas/<int:id>/enviar_verifactu', methods=['POST'])
 def enviar_verifactu(id):
@@ -707,7 +1800,10 @@ def enviar_verifactu(id):
         return redirect(url_for('ver_factura', id=id))
     
     # Llamar a la función de envío
+    inicio = time.perf_counter()
     resultado = enviar_factura_verifactu(factura)
+    metricas.observar('taller_verifactu_segundos', time.perf_counter() - inicio)
+    metricas.incrementar('taller_verifactu_envios_total', resultado='exito' if resultado['exito'] else 'error')
     
     if resultado['exito']:
         factura.enviada_verifactu = True
@@ -720,6 +1816,7 @@ def enviar_verifactu(id):
     return redirect(url_for('ver_factura', id=id))
 
 @app.route('/facturas/<int:id>/pdf')
+@admision.limitar('pdf')
 def descargar_pdf_factura(id):
     """Ruta para descargar el PDF de una factura"""
     from sqlalchemy.orm import joinedload
@@ -741,6 +1838,280 @@ def descargar_pdf_factura(id):
         flash(f'Error al generar PDF: {str(e)}', 'error')
         return redirect(url_for('ver_factura', id=id))
 
+# ========== ENVÍO DE FACTURAS POR CORREO ==========
+
+def avisar_encolado(resultado):
+    if resultado.encoladas:
+        flash(f'{resultado.encoladas} factura(s) en cola de envío por correo', 'success')
+    if resultado.sin_email:
+        flash(f'{resultado.sin_email} factura(s) sin email del cliente', 'error')
+    if resultado.repetidas:
+        flash(f'{resultado.repetidas} factura(s) ya enviadas o en cola', 'info')
+
+def mes_solicitado(valor):
+    try:
+        mes = datetime.strptime(valor or '', '%Y-%m').date()
+    except ValueError:
+        mes = None
+    # Como en los informes, un año fuera de rango (el mes siguiente a 9999-12 no existe) vuelve al mes actual
+    if mes is None or not 1900 <= mes.year < 9999:
+        return datetime.now().date().replace(day=1)
+    return mes
+
+@app.route('/facturas/correo')
+def envios_correo():
+    """Estado del envío por correo de las facturas de un mes"""
+    inicio = mes_solicitado(request.args.get('mes'))
+    fin = mantenimiento.sumar_meses(inicio, 1)
+    facturas = correo.estado_facturas(inicio, fin)
+    recuento = {}
+    for fila in facturas:
+        recuento[fila.estado or 'sin_enviar'] = recuento.get(fila.estado or 'sin_enviar', 0) + 1
+    return render_template('facturas/correo.html', facturas=facturas, recuento=recuento, estados=correo.ESTADOS,
+                           inicio=inicio, anterior=mantenimiento.sumar_meses(inicio, -1), siguiente=fin)
+
+@app.route('/facturas/correo', methods=['POST'])
+def enviar_correo_mes():
+    """Encola el envío de todas las facturas del mes (el worker de correo las envía)"""
+    inicio = mes_solicitado(request.form.get('mes'))
+    fin = mantenimiento.sumar_meses(inicio, 1)
+    resultado = correo.encolar(Factura.fecha >= inicio, Factura.fecha < fin,
+                               reenviar=bool(request.form.get('reenviar')))
+    db.session.commit()
+    avisar_encolado(resultado)
+    return redirect(url_for('envios_correo', mes=inicio.strftime('%Y-%m')))
+
+@app.route('/facturas/<int:id>/enviar_correo', methods=['POST'])
+def enviar_correo_factura(id):
+    factura = Factura.query.get_or_404(id)
+    resultado = correo.encolar(Factura.id == id, reenviar=True)
+    db.session.commit()
+    avisar_encolado(resultado)
+    if request.form.get('mes'):
+        return redirect(url_for('envios_correo', mes=request.form['mes']))
+    return redirect(url_for('ver_factura', id=factura.id))
+
+@app.cli.command('enviar-correos')
+@click.option('--una-vez', is_flag=True, help='Envía lo que está listo y termina, en lugar de quedarse esperando')
+def enviar_correos(una_vez):
+    """Worker de correo: envía las facturas en cola reutilizando las conexiones SMTP."""
+    import signal
+    
+    config = app.config
+    pool = correo.PoolSMTP(config['SMTP_SERVIDOR'], config['SMTP_PUERTO'], usuario=config['SMTP_USUARIO'],
+                           clave=config['SMTP_CLAVE'], cifrado=config['SMTP_CIFRADO'],
+                           conexiones=config['SMTP_CONEXIONES'],
+                           mensajes_por_conexion=config['SMTP_MENSAJES_POR_CONEXION'], metricas=metricas)
+    trabajador = correo.TrabajadorCorreo(pool, config['SMTP_REMITENTE'], generar_pdf_factura,
+                                         limitador=correo.Limitador(config['SMTP_MENSAJES_POR_MINUTO']),
+                                         hilos=config['SMTP_CONEXIONES'], lote=config['CORREO_LOTE'],
+                                         max_intentos=config['CORREO_MAX_INTENTOS'],
+                                         reintento=config['CORREO_REINTENTO'], metricas=metricas)
+    # Con varios talleres y sin TALLER, un único worker atiende la cola de todos
+    if db.pool_talleres is not None and not config['TALLER']:
+        talleres = db.pool_talleres.talleres
+    else:
+        talleres = lambda: [config['TALLER']]
+    
+    parar = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *args: parar.set())
+    try:
+        while not parar.is_set():
+            procesados = 0
+            for taller in talleres():
+                with contexto_taller(taller):
+                    resultado = trabajador.procesar_lote()
+                if resultado:
+                    procesados += sum(resultado.values())
+                    click.echo(f"{taller or 'taller'}: " +
+                               ', '.join(f'{n} {estado}' for estado, n in sorted(resultado.items())))
+                metricas.tal_vez_volcar()
+            if not procesados:
+                if una_vez:
+                    break
+                parar.wait(config['CORREO_INTERVALO'])
+    except KeyboardInterrupt:
+        pass
+    finally:
+        trabajador.cerrar()
+
+# ========== INFORMES ==========
+
+def periodo_informe():
+    """
+    Lee el periodo del informe de los parámetros `anio` y `trimestre`.
+    Sin trimestre se usa el trimestre actual; con trimestre vacío, el año completo.
+    
+    Returns:
+        dict: anio, trimestre, desde (incluido), hasta (excluido) y descripción
+    """
+    hoy = datetime.now()
+    anio = request.args.get('anio', type=int) or hoy.year
+    if not 1900 <= anio < 9999:
+        # Fuera del calendario (el periodo acaba el 1 de enero del año siguiente): el año actual
+        anio = hoy.year
+    if 'trimestre' in request.args:
+        trimestre = request.args.get('trimestre', type=int)
+    else:
+        trimestre = (hoy.month - 1) // 3 + 1
+    
+    if trimestre in (1, 2, 3, 4):
+        desde = datetime(anio, 3 * (trimestre - 1) + 1, 1)
+        hasta = datetime(anio + 1, 1, 1) if trimestre == 4 else datetime(anio, 3 * trimestre + 1, 1)
+        descripcion = f'{trimestre}T {anio}'
+    else:
+        trimestre = None
+        desde = datetime(anio, 1, 1)
+        hasta = datetime(anio + 1, 1, 1)
+        descripcion = f'Año {anio}'
+    
+    return {'anio': anio, 'trimestre': trimestre, 'desde': desde, 'hasta': hasta, 'descripcion': descripcion}
+
+def formato_csv(valor):
+    """Importe con coma decimal para hojas de cálculo en español"""
+    return f"{valor or 0:.2f}".replace('.', ',')
+
+def respuesta_csv(nombre_fichero, cabecera, filas):
+    """Respuesta CSV (separador ';', UTF-8 con BOM para Excel) generada fila a fila"""
+    import csv
+    from io import StringIO
+    from flask import Response, stream_with_context
+    
+    def generar():
+        salida = StringIO()
+        escritor = csv.writer(salida, delimiter=';')
+        salida.write('\ufeff')
+        escritor.writerow(cabecera)
+        for fila in filas:
+            escritor.writerow(fila)
+            yield salida.getvalue()
+            salida.seek(0)
+            salida.truncate()
+        yield salida.getvalue()
+    
+    return Response(stream_with_context(generar()), mimetype='text/csv',
+                    headers={'Content-Disposition': f'attachment; filename={nombre_fichero}'})
+
+@app.route('/informes/iva')
+@admision.limitar('informes')
+def informe_iva():
+    """Resumen de IVA repercutido por tipo (modelo 303), agregado en SQL"""
+    from sqlalchemy import func
+    periodo = periodo_informe()
+    
+    filas = db.session.query(
+        Factura.iva_porcentaje,
+        func.count(Factura.id),
+        func.sum(Factura.base_imponible),
+        func.sum(Factura.descuento_importe),
+        func.sum(Factura.iva_importe),
+        func.sum(Factura.total),
+    ).filter(
+        Factura.fecha >= periodo['desde'],
+        Factura.fecha < periodo['hasta']
+    ).group_by(Factura.iva_porcentaje).order_by(Factura.iva_porcentaje).all()
+    
+    tipos = [{
+        'iva_porcentaje': iva_porcentaje,
+        'num_facturas': num_facturas,
+        'base_imponible': base_imponible,
+        'descuento_importe': descuento_importe,
+        'base_liquidable': base_imponible - descuento_importe,
+        'iva_importe': iva_importe,
+        'total': total,
+    } for iva_porcentaje, num_facturas, base_imponible, descuento_importe, iva_importe, total in filas]
+    
+    totales = {campo: sum(tipo[campo] for tipo in tipos)
+               for campo in ('num_facturas', 'base_imponible', 'descuento_importe', 'base_liquidable', 'iva_importe', 'total')}
+    
+    if request.args.get('formato') == 'csv':
+        return respuesta_csv(
+            f"iva_{periodo['descripcion'].replace(' ', '_')}.csv",
+            ['Tipo IVA', 'Nº facturas', 'Base imponible', 'Descuentos', 'Base liquidable', 'Cuota IVA', 'Total'],
+            [[formato_csv(t['iva_porcentaje']), t['num_facturas'], formato_csv(t['base_imponible']),
+              formato_csv(t['descuento_importe']), formato_csv(t['base_liquidable']),
+              formato_csv(t['iva_importe']), formato_csv(t['total'])] for t in tipos]
+        )
+    
+    return render_template('informes/iva.html', periodo=periodo, tipos=tipos, totales=totales)
+
+@app.route('/informes/libro-facturas')
+@admision.limitar('informes')
+def libro_facturas_emitidas():
+    """Libro registro de facturas emitidas del periodo"""
+    periodo = periodo_informe()
+    
+    consulta = db.session.query(
+        Factura.id,
+        Factura.fecha,
+        Factura.numero_factura,
+        Cliente.nombre,
+        Cliente.dni,
+        Factura.base_imponible,
+        Factura.descuento_importe,
+        Factura.iva_porcentaje,
+        Factura.iva_importe,
+        Factura.total,
+    ).join(Cliente, Factura.cliente_id == Cliente.id).filter(
+        Factura.fecha >= periodo['desde'],
+        Factura.fecha < periodo['hasta']
+    ).order_by(Factura.fecha, Factura.numero_factura)
+    
+    if request.args.get('formato') == 'csv':
+        return respuesta_csv(
+            f"libro_facturas_emitidas_{periodo['descripcion'].replace(' ', '_')}.csv",
+            ['Fecha', 'Número', 'Cliente', 'NIF', 'Base imponible', 'Descuento', 'Tipo IVA', 'Cuota IVA', 'Total'],
+            ([f.fecha.strftime('%d/%m/%Y'), f.numero_factura, f.nombre, f.dni or '',
+              formato_csv(f.base_imponible), formato_csv(f.descuento_importe), formato_csv(f.iva_porcentaje),
+              formato_csv(f.iva_importe), formato_csv(f.total)] for f in consulta.yield_per(500))
+        )
+    
+    return render_template('informes/libro_facturas.html', periodo=periodo, facturas=consulta.all())
+
+# ========== API DE SINCRONIZACIÓN (TABLETS) ==========
+
+@app.route('/api/sync')
+@admision.limitar('sincronizacion')
+def api_sync():
+    """
+    Cambios de clientes, vehículos, intervenciones y facturas desde el token `since`.
+    Sin token devuelve la carga inicial. La respuesta va comprimida con gzip si el
+    cliente lo acepta.
+    """
+    import gzip
+    import json
+    
+    # Con menos de una fila por página el token no avanzaría nunca
+    limite = max(1, min(request.args.get('limite', app.config['SYNC_LIMITE'], type=int), 5000))
+    try:
+        datos = sincronizacion.cambios_desde(request.args.get('since'), limite, app.config['SYNC_MARGEN_SEGUNDOS'])
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    cuerpo = json.dumps(datos, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+    respuesta = app.response_class(cuerpo, mimetype='application/json')
+    respuesta.headers['Vary'] = 'Accept-Encoding'
+    if 'gzip' in request.headers.get('Accept-Encoding', ''):
+        respuesta.set_data(gzip.compress(cuerpo, 6))
+        respuesta.headers['Content-Encoding'] = 'gzip'
+    return respuesta
+
+# ========== REGISTRO DE CAMBIOS (OUTBOX) ==========
+
+@app.cli.command('compactar-cambios')
+@click.option('--dias', type=float, default=None, help='Retención en días (por defecto CAMBIOS_RETENCION_DIAS)')
+def compactar_cambios(dias):
+    """Compacta el registro de cambios y muestra el estado de los consumidores."""
+    from datetime import timedelta
+    
+    dias = app.config['CAMBIOS_RETENCION_DIAS'] if dias is None else dias
+    resultado = cambios.compactar(timedelta(days=dias))
+    click.echo(f"Entradas borradas: {resultado['confirmadas']} procesadas por todos, "
+               f"{resultado['compactadas']} sustituidas por otra posterior")
+    for consumidor in cambios.estado_consumidores():
+        click.echo(f"  {consumidor['consumidor']}: secuencia {consumidor['secuencia']}, "
+                   f"{consumidor['pendientes']} pendientes")
+
 # ========== FUNCIÓN API VERIFACTU ==========
 
 def enviar_factura_verifactu(factura):
@@ -770,6 +2141,11 @@ def enviar_factura_verifactu(factura):
     datos_factura = {
         'numero_factura': factura.numero_factura,
         'fecha': factura.fecha.isoformat(),
+        # Registro encadenado calculado al crear la factura (verifactu.py)
+        'emisor_nif': factura.emisor_nif,
+        'huella': factura.huella,
+        'huella_anterior': factura.huella_anterior,
+        'fecha_hora_registro': factura.registro_generado,
         'cliente': {
             'nombre': factura.cliente.nombre,
             'dni': factura.cliente.dni,
@@ -807,20 +2183,53 @@ def enviar_factura_verifactu(factura):
 
 # ========== GENERACIÓN DE PDF ==========
 
-def generar_pdf_factura(factura):
+# Tamaño del logo en la factura y resolución a la que se reduce en modo compacto
+LOGO_ANCHO = 8*cm
+LOGO_ALTO = 3*cm
+LOGO_PPP = 150
+
+@functools.lru_cache(maxsize=4)
+def logo_compacto(ruta, modificado):
+    """
+    Logo reducido a LOGO_PPP para el tamaño con que se dibuja, sobre fondo blanco y
+    codificado como JPEG. Se calcula una vez por proceso (y por fecha de modificación
+    del fichero); reportlab incrusta el JPEG tal cual, sin volver a codificarlo.
+    """
+    from PIL import Image as ImagenPIL
+    
+    with ImagenPIL.open(ruta) as original:
+        imagen = original.convert('RGBA')
+    ancho = min(imagen.width, round(LOGO_ANCHO / 72 * LOGO_PPP))
+    alto = min(imagen.height, round(LOGO_ALTO / 72 * LOGO_PPP))
+    imagen = imagen.resize((ancho, alto), ImagenPIL.LANCZOS)
+    fondo = ImagenPIL.new('RGB', imagen.size, 'white')
+    fondo.paste(imagen, mask=imagen.getchannel('A'))
+    salida = BytesIO()
+    fondo.save(salida, 'JPEG', quality=85, optimize=True)
+    return salida.getvalue()
+
+def generar_pdf_factura(factura, compacto=None):
     """
     Genera un PDF de la factura con el logo y formato profesional.
     
+    Solo se usan fuentes base 14 (Helvetica), que no se incrustan. En modo compacto
+    el logo va reducido y en JPEG y el contenido de las páginas comprimido.
+    
     Args:
         factura: Objeto Factura de la base de datos
+        compacto: Modo compacto; por defecto, PDF_COMPACTO de la configuración
     
     Returns:
         BytesIO: Buffer con el contenido del PDF
     """
+    if compacto is None:
+        compacto = current_app.config['PDF_COMPACTO']
+    inicio = time.perf_counter()
     buffer = BytesIO()
     doc = SimpleDocTemplate(buffer, pagesize=A4, 
                             rightMargin=2*cm, leftMargin=2*cm,
-                            topMargin=2*cm, bottomMargin=2*cm)
+                            topMargin=2*cm, bottomMargin=2*cm,
+                            pageCompression=1 if compacto else 0)
     
     # Contenedor para los elementos del PDF
     elements = []
@@ -851,7 +2260,11 @@ def generar_pdf_factura(factura):
     logo_path = os.path.join(current_app.static_folder, 'logo_saussol.png')
     if os.path.exists(logo_path):
         try:
-            logo = Image(logo_path, width=8*cm, height=3*cm)
+            if compacto:
+                logo = Image(BytesIO(logo_compacto(logo_path, os.path.getmtime(logo_path))),
+                             width=LOGO_ANCHO, height=LOGO_ALTO)
+            else:
+                logo = Image(logo_path, width=LOGO_ANCHO, height=LOGO_ALTO)
             logo.hAlign = 'LEFT'
             elements.append(logo)
             elements.append(Spacer(1, 0.5*cm))
@@ -1002,10 +2415,15 @@ def generar_pdf_factura(factura):
     # Construir PDF
     doc.build(elements)
     buffer.seek(0)
+    modo = 'compacto' if compacto else 'completo'
+    metricas.observar('taller_pdf_segundos', time.perf_counter() - inicio, modo=modo)
+    metricas.observar('taller_pdf_bytes', buffer.getbuffer().nbytes, modo=modo)
     return buffer
 
 # ========== DATOS DE PRUEBA ==========
 
+NIF_PRUEBA = 'B00000000'
+
 def insertar_datos_prueba():
     """Función para insertar datos de prueba en la base de datos"""
     from random import choice, randint, uniform
@@ -1017,6 +2435,10 @@ def insertar_datos_prueba():
             print("Ya existen datos en la base de datos. No se insertarán datos de prueba.")
             return False
         
+        # NIF ficticio para poder encadenar las facturas de prueba si el taller aún no tiene uno
+        if verifactu.nif_emisor() is None:
+            verifactu.guardar_nif(NIF_PRUEBA)
+        
         # 1. Crear 10 clientes
         clientes_data = [
             {'nombre': 'Juan Pérez García', 'dni': '12345678A', 'telefono': '600123456', 'email': 'juan.perez@email.com', 'direccion': 'Calle Mayor 1', 'codigo_postal': '28001', 'poblacion': 'Madrid', 'provincia': 'Madrid'},
@@ -1186,18 +2608,20 @@ def insertar_datos_prueba():
         
         for i, config in enumerate(facturas_config):
             intervenciones_factura = config['intervenciones']
-            total = sum(interv.precio for interv in intervenciones_factura)
+            totales = calcular_totales([interv.precio for interv in intervenciones_factura])
             numero_factura = f"FAC-{datetime.now().year}-{i + 1:04d}"
             
             factura = Factura(
                 cliente_id=config['cliente_id'],
                 numero_factura=numero_factura,
-                total=total,
-                fecha=intervenciones_factura[0].fecha  # Fecha de la primera intervención
+                fecha=intervenciones_factura[0].fecha,  # Fecha de la primera intervención
+                **totales
             )
             db.session.add(factura)
             db.session.flush()
             
+            verifactu.encadenar(factura)
+            
             # Asociar intervenciones a la factura
             for interv in intervenciones_factura:
                 interv.factura_id = factura.id
@@ -1239,6 +2663,61 @@ def ruta_insertar_datos_prueba():
     tiene_datos = Cliente.query.count() > 0
     return render_template('index.html', mostrar_confirmacion_datos=True, tiene_datos=tiene_datos)
 
+# ========== SERVIDOR DE PRODUCCIÓN ==========
+
+def cerrar_conexiones_bd():
+    """Cierra las conexiones a la base de datos del proceso (antes de crear workers con fork)"""
+    with app.app_context():
+        db.session.remove()
+        if db.taller_activo() is None:
+            db.engine.dispose()
+    if db.pool_talleres is not None:
+        db.pool_talleres.cerrar_todos()
+
+@app.cli.command('serve')
+@click.option('--bind', '-b', 'direccion', default=app.config['SERVIR_DIRECCION'], show_default=True, help='host:puerto')
+@click.option('--workers', '-w', default=app.config['SERVIR_WORKERS'], show_default=True, help='Procesos')
+@click.option('--threads', '-t', 'hilos', default=app.config['SERVIR_HILOS'], show_default=True,
+              help='Conexiones simultáneas por proceso')
+@click.option('--max-requests', 'max_peticiones', default=app.config['SERVIR_MAX_PETICIONES'], show_default=True,
+              help='Peticiones tras las que se recicla cada worker (0: nunca)')
+@click.option('--graceful-timeout', 'gracia', default=app.config['SERVIR_GRACIA'], show_default=True,
+              help='Segundos de espera a las peticiones en curso al parar o reiniciar')
+def servir(direccion, workers, hilos, max_peticiones, gracia):
+    """Servidor de producción con workers preforkados (HUP: reinicio sin cortes)."""
+    import logging
+    from servidor import Maestro
+    
+    registro = logging.getLogger('servidor')
+    registro.setLevel(logging.INFO)
+    salida = logging.StreamHandler()
+    salida.setFormatter(logging.Formatter('%(asctime)s [%(process)d] %(message)s'))
+    registro.addHandler(salida)
+    if 'ADMISION_TOTAL' not in os.environ:
+        admision.limitar_total(max(1, hilos // 2))
+    elif app.config['ADMISION_TOTAL'] >= hilos:
+        registro.warning('ADMISION_TOTAL=%d no deja hilos libres para las páginas normales (--threads %d)',
+                         app.config['ADMISION_TOTAL'], hilos)
+    if app.config['CACHE_BACKEND'] == 'memoria':
+        # Cada worker tendría su propia caché y no vería las invalidaciones de los demás
+        # (también con -w 1: TTIN puede añadir workers)
+        app.config['CACHE_BACKEND'] = 'fichero'
+        cache_fragmentos.backend = crear_backend(app.config)
+        registro.warning('CACHE_BACKEND=memoria no se comparte entre workers: se usa fichero en %s',
+                         app.config['CACHE_DIR'])
+    if not app.config['METRICAS_DIR']:
+        # Sin directorio compartido, /metrics daría los contadores del worker que responda
+        app.config['METRICAS_DIR'] = os.path.join(app.instance_path, 'metricas')
+        metricas.usar_directorio(app.config['METRICAS_DIR'])
+        registro.warning('Sin METRICAS_DIR, /metrics no sumaría los workers: se usa %s',
+                         app.config['METRICAS_DIR'])
+    # Plantillas compiladas en el maestro: los workers (y los que los sustituyen) las heredan
+    for nombre in app.jinja_env.list_templates(extensions=['html']):
+        app.jinja_env.get_template(nombre)
+    Maestro(app, direccion, workers=workers, hilos=hilos, max_peticiones=max_peticiones,
+            variacion=max_peticiones // 10, gracia=gracia, antes_de_bifurcar=cerrar_conexiones_bd,
+            al_salir_worker=metricas.volcar).ejecutar()
+
 if __name__ == '__main__':
     app.run(debug=True)
 
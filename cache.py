@@ -0,0 +1,254 @@
+"""
+Caché de fragmentos HTML para las páginas de listados.
+
+Cada fragmento se guarda con una clave formada por la página, los filtros de la
+petición y la versión actual de cada tabla de la que depende. Cuando se inserta,
+modifica o elimina un registro se cambia la versión de su tabla, de modo que las
+claves antiguas dejan de usarse sin tener que borrarlas una a una.
+
+Backends disponibles:
+    - 'memoria': LRU dentro del proceso (solo sirve con un único proceso).
+    - 'fichero': directorio compartido entre procesos del mismo servidor.
+    - 'redis':   servidor Redis (o compatible) compartido entre servidores.
+"""
+import hashlib
+import os
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from markupsafe import Markup
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+
+
+class BackendMemoria:
+    """LRU en memoria del proceso, protegido con un lock."""
+
+    def __init__(self, max_entradas=512):
+        self.max_entradas = max_entradas
+        self._datos = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, clave):
+        with self._lock:
+            valor = self._datos.get(clave)
+            if valor is not None:
+                self._datos.move_to_end(clave)
+            return valor
+
+    def set(self, clave, valor, timeout=None):
+        with self._lock:
+            self._datos[clave] = valor
+            self._datos.move_to_end(clave)
+            while len(self._datos) > self.max_entradas:
+                self._datos.popitem(last=False)
+
+
+class BackendFichero:
+    """Un fichero por clave dentro de un directorio compartido entre workers."""
+
+    def __init__(self, directorio, max_entradas=2000, caducidad=86400):
+        self.directorio = directorio
+        self.max_entradas = max_entradas
+        self.caducidad = caducidad
+        self._escrituras = 0
+        os.makedirs(directorio, exist_ok=True)
+
+    def _ruta(self, clave):
+        return os.path.join(self.directorio, hashlib.sha1(clave.encode('utf-8')).hexdigest())
+
+    def get(self, clave):
+        ruta = self._ruta(clave)
+        try:
+            # Las versiones no caducan; los fragmentos duran como máximo `caducidad` segundos
+            if not clave.endswith('.v') and os.path.getmtime(ruta) < time.time() - self.caducidad:
+                return None
+            with open(ruta, 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def set(self, clave, valor, timeout=None):
+        # Escritura atómica: fichero temporal + rename para no servir ficheros a medias
+        fd, tmp = tempfile.mkstemp(dir=self.directorio, prefix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(valor)
+        os.replace(tmp, self._ruta(clave))
+        self._escrituras += 1
+        if self._escrituras % 200 == 0:
+            self._purgar()
+
+    def _purgar(self):
+        """Elimina los ficheros más antiguos si se supera el máximo de entradas."""
+        try:
+            entradas = [e for e in os.scandir(self.directorio) if e.is_file() and not e.name.startswith('.')]
+        except OSError:
+            return
+        if len(entradas) <= self.max_entradas:
+            return
+        entradas.sort(key=lambda e: e.stat().st_mtime)
+        for entrada in entradas[:len(entradas) - self.max_entradas]:
+            try:
+                os.remove(entrada.path)
+            except OSError:
+                pass
+
+
+class BackendRedis:
+    """Servidor Redis o compatible (KeyDB, Valkey...). Requiere el paquete `redis`."""
+
+    def __init__(self, url, prefijo='taller:'):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("CACHE_BACKEND='redis' requiere instalar el paquete 'redis'")
+        self._cliente = redis.Redis.from_url(url)
+        self.prefijo = prefijo
+
+    def get(self, clave):
+        return self._cliente.get(self.prefijo + clave)
+
+    def set(self, clave, valor, timeout=None):
+        self._cliente.set(self.prefijo + clave, valor, ex=timeout)
+
+
+def crear_backend(config):
+    """Crea el backend indicado en CACHE_BACKEND ('memoria', 'fichero' o 'redis')."""
+    tipo = config.get('CACHE_BACKEND', 'memoria')
+    if tipo == 'memoria':
+        return BackendMemoria(config.get('CACHE_MAX_ENTRADAS', 512))
+    if tipo == 'fichero':
+        return BackendFichero(config['CACHE_DIR'], config.get('CACHE_MAX_ENTRADAS', 2000))
+    if tipo == 'redis':
+        return BackendRedis(config['CACHE_REDIS_URL'])
+    raise ValueError(f'Backend de caché desconocido: {tipo}')
+
+
+class CacheFragmentos:
+    """Caché de fragmentos versionada por tabla."""
+
+    def __init__(self, backend, timeout=86400, espacio=None):
+        """
+        Args:
+            backend: Backend de almacenamiento
+            timeout: Segundos que se guarda cada fragmento
+            espacio: Función que devuelve el espacio de claves actual (p. ej. el taller),
+                o None si solo hay uno
+        """
+        self.backend = backend
+        self.timeout = timeout
+        self._espacio = espacio
+
+    def espacio(self):
+        """Prefijo de las claves del espacio actual ('' si solo hay uno)"""
+        nombre = self._espacio() if self._espacio is not None else None
+        return f'{nombre}/' if nombre else ''
+
+    # ----- Versiones por tabla -----
+
+    def version(self, tabla):
+        clave = f'version:{self.espacio()}{tabla}.v'
+        version = self.backend.get(clave)
+        if version is None:
+            # Primera vez: se crea la versión para que todos los workers compartan la misma
+            version = uuid.uuid4().hex.encode('ascii')
+            self.backend.set(clave, version)
+        return version.decode('ascii') if isinstance(version, bytes) else version
+
+    def invalidar(self, *tablas):
+        """Cambia la versión de las tablas indicadas (las claves antiguas quedan huérfanas)."""
+        espacio = self.espacio()
+        for tabla in tablas:
+            self.backend.set(f'version:{espacio}{tabla}.v', uuid.uuid4().hex.encode('ascii'))
+
+    # ----- Fragmentos -----
+
+    def clave(self, pagina, tablas, filtros=None):
+        versiones = '|'.join(f'{tabla}={self.version(tabla)}' for tabla in tablas)
+        filtros = '&'.join(f'{k}={v}' for k, v in sorted((filtros or {}).items()))
+        return f'fragmento:{self.espacio()}{pagina}:{filtros}:{versiones}'
+
+    def obtener(self, pagina, tablas, filtros, renderizar):
+        """
+        Devuelve el fragmento cacheado o lo genera con `renderizar()` y lo guarda.
+
+        Args:
+            pagina: Nombre del fragmento (p. ej. 'clientes')
+            tablas: Tablas de las que depende el contenido
+            filtros: Diccionario con los parámetros que cambian el contenido
+            renderizar: Función sin argumentos que devuelve el HTML
+
+        Returns:
+            Markup: HTML listo para insertar en la plantilla
+        """
+        clave = self.clave(pagina, tablas, filtros)
+        html = self.backend.get(clave)
+        if html is None:
+            html = renderizar().encode('utf-8')
+            self.backend.set(clave, html, self.timeout)
+        return Markup(html.decode('utf-8'))
+
+    # ----- Invalidación automática -----
+
+    def registrar_eventos(self, *modelos):
+        """
+        Marca como modificada la tabla de cada modelo insertado, actualizado o
+        eliminado, y cambia su versión cuando la transacción se confirma.
+
+        La versión no se cambia en el propio flush: otro worker podría leer la
+        nueva versión antes del commit y guardar con ella datos antiguos.
+        """
+        def marcar(mapper, connection, target):
+            sesion = object_session(target)
+            if sesion is not None:
+                sesion.info.setdefault('tablas_modificadas', set()).add(mapper.local_table.name)
+
+        for modelo in modelos:
+            for evento in ('after_insert', 'after_update', 'after_delete'):
+                event.listen(modelo, evento, marcar)
+
+        @event.listens_for(Session, 'after_commit')
+        def invalidar_tras_commit(sesion):
+            tablas = sesion.info.pop('tablas_modificadas', None)
+            if tablas:
+                self.invalidar(*tablas)
+
+        @event.listens_for(Session, 'after_rollback')
+        def descartar_tras_rollback(sesion):
+            sesion.info.pop('tablas_modificadas', None)
+
+
+class CacheReferencias:
+    """
+    Caché de lectura, por proceso, de los datos de referencia de los formularios
+    (listas de clientes y vehículos de los desplegables).
+
+    Guarda tuplas ligeras en lugar de objetos del ORM y las vuelve a cargar solo
+    cuando cambia la versión de la tabla en la caché de fragmentos, que es
+    compartida entre workers con los backends 'fichero' y 'redis'.
+    """
+
+    def __init__(self, versiones):
+        self.versiones = versiones
+        self._datos = {}
+        self._lock = threading.Lock()
+
+    def obtener(self, tabla, cargar):
+        """
+        Devuelve los datos de `tabla`, cargándolos con `cargar()` si la versión cambió.
+
+        Returns:
+            tuple: Resultado de `cargar()` convertido a tupla (inmutable, se comparte entre hilos)
+        """
+        version = self.versiones.version(tabla)
+        clave = (self.versiones.espacio(), tabla)
+        entrada = self._datos.get(clave)
+        if entrada is not None and entrada[0] == version:
+            return entrada[1]
+        datos = tuple(cargar())
+        with self._lock:
+            self._datos[clave] = (version, datos)
+        return datos
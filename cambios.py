@@ -0,0 +1,224 @@
+"""
+Registro de cambios (outbox) para consumidores externos.
+
+Cada alta, modificación o baja de los modelos registrados añade una fila a la
+tabla `cambios` en la misma transacción que el propio cambio: si la transacción
+se deshace, la entrada desaparece con ella. La secuencia es la clave primaria
+AUTOINCREMENT; como SQLite serializa las transacciones de escritura, el orden de
+la secuencia es el orden de confirmación y no aparecen huecos que se rellenen
+más tarde.
+
+Cada entrada lleva la fila completa, así que un consumidor solo necesita la
+última entrada de cada registro. Los consumidores (índices de búsqueda, tablas
+resumen, exportación contable...) leen desde su punto de control y lo avanzan
+al terminar cada lote; la entrega es "al menos una vez".
+
+`compactar()` mantiene la tabla acotada:
+    - borra las entradas que ya han procesado todos los consumidores;
+    - de las más antiguas que la retención conserva solo la última por registro.
+"""
+import json
+from collections import namedtuple
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+
+from sqlalchemy import case, delete, event, func, inspect, select, update
+
+from models import db, Cambio, PuntoControl
+
+EntradaCambio = namedtuple('EntradaCambio', 'secuencia tabla registro_id operacion datos creado_en')
+
+
+def _json(valor):
+    if isinstance(valor, (datetime, date)):
+        return valor.isoformat()
+    if isinstance(valor, Decimal):
+        return str(valor)
+    raise TypeError(f'Tipo no serializable: {type(valor).__name__}')
+
+
+def anotar_cambio(connection, tabla, registro_id, operacion, datos):
+    """
+    Añade una entrada al registro de cambios usando la conexión de la transacción
+    en curso. Las actualizaciones masivas que no pasan por el ORM deben llamarla
+    ellas mismas.
+    """
+    connection.execute(Cambio.__table__.insert().values(
+        tabla=tabla,
+        registro_id=registro_id,
+        operacion=operacion,
+        datos=json.dumps(datos, default=_json, ensure_ascii=False, separators=(',', ':')),
+        creado_en=datetime.utcnow()
+    ))
+
+
+def anotar_cambios(connection, tabla, operacion, filas):
+    """Como `anotar_cambio`, para muchas filas de una tabla con un solo executemany"""
+    if not filas:
+        return
+    creado_en = datetime.utcnow()
+    connection.execute(Cambio.__table__.insert(), [
+        {'tabla': tabla, 'registro_id': fila['id'], 'operacion': operacion, 'creado_en': creado_en,
+         'datos': json.dumps(dict(fila), default=_json, ensure_ascii=False, separators=(',', ':'))}
+        for fila in filas
+    ])
+
+
+def _fila(mapper, connection, target):
+    """Valores de todas las columnas del objeto; lee de la base de datos las que no estén cargadas"""
+    estado = inspect(target)
+    claves = [atributo.key for atributo in mapper.column_attrs]
+    if any(clave not in estado.dict for clave in claves):
+        tabla = mapper.local_table
+        fila = connection.execute(select(tabla).where(tabla.c.id == target.id)).mappings().first()
+        if fila is not None:
+            return {atributo.key: fila[atributo.columns[0].name] for atributo in mapper.column_attrs}
+    return {clave: estado.dict.get(clave) for clave in claves}
+
+
+def registrar_cambios(*modelos):
+    """Anota en `cambios` las altas, modificaciones y bajas de los modelos hechas con el ORM"""
+    def alta(mapper, connection, target):
+        anotar_cambio(connection, mapper.local_table.name, target.id, 'insert', _fila(mapper, connection, target))
+
+    def modificacion(mapper, connection, target):
+        estado = inspect(target)
+        # after_update también se dispara para objetos marcados sin cambios en columnas
+        if not any(estado.attrs[atributo.key].history.has_changes() for atributo in mapper.column_attrs):
+            return
+        anotar_cambio(connection, mapper.local_table.name, target.id, 'update', _fila(mapper, connection, target))
+
+    def baja(mapper, connection, target):
+        estado = inspect(target)
+        datos = {atributo.key: estado.dict[atributo.key] for atributo in mapper.column_attrs
+                 if atributo.key in estado.dict}
+        anotar_cambio(connection, mapper.local_table.name, target.id, 'delete', datos)
+
+    for modelo in modelos:
+        event.listen(modelo, 'after_insert', alta)
+        event.listen(modelo, 'after_update', modificacion)
+        event.listen(modelo, 'after_delete', baja)
+
+
+# ========== API DE CONSUMIDORES ==========
+
+def ultima_secuencia():
+    # Los puntos de control cubren el caso de una tabla vaciada por completo al compactar
+    return db.session.execute(select(func.max(
+        select(func.coalesce(func.max(Cambio.secuencia), 0)).scalar_subquery(),
+        select(func.coalesce(func.max(PuntoControl.secuencia), 0)).scalar_subquery(),
+    ))).scalar()
+
+
+def punto_control(consumidor):
+    """Última secuencia confirmada por el consumidor, o None si no está registrado"""
+    return db.session.execute(
+        select(PuntoControl.secuencia).where(PuntoControl.consumidor == consumidor)
+    ).scalar()
+
+
+def registrar_consumidor(consumidor, desde_el_principio=False):
+    """
+    Da de alta un consumidor. Por defecto empieza al final del registro (solo verá
+    cambios futuros); con `desde_el_principio` recibe todo lo que aún conserve la tabla.
+    Si ya existe no se modifica. Devuelve su punto de control.
+    """
+    actual = punto_control(consumidor)
+    if actual is not None:
+        return actual
+    inicio = 0 if desde_el_principio else ultima_secuencia()
+    db.session.add(PuntoControl(consumidor=consumidor, secuencia=inicio))
+    db.session.commit()
+    return inicio
+
+
+def eliminar_consumidor(consumidor):
+    """Da de baja un consumidor para que no impida compactar el registro"""
+    db.session.execute(delete(PuntoControl).where(PuntoControl.consumidor == consumidor))
+    db.session.commit()
+
+
+def leer(consumidor, limite=500):
+    """Entradas posteriores al punto de control del consumidor, en orden de secuencia"""
+    desde = punto_control(consumidor)
+    if desde is None:
+        raise ValueError(f'Consumidor no registrado: {consumidor}')
+    filas = db.session.execute(
+        select(Cambio.secuencia, Cambio.tabla, Cambio.registro_id, Cambio.operacion, Cambio.datos, Cambio.creado_en)
+        .where(Cambio.secuencia > desde)
+        .order_by(Cambio.secuencia)
+        .limit(limite)
+    )
+    return [EntradaCambio(secuencia, tabla, registro_id, operacion, json.loads(datos), creado_en)
+            for secuencia, tabla, registro_id, operacion, datos, creado_en in filas]
+
+
+def confirmar(consumidor, secuencia):
+    """Avanza el punto de control del consumidor (nunca lo retrocede)"""
+    db.session.execute(
+        update(PuntoControl)
+        .where(PuntoControl.consumidor == consumidor)
+        .values(
+            secuencia=case((PuntoControl.secuencia < secuencia, secuencia), else_=PuntoControl.secuencia),
+            actualizado_en=datetime.utcnow()
+        )
+    )
+    db.session.commit()
+
+
+def consumir(consumidor, procesar, lote=500):
+    """
+    Entrega las entradas pendientes a `procesar(entradas)` en lotes y confirma el
+    punto de control después de cada lote. Si `procesar` falla, el lote se volverá
+    a entregar en la siguiente llamada.
+
+    Returns:
+        int: Número de entradas procesadas
+    """
+    total = 0
+    while True:
+        entradas = leer(consumidor, lote)
+        if not entradas:
+            return total
+        procesar(entradas)
+        confirmar(consumidor, entradas[-1].secuencia)
+        total += len(entradas)
+        if len(entradas) < lote:
+            return total
+
+
+def compactar(retencion=timedelta(days=7)):
+    """
+    Reduce la tabla de cambios. Sin consumidores registrados borra todo lo anterior
+    a la retención.
+
+    Returns:
+        dict: confirmadas (borradas por estar procesadas) y compactadas (sustituidas
+        por una entrada posterior del mismo registro)
+    """
+    limite = datetime.utcnow() - retencion
+    minimo = db.session.execute(select(func.min(PuntoControl.secuencia))).scalar()
+    if minimo is None:
+        confirmadas = db.session.execute(delete(Cambio).where(Cambio.creado_en < limite)).rowcount
+        db.session.commit()
+        return {'confirmadas': confirmadas, 'compactadas': 0}
+
+    confirmadas = db.session.execute(delete(Cambio).where(Cambio.secuencia <= minimo)).rowcount
+    ultimas = select(func.max(Cambio.secuencia)).group_by(Cambio.tabla, Cambio.registro_id)
+    compactadas = db.session.execute(
+        delete(Cambio).where(Cambio.creado_en < limite, Cambio.secuencia.not_in(ultimas))
+    ).rowcount
+    db.session.commit()
+    return {'confirmadas': confirmadas, 'compactadas': compactadas}
+
+
+def estado_consumidores():
+    """Punto de control y entradas pendientes de cada consumidor"""
+    ultima = ultima_secuencia()
+    filas = db.session.execute(
+        select(PuntoControl.consumidor, PuntoControl.secuencia, PuntoControl.actualizado_en)
+        .order_by(PuntoControl.consumidor)
+    )
+    return [{'consumidor': consumidor, 'secuencia': secuencia, 'pendientes': ultima - secuencia,
+             'actualizado_en': actualizado_en}
+            for consumidor, secuencia, actualizado_en in filas]
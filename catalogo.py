@@ -0,0 +1,146 @@
+"""
+Catálogo de trabajos y piezas habituales con precio y horas por defecto, para
+sugerir las líneas de intervención mientras se escribe la descripción.
+
+Las sugerencias salen de un índice en memoria por proceso (`IndiceCatalogo`), sin
+consultar la base de datos al escribir:
+    - prefijos de palabra: cada palabra escrita debe ser el principio de alguna
+      palabra del artículo ("camb ace" encuentra "Cambio de aceite y filtro"); se
+      resuelve con búsqueda binaria sobre la lista ordenada de palabras;
+    - trigramas: si ningún artículo cumple lo anterior (faltas de ortografía, como
+      "amortiguadroes"), se ordenan por trigramas en común.
+El índice se reconstruye cuando cambia la tabla `catalogo` (ver `indice_catalogo`
+en app.py, que usa la versión de la tabla en la caché compartida entre workers).
+
+`sembrar()` crea el catálogo inicial con las descripciones más repetidas del
+histórico de intervenciones, con el precio y las horas de la más reciente.
+"""
+import re
+from bisect import bisect_left
+from collections import Counter, defaultdict, namedtuple
+
+from sqlalchemy import func, select
+
+from mantenimiento import normalizar
+from models import db, ArticuloCatalogo, Intervencion
+
+Articulo = namedtuple('Articulo', 'id tipo descripcion precio horas usos')
+
+TIPOS = {'mano_obra': 'Mano de obra', 'pieza': 'Pieza'}
+# Parecido mínimo (trigramas comunes / trigramas de ambos) para sugerir sin coincidencia de prefijos
+PARECIDO_MINIMO = 0.3
+
+
+def palabras(texto):
+    return re.findall(r'[a-z0-9]+', normalizar(texto))
+
+
+def trigramas(texto):
+    """Trigramas de cada palabra con relleno, como pg_trgm: 'eje' -> '  e', ' ej', 'eje', 'je '"""
+    resultado = set()
+    for palabra in palabras(texto):
+        palabra = f'  {palabra} '
+        resultado.update(palabra[i:i + 3] for i in range(len(palabra) - 2))
+    return resultado
+
+
+class IndiceCatalogo:
+    """Índice inmutable de los artículos activos; se comparte entre hilos sin bloqueos."""
+
+    def __init__(self, articulos):
+        self.articulos = {articulo.id: articulo for articulo in articulos}
+        self._texto = {articulo.id: ' '.join(palabras(articulo.descripcion)) for articulo in articulos}
+        entradas = sorted({(palabra, id) for id, texto in self._texto.items() for palabra in texto.split()})
+        self._palabras = [palabra for palabra, _ in entradas]
+        self._ids = [id for _, id in entradas]
+        self._trigramas = defaultdict(set)
+        self._num_trigramas = {}
+        for articulo in articulos:
+            propios = trigramas(articulo.descripcion)
+            self._num_trigramas[articulo.id] = len(propios)
+            for trigrama in propios:
+                self._trigramas[trigrama].add(articulo.id)
+
+    def __len__(self):
+        return len(self.articulos)
+
+    def _con_prefijo(self, prefijo):
+        """Ids de los artículos con alguna palabra que empieza por `prefijo`"""
+        ids = set()
+        i = bisect_left(self._palabras, prefijo)
+        while i < len(self._palabras) and self._palabras[i].startswith(prefijo):
+            ids.add(self._ids[i])
+            i += 1
+        return ids
+
+    def buscar(self, texto, limite=10):
+        """Artículos que mejor encajan con lo escrito, los más usados primero"""
+        escritas = palabras(texto)
+        if not escritas:
+            return []
+
+        ids = None
+        for palabra in escritas:
+            ids = self._con_prefijo(palabra) if ids is None else ids & self._con_prefijo(palabra)
+            if not ids:
+                break
+        if ids:
+            consulta = ' '.join(escritas)
+            orden = sorted(ids, key=lambda id: (not self._texto[id].startswith(consulta),
+                                                -self.articulos[id].usos, self._texto[id]))
+            return [self.articulos[id] for id in orden[:limite]]
+
+        propios = trigramas(texto)
+        comunes = Counter(id for trigrama in propios for id in self._trigramas.get(trigrama, ()))
+        parecidos = []
+        for id, n in comunes.items():
+            parecido = n / (len(propios) + self._num_trigramas[id] - n)
+            if parecido >= PARECIDO_MINIMO:
+                parecidos.append((-parecido, -self.articulos[id].usos, id))
+        return [self.articulos[id] for _, _, id in sorted(parecidos)[:limite]]
+
+
+def articulos_activos():
+    filas = db.session.execute(
+        select(ArticuloCatalogo.id, ArticuloCatalogo.tipo, ArticuloCatalogo.descripcion, ArticuloCatalogo.precio,
+               ArticuloCatalogo.horas, ArticuloCatalogo.usos)
+        .where(ArticuloCatalogo.activo.is_(True))
+    )
+    return [Articulo(*fila) for fila in filas]
+
+
+def sembrar(limite=200, minimo=2):
+    """
+    Añade al catálogo las descripciones de intervención más repetidas que aún no
+    estén en él (sin distinguir mayúsculas, tildes ni espacios). Las que tienen
+    horas de trabajo se dan de alta como mano de obra y el resto como piezas.
+    No confirma la transacción.
+
+    Returns:
+        int: Artículos añadidos
+    """
+    clave = func.lower(func.trim(Intervencion.descripcion))
+    frecuentes = (
+        select(func.max(Intervencion.id).label('id'), func.count().label('usos'))
+        .group_by(clave).having(func.count() >= minimo)
+        .order_by(func.count().desc()).limit(limite)
+        .subquery()
+    )
+    filas = db.session.execute(
+        select(Intervencion.descripcion, Intervencion.precio, Intervencion.horas_trabajo, frecuentes.c.usos)
+        .join(frecuentes, Intervencion.id == frecuentes.c.id)
+        .order_by(frecuentes.c.usos.desc())
+    ).all()
+
+    existentes = {' '.join(palabras(descripcion)) for descripcion in
+                  db.session.execute(select(ArticuloCatalogo.descripcion)).scalars()}
+    añadidos = 0
+    for descripcion, precio, horas, usos in filas:
+        clave_texto = ' '.join(palabras(descripcion))
+        if not clave_texto or clave_texto in existentes:
+            continue
+        existentes.add(clave_texto)
+        db.session.add(ArticuloCatalogo(tipo='mano_obra' if horas else 'pieza', descripcion=descripcion.strip()[:200],
+                                        precio=precio, horas=horas or 0.0, usos=usos))
+        añadidos += 1
+    return añadidos
@@ -0,0 +1,200 @@
+"""
+Mide los adjuntos de fotos y documentos:
+    - la memoria máxima al subir un fichero grande, leyéndolo entero en la vista
+      (como se haría con `fichero.read()`) frente a la subida en flujo al almacén;
+    - lo que tarda la subida de varias fotos de móvil generando las miniaturas
+      dentro de la petición frente a encolarlas en el pool, y cuánto tardan luego
+      en estar todas;
+    - el espacio en disco al adjuntar varias veces las mismas fotos;
+    - los bytes que descarga la ficha de un vehículo con muchas fotos (miniaturas
+      frente a originales) y que una segunda visita solo revalida (304) y que los
+      originales admiten peticiones por rangos.
+
+Termina con error si la subida en flujo no usa mucha menos memoria que la otra,
+si se guarda más de una copia de un mismo contenido o si las cabeceras de caché y
+rangos no son las esperadas. Se ejecuta sobre una base de datos y un directorio
+temporales:
+    python comparar_adjuntos.py [MB del fichero grande] [fotos]
+"""
+import hashlib
+import io
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+directorio = tempfile.mkdtemp()
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(directorio, 'comparacion.db')
+os.environ['ADJUNTOS_DIR'] = os.path.join(directorio, 'adjuntos')
+os.environ['ADJUNTOS_MAX_MB'] = '1000'
+
+from PIL import Image
+from flask import request
+
+import adjuntos
+from app import app, almacen_adjuntos
+from models import db, Archivo, Cliente, Coche
+
+LIMITE = 'ComparacionLimite'
+
+
+@app.route('/comparacion/<int:id>/en_memoria', methods=['POST'])
+def subir_en_memoria(id):
+    """Subida leyendo cada fichero entero y generando su miniatura en la petición"""
+    for fichero in request.files.getlist('archivos'):
+        datos = fichero.read()
+        hash = hashlib.sha256(datos).hexdigest()
+        destino = almacen_adjuntos.ruta(hash)
+        os.makedirs(os.path.dirname(destino), exist_ok=True)
+        with open(destino, 'wb') as salida:
+            salida.write(datos)
+        if request.args.get('miniaturas'):
+            almacen_adjuntos._generar(destino, almacen_adjuntos.ruta_miniatura(hash))
+    return '', 204
+
+
+def cuerpo_multipart(ficheros):
+    """Escribe en un temporal el cuerpo multipart con `ficheros` [(nombre, bytes o tamaño)]"""
+    cuerpo = tempfile.TemporaryFile(dir=directorio)
+    for nombre, contenido in ficheros:
+        cuerpo.write(f'--{LIMITE}\r\nContent-Disposition: form-data; name="archivos"; filename="{nombre}"\r\n'
+                     f'Content-Type: application/octet-stream\r\n\r\n'.encode())
+        if isinstance(contenido, int):
+            cuerpo.write(b'%PDF-1.4\n')
+            bloque = random.Random(contenido).randbytes(1024 * 1024)
+            for _ in range(contenido // len(bloque)):
+                cuerpo.write(bloque)
+        else:
+            cuerpo.write(contenido)
+        cuerpo.write(b'\r\n')
+    cuerpo.write(f'--{LIMITE}--\r\n'.encode())
+    longitud = cuerpo.tell()
+    cuerpo.seek(0)
+    return cuerpo, longitud
+
+
+def enviar(cliente_web, ruta, ficheros, medir_memoria=False):
+    """Devuelve (segundos, pico de memoria en bytes) de la petición"""
+    cuerpo, longitud = cuerpo_multipart(ficheros)
+    with cuerpo:
+        if medir_memoria:
+            tracemalloc.start()
+        inicio = time.perf_counter()
+        respuesta = cliente_web.post(ruta, input_stream=cuerpo, content_length=longitud,
+                                     content_type=f'multipart/form-data; boundary={LIMITE}')
+        segundos = time.perf_counter() - inicio
+        pico = 0
+        if medir_memoria:
+            pico = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+    assert respuesta.status_code in (204, 302), respuesta.status_code
+    return segundos, pico
+
+
+def foto_movil(n):
+    """JPEG de 12 Mpx distinto para cada n"""
+    imagen = Image.merge('RGB', [Image.linear_gradient('L').rotate(n * 7 + i * 40).resize((4000, 3000))
+                                 for i in range(3)])
+    datos = io.BytesIO()
+    imagen.save(datos, 'JPEG', quality=90)
+    return datos.getvalue()
+
+
+def esperar_miniaturas(hashes, plazo=120):
+    inicio = time.perf_counter()
+    for hash in hashes:
+        almacen_adjuntos.miniatura(hash, plazo=plazo)
+    return time.perf_counter() - inicio
+
+
+if __name__ == '__main__':
+    megas = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    total_fotos = int(sys.argv[2]) if len(sys.argv) > 2 else 12
+    problemas = []
+    cliente_web = app.test_client()
+    try:
+        with app.app_context():
+            cliente = Cliente(nombre='Cliente adjuntos')
+            db.session.add(cliente)
+            db.session.flush()
+            coche = Coche(matricula='0000ADJ', marca='Seat', modelo='León', cliente_id=cliente.id)
+            db.session.add(coche)
+            db.session.commit()
+            coche_id = coche.id
+            db.session.remove()
+
+        print(f"Subida de un PDF de {megas} MB")
+        print(f"{'Subida':26} {'segundos':>9} {'memoria MB':>11}")
+        enviar(cliente_web, f'/comparacion/{coche_id}/en_memoria', [('grande.pdf', megas * 1024 * 1024)])  # calentamiento
+        segundos, pico_memoria = enviar(cliente_web, f'/comparacion/{coche_id}/en_memoria',
+                                        [('grande.pdf', megas * 1024 * 1024)], medir_memoria=True)
+        print(f"{'leyendo el fichero entero':26} {segundos:9.2f} {pico_memoria / 1048576:11.1f}")
+        segundos, pico_flujo = enviar(cliente_web, f'/coches/{coche_id}/adjuntos',
+                                      [('grande.pdf', megas * 1024 * 1024)], medir_memoria=True)
+        print(f"{'en flujo al almacén':26} {segundos:9.2f} {pico_flujo / 1048576:11.1f}")
+        if pico_flujo * 4 > pico_memoria:
+            problemas.append(f'la subida en flujo usa {pico_flujo} bytes frente a {pico_memoria}')
+
+        fotos = [(f'foto{n}.jpg', foto_movil(n)) for n in range(total_fotos)]
+        hashes = [hashlib.sha256(datos).hexdigest() for _, datos in fotos]
+        print(f"\nSubida de {total_fotos} fotos de 12 Mpx "
+              f"({sum(len(datos) for _, datos in fotos) / 1048576:.1f} MB) con miniaturas")
+        print(f"{'Miniaturas':26} {'petición s':>11} {'todas listas s':>15}")
+        segundos, _ = enviar(cliente_web, f'/comparacion/{coche_id}/en_memoria?miniaturas=1', fotos)
+        print(f"{'dentro de la petición':26} {segundos:11.2f} {segundos:15.2f}")
+        shutil.rmtree(os.path.join(os.environ['ADJUNTOS_DIR'], 'miniaturas'))
+        for hash in hashes:
+            os.unlink(almacen_adjuntos.ruta(hash))
+        segundos, _ = enviar(cliente_web, f'/coches/{coche_id}/adjuntos', fotos)
+        listas = esperar_miniaturas(hashes)
+        print(f"{'en el pool (' + str(almacen_adjuntos.hilos) + ' hilos)':26} {segundos:11.2f} {segundos + listas:15.2f}")
+
+        for _ in range(4):
+            enviar(cliente_web, f'/coches/{coche_id}/adjuntos', fotos)
+        with app.app_context():
+            adjuntado, en_disco = adjuntos.espacio()
+            copias = {hash: os.path.exists(almacen_adjuntos.ruta(hash)) for hash in hashes}
+            archivos = db.session.query(Archivo).count()
+            filas = adjuntos.de_coche(coche_id)
+            db.session.remove()
+        ficheros_disco = sum(1 for raiz, _, ficheros in os.walk(os.environ['ADJUNTOS_DIR'])
+                             if 'miniaturas' not in raiz and 'subidas' not in raiz
+                             for fichero in ficheros if not fichero.startswith('.'))
+        print(f"\nLas mismas fotos adjuntadas 5 veces: {adjuntado / 1048576:.1f} MB adjuntados, "
+              f"{en_disco / 1048576:.1f} MB en disco, {archivos} archivos, {ficheros_disco} ficheros")
+        if archivos != total_fotos + 1 or ficheros_disco != archivos or not all(copias.values()):
+            problemas.append(f'{ficheros_disco} ficheros en disco para {total_fotos + 1} contenidos distintos')
+
+        ficha = cliente_web.get(f'/coches/{coche_id}/ficha')
+        fotos_ficha = [fila for fila in filas if fila.tipo in adjuntos.CON_MINIATURA]
+        etags, bytes_miniaturas = {}, 0
+        for fila in fotos_ficha:
+            respuesta = cliente_web.get(f'/adjuntos/{fila.id}/{fila.hash}/miniatura')
+            etags[f'{fila.id}/{fila.hash}'] = respuesta.headers['ETag']
+            bytes_miniaturas += len(respuesta.data)
+        bytes_originales = sum(fila.tamaño for fila in fotos_ficha)
+        revalidadas = sum(
+            cliente_web.get(f'/adjuntos/{ruta}/miniatura', headers={'If-None-Match': etag}).status_code == 304
+            for ruta, etag in etags.items())
+        print(f"\nFicha con {len(fotos_ficha)} fotos: {len(ficha.data) / 1024:.0f} KB de HTML, "
+              f"{bytes_miniaturas / 1048576:.1f} MB de miniaturas frente a {bytes_originales / 1048576:.1f} MB "
+              f"de originales; segunda visita: {revalidadas} de {len(etags)} respondidas con 304")
+        if revalidadas != len(etags):
+            problemas.append('las miniaturas no se revalidan con 304')
+
+        pdf = next(fila for fila in filas if fila.tipo == 'application/pdf')
+        respuesta = cliente_web.get(f'/adjuntos/{pdf.id}/{pdf.hash}', headers={'Range': 'bytes=1048576-2097151'})
+        print(f"Rango de 1 MB del PDF: {respuesta.status_code}, {len(respuesta.data)} bytes, "
+              f"Cache-Control: {respuesta.headers['Cache-Control']}")
+        if respuesta.status_code != 206 or len(respuesta.data) != 1048576:
+            problemas.append(f'petición por rangos respondida con {respuesta.status_code}')
+        if 'immutable' not in respuesta.headers['Cache-Control']:
+            problemas.append('los originales no se sirven como inmutables')
+    finally:
+        almacen_adjuntos.cerrar()
+        shutil.rmtree(directorio, ignore_errors=True)
+    if problemas:
+        sys.exit('; '.join(problemas))
@@ -0,0 +1,260 @@
+"""
+Compara el envío de las facturas de un mes por correo abriendo una conexión SMTP
+por mensaje (como se haría dentro de la petición) con el worker de correo
+(`flask --app app enviar-correos --una-vez`), que reutiliza las conexiones.
+
+Las dos pruebas van contra un servidor SMTP local de prueba (`ServidorSMTPPrueba`)
+que imita a un proveedor real: tarda en aceptar cada conexión (TLS y login), corta
+la sesión con 421 tras unos cuantos mensajes, rechaza con 550 un buzón inexistente
+y responde 451 la primera vez a otro. Termina con error si alguna factura con email
+válido no se entrega exactamente una vez o si los envíos no acaban en el estado
+esperado.
+
+Se ejecuta sobre una base de datos temporal con datos sintéticos:
+    python comparar_correo.py [facturas]
+
+El servidor de prueba también puede lanzarse solo, para probar a mano el worker:
+    python comparar_correo.py --servidor 8025
+    SMTP_SERVIDOR=127.0.0.1 SMTP_PUERTO=8025 flask --app app enviar-correos
+"""
+import os
+import shutil
+import smtplib
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from email import message_from_bytes
+from email.message import EmailMessage
+
+
+class ServidorSMTPPrueba(socketserver.ThreadingTCPServer):
+    """Servidor SMTP mínimo que guarda en memoria los mensajes recibidos."""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, puerto=0, latencia_conexion=0.1, latencia_mensaje=0.01, mensajes_por_conexion=20,
+                 rechazados=(), temporales=(), mostrar=False):
+        super().__init__(('127.0.0.1', puerto), _SesionSMTP)
+        self.latencia_conexion = latencia_conexion
+        self.latencia_mensaje = latencia_mensaje
+        self.mensajes_por_conexion = mensajes_por_conexion
+        self.rechazados = set(rechazados)
+        self.temporales = set(temporales)
+        self.mostrar = mostrar
+        self.conexiones = 0
+        self.mensajes = []  # (destinatarios, asunto)
+        self.lock = threading.Lock()
+
+    @property
+    def puerto(self):
+        return self.server_address[1]
+
+    def reiniciar(self):
+        with self.lock:
+            self.conexiones = 0
+            self.mensajes = []
+
+    def arrancar(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+class _SesionSMTP(socketserver.StreamRequestHandler):
+    def responder(self, linea):
+        self.wfile.write(linea.encode() + b'\r\n')
+
+    def handle(self):
+        servidor = self.server
+        with servidor.lock:
+            servidor.conexiones += 1
+        time.sleep(servidor.latencia_conexion)
+        self.responder('220 prueba ESMTP')
+        mensajes, destinatarios = 0, []
+        while True:
+            linea = self.rfile.readline()
+            if not linea:
+                return
+            orden = linea.decode('ascii', 'replace').strip()
+            verbo = orden[:4].upper()
+            if verbo == 'EHLO':
+                self.responder('250-prueba')
+                self.responder('250 8BITMIME')
+            elif verbo == 'HELO':
+                self.responder('250 prueba')
+            elif verbo == 'MAIL':
+                if servidor.mensajes_por_conexion and mensajes >= servidor.mensajes_por_conexion:
+                    self.responder('421 Demasiados mensajes en esta conexion')
+                    return
+                destinatarios = []
+                self.responder('250 OK')
+            elif verbo == 'RCPT':
+                direccion = orden.split(':', 1)[1].strip().strip('<>')
+                with servidor.lock:
+                    temporal = direccion in servidor.temporales
+                    servidor.temporales.discard(direccion)
+                if direccion in servidor.rechazados:
+                    self.responder('550 Buzon inexistente')
+                elif temporal:
+                    self.responder('451 Intentelo mas tarde')
+                else:
+                    destinatarios.append(direccion)
+                    self.responder('250 OK')
+            elif verbo == 'DATA':
+                self.responder('354 Fin con <CRLF>.<CRLF>')
+                datos = []
+                while (linea := self.rfile.readline()) not in (b'.\r\n', b''):
+                    datos.append(linea[1:] if linea.startswith(b'..') else linea)
+                time.sleep(servidor.latencia_mensaje)
+                asunto = message_from_bytes(b''.join(datos))['Subject']
+                with servidor.lock:
+                    servidor.mensajes.append((tuple(destinatarios), asunto))
+                if servidor.mostrar:
+                    print(f"{', '.join(destinatarios)}: {asunto}", flush=True)
+                mensajes += 1
+                self.responder('250 OK')
+            elif verbo in ('RSET', 'NOOP'):
+                self.responder('250 OK')
+            elif verbo == 'QUIT':
+                self.responder('221 Adios')
+                return
+            else:
+                self.responder('500 Orden desconocida')
+
+
+def crear_mes(facturas):
+    """Facturas de enero de 2024 con un cliente cada una; devuelve las direcciones que deben recibir correo"""
+    from datetime import datetime
+    from models import db, Cliente, Coche, Intervencion, Factura
+
+    emails = []
+    for n in range(facturas):
+        if n == 0:
+            email = None
+        elif n == 1:
+            email = 'rechazado@example.com'
+        elif n == 2:
+            email = 'temporal@example.com'
+        else:
+            email = f'cliente{n}@example.com'
+        cliente = Cliente(nombre=f'Cliente {n}', email=email)
+        db.session.add(cliente)
+        db.session.flush()
+        coche = Coche(matricula=f'C{n:06d}', marca='Seat', modelo='Ibiza', cliente_id=cliente.id)
+        factura = Factura(cliente_id=cliente.id, numero_factura=f'2024/{n:05d}', fecha=datetime(2024, 1, 1 + n % 28),
+                          base_imponible=100, iva_importe=21, total=121)
+        db.session.add_all([coche, factura])
+        db.session.flush()
+        db.session.add(Intervencion(coche_id=coche.id, cliente_id=cliente.id, fecha=factura.fecha, km=1000,
+                                    descripcion='Cambio de aceite', precio=100, horas_trabajo=1.0,
+                                    factura_id=factura.id))
+        if email and email != 'rechazado@example.com':
+            emails.append(email)
+    db.session.commit()
+    return emails
+
+
+def una_conexion_por_mensaje(servidor):
+    """Genera el PDF y abre una conexión SMTP para cada factura, una detrás de otra"""
+    from sqlalchemy import select
+    from sqlalchemy.orm import joinedload, selectinload
+    from app import app, generar_pdf_factura
+    from models import db, Factura, Intervencion
+
+    errores = 0
+    with app.test_request_context('/'):
+        facturas = db.session.execute(
+            select(Factura).options(joinedload(Factura.cliente),
+                                    selectinload(Factura.intervenciones).joinedload(Intervencion.coche))
+        ).scalars().all()
+        for factura in facturas:
+            if not factura.cliente.email:
+                continue
+            mensaje = EmailMessage()
+            mensaje['Subject'] = f'Factura {factura.numero_factura}'
+            mensaje['From'] = 'facturas@localhost'
+            mensaje['To'] = factura.cliente.email
+            mensaje.set_content('Le adjuntamos la factura.')
+            mensaje.add_attachment(generar_pdf_factura(factura).getvalue(), maintype='application',
+                                   subtype='pdf', filename='factura.pdf')
+            try:
+                with smtplib.SMTP('127.0.0.1', servidor.puerto) as smtp:
+                    smtp.send_message(mensaje)
+            except smtplib.SMTPException:
+                errores += 1
+        db.session.remove()
+    return errores
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--servidor']:
+        servidor = ServidorSMTPPrueba(int(sys.argv[2]) if len(sys.argv) > 2 else 8025, latencia_conexion=0,
+                                      latencia_mensaje=0, mensajes_por_conexion=0, mostrar=True)
+        print(f'Servidor SMTP de prueba en 127.0.0.1:{servidor.puerto} (Ctrl+C para terminar)')
+        try:
+            servidor.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        sys.exit()
+
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    servidor = ServidorSMTPPrueba(rechazados={'rechazado@example.com'}).arrancar()
+
+    directorio = tempfile.mkdtemp()
+    os.environ.update({
+        'DATABASE_URL': 'sqlite:///' + os.path.join(directorio, 'comparacion.db'),
+        'SMTP_SERVIDOR': '127.0.0.1',
+        'SMTP_PUERTO': str(servidor.puerto),
+        'SMTP_CONEXIONES': '2',
+        'SMTP_MENSAJES_POR_MINUTO': '0',
+        'CORREO_REINTENTO': '0',
+    })
+    from app import app
+    from models import db, EnvioFactura
+
+    try:
+        with app.app_context():
+            esperados = crear_mes(total)
+            db.session.remove()
+
+        print(f"{total} facturas; servidor de prueba: {servidor.latencia_conexion * 1000:.0f} ms por conexión, "
+              f"{servidor.latencia_mensaje * 1000:.0f} ms por mensaje, 421 tras {servidor.mensajes_por_conexion} "
+              f"mensajes\n")
+        print(f"{'Envío':34} {'segundos':>9} {'conexiones':>11} {'mensajes':>9}")
+
+        servidor.temporales = {'temporal@example.com'}
+        inicio = time.perf_counter()
+        una_conexion_por_mensaje(servidor)
+        print(f"{'una conexión por mensaje':34} {time.perf_counter() - inicio:9.2f} {servidor.conexiones:11d} "
+              f"{len(servidor.mensajes):9d}")
+
+        servidor.reiniciar()
+        servidor.temporales = {'temporal@example.com'}
+        cliente_web = app.test_client()
+        respuesta = cliente_web.post('/facturas/correo', data={'mes': '2024-01'})
+        assert respuesta.status_code == 302, respuesta.status_code
+        inicio = time.perf_counter()
+        salida = app.test_cli_runner().invoke(args=['enviar-correos', '--una-vez'])
+        assert salida.exit_code == 0, salida.output
+        print(f"{'worker con conexiones reutilizadas':34} {time.perf_counter() - inicio:9.2f} {servidor.conexiones:11d} "
+              f"{len(servidor.mensajes):9d}")
+
+        with app.app_context():
+            estados = dict(Counter(envio.estado for envio in EnvioFactura.query))
+            db.session.remove()
+    finally:
+        servidor.shutdown()
+        shutil.rmtree(directorio, ignore_errors=True)
+
+    print(f"\nEstado de los envíos del worker: {estados}")
+    recibidos = Counter(destinatario for destinatarios, _ in servidor.mensajes for destinatario in destinatarios)
+    problemas = []
+    if sorted(recibidos) != sorted(esperados) or any(n != 1 for n in recibidos.values()):
+        problemas.append(f"{len(recibidos)} destinatarios distintos de {len(esperados)} esperados, "
+                         f"{sum(1 for n in recibidos.values() if n > 1)} repetidos")
+    if estados != {'enviado': len(esperados), 'error': 1}:
+        problemas.append(f"estados inesperados: {estados}")
+    if problemas:
+        sys.exit('; '.join(problemas))
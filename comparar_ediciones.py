@@ -0,0 +1,93 @@
+"""
+Comprueba el control de concurrencia optimista de las ediciones: varios usuarios
+abren a la vez el formulario de edición de un mismo cliente, añaden cada uno una
+marca a la dirección y lo guardan.
+
+Sin la versión en el formulario (como antes), cada guardado sobrescribe al anterior
+y se pierden marcas de ediciones que recibieron "actualizado correctamente". Con la
+versión, las ediciones basadas en datos obsoletos reciben la página de conflicto
+(409) y ninguna edición aceptada se pierde. Termina con error si se pierde alguna
+con la versión activada.
+
+Se ejecuta sobre una base de datos temporal:
+    python comparar_ediciones.py [usuarios] [rondas]
+"""
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from html import unescape
+
+directorio = tempfile.mkdtemp()
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(directorio, 'comparacion.db')
+
+from app import app
+from models import db, Cliente
+
+PATRON_CAMPO = r'name="{}" value="([^"]*)"'
+
+
+def campo(html, nombre):
+    return unescape(re.search(PATRON_CAMPO.format(nombre), html).group(1))
+
+
+def editar(cliente_id, marca, con_version, resultados, lock):
+    """Un usuario: abre el formulario, tarda un poco en rellenarlo y lo guarda"""
+    cliente = app.test_client()
+    html = cliente.get(f'/clientes/{cliente_id}/editar').get_data(as_text=True)
+    formulario = {'nombre': campo(html, 'nombre'), 'direccion': campo(html, 'direccion') + f' {marca}'}
+    if con_version:
+        formulario['version'] = campo(html, 'version')
+    time.sleep(random.uniform(0, 0.02))
+    respuesta = cliente.post(f'/clientes/{cliente_id}/editar', data=formulario)
+    with lock:
+        resultados.append((marca, respuesta.status_code))
+
+
+def medir(nombre, con_version, usuarios, rondas):
+    with app.app_context():
+        cliente = Cliente(nombre=f'Cliente {nombre}', direccion='Calle Mayor 1')
+        db.session.add(cliente)
+        db.session.commit()
+        cliente_id = cliente.id
+        db.session.remove()
+
+    resultados, lock = [], threading.Lock()
+    inicio = time.perf_counter()
+    for ronda in range(rondas):
+        hilos = [threading.Thread(target=editar, args=(cliente_id, f'r{ronda}u{u}', con_version, resultados, lock))
+                 for u in range(usuarios)]
+        for hilo in hilos:
+            hilo.start()
+        for hilo in hilos:
+            hilo.join()
+    duracion = time.perf_counter() - inicio
+
+    with app.app_context():
+        direccion = db.session.get(Cliente, cliente_id).direccion.split()
+        db.session.remove()
+    aceptadas = [marca for marca, estado in resultados if estado == 302]
+    conflictos = sum(1 for _, estado in resultados if estado == 409)
+    perdidas = sum(1 for marca in aceptadas if marca not in direccion)
+    print(f"{nombre:22} {len(resultados):9d} {len(aceptadas):9d} {conflictos:10d} {perdidas:9d} "
+          f"{duracion * 1000 / len(resultados):10.1f}")
+    return perdidas
+
+
+if __name__ == '__main__':
+    usuarios = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    rondas = int(sys.argv[2]) if len(sys.argv) > 2 else 25
+
+    print(f"{usuarios} usuarios editando el mismo cliente a la vez, {rondas} rondas\n")
+    print(f"{'Formulario':22} {'ediciones':>9} {'aceptadas':>9} {'conflictos':>10} {'perdidas':>9} {'ms/edición':>10}")
+    try:
+        medir('sin versión', False, usuarios, rondas)
+        perdidas = medir('con versión', True, usuarios, rondas)
+    finally:
+        shutil.rmtree(directorio, ignore_errors=True)
+    if perdidas:
+        sys.exit(f"Se han perdido {perdidas} ediciones aceptadas con el control de versión activado")
@@ -0,0 +1,103 @@
+"""
+Cuenta las consultas de la ficha de cliente (/clientes/<id>) para clientes con
+flotas de distinto tamaño, frente a montar la misma información recorriendo las
+relaciones perezosas (Cliente.vehiculos, Coche.intervenciones, Cliente.facturas,
+Factura.pagos).
+
+La ficha debe hacer siempre el mismo número de consultas; termina con error si
+el número cambia con el tamaño de la flota.
+
+Se ejecuta sobre una base de datos temporal con datos sintéticos:
+    python comparar_ficha_cliente.py [vehiculos...]
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+directorio = tempfile.mkdtemp()
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(directorio, 'comparacion.db')
+
+from sqlalchemy import event
+
+from app import app
+from models import db, Cliente, Coche, Intervencion, Factura, Pago
+
+
+class ContadorConsultas:
+    def __init__(self, engine):
+        self.engine = engine
+        self.total = 0
+
+    def _contar(self, *args):
+        self.total += 1
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self._contar)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(self.engine, 'before_cursor_execute', self._contar)
+
+
+def crear_flota(vehiculos, intervenciones_por_vehiculo=6):
+    """Cliente con `vehiculos` vehículos, sus intervenciones y una factura con un pago por vehículo"""
+    cliente = Cliente(nombre=f'Flota {vehiculos}')
+    db.session.add(cliente)
+    db.session.flush()
+    fecha = datetime(2024, 1, 1)
+    for v in range(vehiculos):
+        coche = Coche(matricula=f'F{vehiculos:04d}{v:05d}', marca='Renault', modelo='Kangoo', cliente_id=cliente.id)
+        factura = Factura(cliente_id=cliente.id, numero_factura=f'FL-{vehiculos}-{v}', fecha=fecha, total=100)
+        db.session.add_all([coche, factura])
+        db.session.flush()
+        db.session.add(Pago(factura_id=factura.id, importe=50, fecha=fecha))
+        for i in range(intervenciones_por_vehiculo):
+            db.session.add(Intervencion(coche_id=coche.id, cliente_id=cliente.id, fecha=fecha + timedelta(days=i),
+                                        km=1000 * i, descripcion='Revisión', precio=50, horas_trabajo=1.0,
+                                        factura_id=factura.id if i == 0 else None))
+    db.session.commit()
+    return cliente.id
+
+
+def ficha_perezosa(cliente_id):
+    """Lo mismo que muestra la ficha, recorriendo las relaciones una a una"""
+    cliente = db.session.get(Cliente, cliente_id)
+    filas = []
+    for coche in cliente.vehiculos:
+        for intervencion in coche.intervenciones:
+            filas.append((coche.matricula, intervencion.fecha, intervencion.precio,
+                          intervencion.factura.numero_factura if intervencion.factura else None))
+    for factura in cliente.facturas:
+        filas.append((factura.numero_factura, sum(pago.importe for pago in factura.pagos)))
+    return filas
+
+
+if __name__ == '__main__':
+    tamaños = [int(a) for a in sys.argv[1:]] or [1, 10, 100, 400]
+    cliente_web = app.test_client()
+    print(f"{'Vehículos':>10} {'perezosa: consultas':>20} {'ms':>8} {'ficha: consultas':>17} {'ms':>8}")
+    consultas_ficha = set()
+    try:
+        for tamaño in tamaños:
+            with app.app_context():
+                cliente_id = crear_flota(tamaño)
+                db.session.remove()
+                with ContadorConsultas(db.engine) as perezosa:
+                    inicio = time.perf_counter()
+                    ficha_perezosa(cliente_id)
+                    ms_perezosa = (time.perf_counter() - inicio) * 1000
+                db.session.remove()
+                with ContadorConsultas(db.engine) as ficha:
+                    inicio = time.perf_counter()
+                    respuesta = cliente_web.get(f'/clientes/{cliente_id}')
+                    ms_ficha = (time.perf_counter() - inicio) * 1000
+                assert respuesta.status_code == 200, respuesta.status_code
+            consultas_ficha.add(ficha.total)
+            print(f"{tamaño:10d} {perezosa.total:20d} {ms_perezosa:8.1f} {ficha.total:17d} {ms_ficha:8.1f}")
+    finally:
+        shutil.rmtree(directorio, ignore_errors=True)
+    if len(consultas_ficha) > 1:
+        sys.exit(f"La ficha de cliente no hace un número fijo de consultas: {sorted(consultas_ficha)}")
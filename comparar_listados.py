@@ -0,0 +1,110 @@
+"""
+Compara tiempo y memoria de los listados cargando objetos del ORM (con
+joinedload) frente a las consultas de proyección de consultas.py.
+
+Se ejecuta sobre una base de datos temporal con datos sintéticos:
+    python comparar_listados.py [num_intervenciones]
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+directorio = tempfile.mkdtemp()
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(directorio, 'comparacion.db')
+
+from sqlalchemy.orm import joinedload
+
+from app import app
+from models import db, Cliente, Coche, Intervencion, Factura
+import consultas
+
+
+def generar_datos(num_intervenciones):
+    """Inserta clientes, vehículos, facturas e intervenciones sintéticos"""
+    num_clientes = max(num_intervenciones // 10, 1)
+    num_coches = max(num_intervenciones // 5, 1)
+    num_facturas = max(num_intervenciones // 4, 1)
+    fecha = datetime(2024, 1, 1)
+    
+    db.session.execute(Cliente.__table__.insert(), [
+        {'id': i, 'nombre': f'Cliente {i:06d}', 'dni': f'{i:08d}X', 'telefono': '600000000',
+         'email': f'cliente{i}@example.com', 'direccion': 'Calle Mayor 1'}
+        for i in range(1, num_clientes + 1)
+    ])
+    db.session.execute(Coche.__table__.insert(), [
+        {'id': i, 'matricula': f'{i:04d}ABC', 'marca': 'Seat', 'modelo': 'Ibiza', 'tipo': 'Turismo',
+         'año': 2018, 'color': 'Blanco', 'cliente_id': i % num_clientes + 1}
+        for i in range(1, num_coches + 1)
+    ])
+    db.session.execute(Factura.__table__.insert(), [
+        {'id': i, 'cliente_id': i % num_clientes + 1, 'numero_factura': f'FAC-2024-{i:06d}',
+         'fecha': fecha + timedelta(hours=i), 'base_imponible': 100, 'iva_importe': 21, 'total': 121}
+        for i in range(1, num_facturas + 1)
+    ])
+    db.session.execute(Intervencion.__table__.insert(), [
+        {'coche_id': i % num_coches + 1, 'cliente_id': i % num_clientes + 1, 'fecha': fecha + timedelta(hours=i),
+         'km': 10000 + i, 'descripcion': f'Cambio de aceite y filtro {i}', 'precio': 100, 'horas_trabajo': 1.5,
+         'factura_id': i % num_facturas + 1 if i % 2 else None}
+        for i in range(1, num_intervenciones + 1)
+    ])
+    db.session.commit()
+
+
+def medir(cargar, repeticiones=5):
+    """Mediana del tiempo de carga (ms) y pico de memoria de una carga (KB)"""
+    tiempos = []
+    for _ in range(repeticiones):
+        db.session.expunge_all()
+        inicio = time.perf_counter()
+        filas = cargar()
+        tiempos.append((time.perf_counter() - inicio) * 1000)
+        del filas
+    
+    db.session.expunge_all()
+    tracemalloc.start()
+    filas = cargar()
+    _, pico = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del filas
+    return sorted(tiempos)[len(tiempos) // 2], pico / 1024
+
+
+LISTADOS = [
+    ('listar_clientes',
+     lambda: Cliente.query.order_by(Cliente.nombre).all(),
+     consultas.filas_clientes),
+    ('listar_coches',
+     lambda: Coche.query.options(joinedload(Coche.cliente)).order_by(Coche.matricula).all(),
+     consultas.filas_coches),
+    ('listar_intervenciones',
+     lambda: Intervencion.query.options(joinedload(Intervencion.coche), joinedload(Intervencion.cliente))
+     .order_by(Intervencion.fecha.desc()).all(),
+     consultas.filas_intervenciones),
+    ('listar_facturas (sin facturar)',
+     lambda: Intervencion.query.options(joinedload(Intervencion.coche), joinedload(Intervencion.cliente))
+     .filter_by(factura_id=None).order_by(Intervencion.fecha.desc()).all(),
+     lambda: consultas.filas_intervenciones(sin_facturar=True)),
+    ('listar_facturas (facturas)',
+     lambda: Factura.query.options(joinedload(Factura.cliente)).order_by(Factura.fecha.desc()).all(),
+     consultas.filas_facturas),
+]
+
+
+if __name__ == '__main__':
+    num_intervenciones = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    with app.app_context():
+        print(f"Generando {num_intervenciones} intervenciones de prueba en {directorio}...")
+        generar_datos(num_intervenciones)
+        
+        print(f"\n{'Listado':32} {'ORM ms':>9} {'Proy. ms':>9} {'ORM KB':>10} {'Proy. KB':>10}")
+        for nombre, orm, proyeccion in LISTADOS:
+            tiempo_orm, memoria_orm = medir(orm)
+            tiempo_proy, memoria_proy = medir(proyeccion)
+            print(f"{nombre:32} {tiempo_orm:9.1f} {tiempo_proy:9.1f} {memoria_orm:10.0f} {memoria_proy:10.0f}")
+        db.session.remove()
+        db.engine.dispose()
+    shutil.rmtree(directorio, ignore_errors=True)
@@ -0,0 +1,55 @@
+"""
+Compara tamaño y tiempo de generación de los PDFs de factura en modo completo
+(logo PNG original, páginas sin comprimir) y en modo compacto.
+
+Se ejecuta sobre una base de datos temporal con los datos de prueba:
+    python comparar_pdf.py [repeticiones]
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+directorio = tempfile.mkdtemp()
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(directorio, 'comparacion.db')
+
+from app import app, generar_pdf_factura, insertar_datos_prueba, logo_compacto
+from models import db, Factura
+
+
+def medir(factura, compacto, repeticiones):
+    """Mediana del tiempo de generación (ms) y tamaño del PDF (bytes)"""
+    tiempos = []
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        buffer = generar_pdf_factura(factura, compacto=compacto)
+        tiempos.append((time.perf_counter() - inicio) * 1000)
+    return sorted(tiempos)[len(tiempos) // 2], buffer.getbuffer().nbytes
+
+
+if __name__ == '__main__':
+    repeticiones = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    with app.app_context(), app.test_request_context():
+        insertar_datos_prueba()
+        facturas = Factura.query.order_by(Factura.id).all()
+        # El primer PDF compacto incluye la reducción del logo, que luego queda en caché
+        logo_compacto.cache_clear()
+        inicio = time.perf_counter()
+        generar_pdf_factura(facturas[0], compacto=True)
+        print(f"Primer PDF compacto (con reducción del logo): {(time.perf_counter() - inicio) * 1000:.1f} ms\n")
+        
+        print(f"{'Factura':16} {'Completo ms':>12} {'Compacto ms':>12} {'Completo B':>11} {'Compacto B':>11}")
+        totales = [0, 0]
+        for factura in facturas:
+            tiempo_completo, bytes_completo = medir(factura, False, repeticiones)
+            tiempo_compacto, bytes_compacto = medir(factura, True, repeticiones)
+            totales[0] += bytes_completo
+            totales[1] += bytes_compacto
+            print(f"{factura.numero_factura:16} {tiempo_completo:12.1f} {tiempo_compacto:12.1f} "
+                  f"{bytes_completo:11d} {bytes_compacto:11d}")
+        print(f"\nMedia por factura: {totales[0] // len(facturas)} B completo, "
+              f"{totales[1] // len(facturas)} B compacto")
+        db.session.remove()
+        db.engine.dispose()
+    shutil.rmtree(directorio, ignore_errors=True)
@@ -0,0 +1,128 @@
+"""
+Compara el servidor de desarrollo (`flask run`) con el servidor preforkado
+(`flask serve`) bajo la misma carga de rutas: listados, fichas, informes y PDFs
+pedidos por varios clientes concurrentes.
+
+Con --reiniciar, a mitad de la prueba del servidor preforkado se le envía HUP
+(reinicio sin cortes) y no debería aparecer ningún error de conexión.
+
+Se ejecuta sobre una base de datos temporal con los datos de prueba:
+    python comparar_servidor.py [segundos] [clientes] [--reiniciar]
+"""
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import Counter
+
+directorio = tempfile.mkdtemp()
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(directorio, 'comparacion.db')
+
+RUTAS = ['/', '/clientes', '/coches', '/intervenciones', '/facturas', '/coches/1/ficha',
+         '/clientes/1/historial', '/informes/iva', '/facturas/1', '/facturas/1/pdf']
+
+
+def puerto_libre():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def esperar_servidor(url, plazo=30):
+    limite = time.monotonic() + plazo
+    while time.monotonic() < limite:
+        try:
+            urllib.request.urlopen(url, timeout=1).read()
+            return
+        except (urllib.error.URLError, ConnectionError, OSError):
+            time.sleep(0.2)
+    raise RuntimeError(f'El servidor no responde en {url}')
+
+
+def cargar(base, segundos, clientes, al_medio=None):
+    """Peticiones a RUTAS en bucle desde `clientes` hilos; devuelve latencias (ms) y resultados"""
+    latencias, resultados = [], Counter()
+    lock = threading.Lock()
+    fin = time.monotonic() + segundos
+
+    def cliente(n):
+        i = n
+        while time.monotonic() < fin:
+            ruta = RUTAS[i % len(RUTAS)]
+            i += 1
+            inicio = time.perf_counter()
+            try:
+                with urllib.request.urlopen(base + ruta, timeout=60) as respuesta:
+                    respuesta.read()
+                    resultado = respuesta.status
+            except urllib.error.HTTPError as e:
+                resultado = e.code
+            except OSError as e:
+                resultado = type(e).__name__
+            with lock:
+                latencias.append((time.perf_counter() - inicio) * 1000)
+                resultados[resultado] += 1
+
+    hilos = [threading.Thread(target=cliente, args=(n,)) for n in range(clientes)]
+    for hilo in hilos:
+        hilo.start()
+    if al_medio is not None:
+        time.sleep(segundos / 2)
+        al_medio()
+    for hilo in hilos:
+        hilo.join()
+    return latencias, resultados
+
+
+def medir(nombre, orden, segundos, clientes, reiniciar=False):
+    puerto = puerto_libre()
+    proceso = subprocess.Popen(
+        [sys.executable, '-m', 'flask', '--app', 'app'] + [a.format(puerto=puerto) for a in orden],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        base = f'http://127.0.0.1:{puerto}'
+        esperar_servidor(base + '/')
+        al_medio = (lambda: proceso.send_signal(signal.SIGHUP)) if reiniciar else None
+        latencias, resultados = cargar(base, segundos, clientes, al_medio)
+    finally:
+        proceso.send_signal(signal.SIGTERM)
+        proceso.wait(60)
+    latencias.sort()
+    percentil = lambda p: latencias[min(int(len(latencias) * p), len(latencias) - 1)]
+    errores = sum(n for r, n in resultados.items() if not isinstance(r, int) or r >= 500)
+    print(f"{nombre:34} {len(latencias) / segundos:8.1f} {percentil(0.5):8.1f} {percentil(0.95):8.1f} "
+          f"{percentil(0.99):8.1f} {errores:8d}  {dict(resultados)}")
+
+
+if __name__ == '__main__':
+    argumentos = [a for a in sys.argv[1:] if not a.startswith('--')]
+    segundos = float(argumentos[0]) if argumentos else 10
+    clientes = int(argumentos[1]) if len(argumentos) > 1 else 8
+    reiniciar = '--reiniciar' in sys.argv
+
+    from app import app, insertar_datos_prueba
+    from models import db
+    with app.app_context():
+        insertar_datos_prueba()
+        db.session.remove()
+        db.engine.dispose()
+
+    workers = os.cpu_count() or 2
+    print(f"{clientes} clientes durante {segundos:.0f} s por servidor, {workers} workers\n")
+    print(f"{'Servidor':34} {'pet/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errores':>8}")
+    medir('flask run (desarrollo)', ['run', '--port', '{puerto}'], segundos, clientes)
+    medir(f'flask serve -w {workers} -t 4', ['serve', '-b', '127.0.0.1:{puerto}', '-w', str(workers), '-t', '4'],
+          segundos, clientes)
+    medir(f'flask serve -w {workers} -t 4 --max-requests 50',
+          ['serve', '-b', '127.0.0.1:{puerto}', '-w', str(workers), '-t', '4', '--max-requests', '50'],
+          segundos, clientes, reiniciar=reiniciar)
+    shutil.rmtree(directorio, ignore_errors=True)
@@ -0,0 +1,140 @@
+"""
+Mide la cadena de registros Verifactu con historiales grandes:
+    - lo que cuesta encadenar una factura nueva (debe ser igual con 10 o con un
+      millón de registros: solo lee y actualiza la cabeza del emisor);
+    - el tiempo y la memoria máxima de la verificación completa (la memoria no
+      debe crecer con el historial);
+    - que la verificación encuentra el primer eslabón roto tras alterar el total
+      de una factura antigua y tras borrar una factura de en medio.
+
+Termina con error si la verificación no señala la factura alterada o la siguiente
+a la borrada. Se ejecuta sobre una base de datos temporal con datos sintéticos:
+    python comparar_verifactu.py [registros...]
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+directorio = tempfile.mkdtemp()
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(directorio, 'comparacion.db')
+
+from sqlalchemy import delete, func, select, update
+
+import verifactu
+from app import app
+from models import db, CadenaVerifactu, Cliente, Factura
+
+EMISOR = 'B00000000'
+
+
+def ampliar_historial(hasta):
+    """Añade registros encadenados hasta tener `hasta`, con INSERT masivos"""
+    cabeza = db.session.get(CadenaVerifactu, EMISOR)
+    if cabeza is None:
+        cliente = Cliente(nombre='Cliente historial')
+        db.session.add(cliente)
+        db.session.flush()
+        cabeza = CadenaVerifactu(emisor_nif=EMISOR, factura_id=0, huella='', registros=0, registros_verificados=0)
+        db.session.add(cabeza)
+        cliente_id = cliente.id
+    else:
+        cliente_id = db.session.execute(select(Cliente.id).order_by(Cliente.id).limit(1)).scalar()
+    siguiente = (db.session.execute(select(func.max(Factura.id))).scalar() or 0) + 1
+    anterior = cabeza.huella
+    generado = datetime.now().astimezone().isoformat(timespec='seconds')
+    inicio = datetime(2015, 1, 1)
+    filas = []
+    for n in range(siguiente, siguiente + hasta - cabeza.registros):
+        fecha = inicio + timedelta(minutes=5 * n)
+        total, cuota = 12100 + n % 997, 2100 + n % 97
+        numero = f'H-{n:08d}'
+        huella = verifactu.calcular_huella(EMISOR, numero, fecha.strftime('%d-%m-%Y'), cuota, total, anterior, generado)
+        filas.append({'id': n, 'cliente_id': cliente_id, 'numero_factura': numero, 'fecha': fecha,
+                      'base_imponible': (total - cuota) / 100, 'iva_importe': cuota / 100, 'total': total / 100,
+                      'emisor_nif': EMISOR, 'huella': huella, 'huella_anterior': anterior or None,
+                      'registro_generado': generado})
+        anterior = huella
+        if len(filas) == 50000:
+            db.session.execute(Factura.__table__.insert(), filas)
+            filas = []
+    if filas:
+        db.session.execute(Factura.__table__.insert(), filas)
+    cabeza.factura_id = n
+    cabeza.huella = anterior
+    cabeza.registros = hasta
+    db.session.commit()
+
+
+def encadenar_nueva():
+    """Crea y encadena una factura como la ruta de nueva factura; devuelve los ms de encadenar"""
+    cliente_id = db.session.execute(select(Cliente.id).order_by(Cliente.id).limit(1)).scalar()
+    numero = db.session.execute(select(func.count()).select_from(Factura)).scalar()
+    factura = Factura(cliente_id=cliente_id, numero_factura=f'N-{numero}', base_imponible=100, iva_importe=21,
+                      total=121)
+    db.session.add(factura)
+    db.session.flush()
+    inicio = time.perf_counter()
+    verifactu.encadenar(factura, EMISOR)
+    db.session.flush()
+    ms = (time.perf_counter() - inicio) * 1000
+    db.session.commit()
+    return ms
+
+
+def verificar_midiendo():
+    db.session.expire_all()
+    inicio = time.perf_counter()
+    resultado = verifactu.verificar(EMISOR)
+    segundos = time.perf_counter() - inicio
+    db.session.rollback()
+    tracemalloc.start()
+    verifactu.verificar(EMISOR)
+    pico = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    db.session.rollback()
+    return resultado, segundos, pico
+
+
+if __name__ == '__main__':
+    tamaños = sorted(int(a) for a in sys.argv[1:]) or [10, 100000, 500000]
+    problemas = []
+    print(f"{'Registros':>10} {'encadenar ms':>13} {'verificar s':>12} {'memoria KB':>11}")
+    try:
+        with app.app_context():
+            for tamaño in tamaños:
+                ampliar_historial(tamaño)
+                ms = min(encadenar_nueva() for _ in range(5))
+                resultado, segundos, pico = verificar_midiendo()
+                if resultado.roto:
+                    problemas.append(f'cadena intacta de {tamaño} registros dada por rota: {resultado.roto}')
+                print(f"{resultado.registros:10d} {ms:13.2f} {segundos:12.2f} {pico / 1024:11.0f}")
+
+            ids = db.session.execute(select(Factura.id).where(Factura.emisor_nif == EMISOR)
+                                     .order_by(Factura.id)).scalars().all()
+            print()
+
+            alterada = ids[len(ids) * 9 // 10]
+            db.session.execute(update(Factura).where(Factura.id == alterada).values(total=Factura.total + 1))
+            db.session.commit()
+            resultado, segundos, _ = verificar_midiendo()
+            print(f"Total alterado en la factura {alterada}: {resultado.roto} ({segundos:.2f} s)")
+            if not resultado.roto or resultado.roto.factura_id != alterada:
+                problemas.append(f'no se ha señalado la factura alterada {alterada}')
+            db.session.execute(update(Factura).where(Factura.id == alterada).values(total=Factura.total - 1))
+
+            borrada = ids[len(ids) // 2]
+            db.session.execute(delete(Factura).where(Factura.id == borrada))
+            db.session.commit()
+            resultado, segundos, _ = verificar_midiendo()
+            print(f"Factura {borrada} borrada: {resultado.roto} ({segundos:.2f} s)")
+            if not resultado.roto or resultado.roto.factura_id != ids[len(ids) // 2 + 1]:
+                problemas.append(f'no se ha señalado la factura siguiente a la borrada {borrada}')
+            db.session.remove()
+    finally:
+        shutil.rmtree(directorio, ignore_errors=True)
+    if problemas:
+        sys.exit('; '.join(problemas))
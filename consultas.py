@@ -0,0 +1,192 @@
+"""
+Consultas de solo lectura para listados y formularios.
+
+Seleccionan únicamente las columnas que usa cada plantilla y devuelven tuplas
+con nombre en lugar de objetos del ORM: no pasan por el identity map, no
+cargan relaciones y ocupan mucha menos memoria por fila.
+"""
+from collections import namedtuple
+
+from sqlalchemy import case, func, or_, select, tuple_
+from sqlalchemy.orm import selectinload
+
+from models import db, Cliente, Coche, Intervencion, Factura, Pago
+
+FilaCliente = namedtuple('FilaCliente', 'id nombre dni telefono email total_facturado total_pagado')
+FilaCoche = namedtuple('FilaCoche', 'id matricula marca modelo tipo año color cliente_nombre')
+FilaIntervencion = namedtuple(
+    'FilaIntervencion',
+    'id fecha km descripcion precio horas_trabajo factura_id coche_id matricula cliente_nombre'
+)
+FilaFactura = namedtuple('FilaFactura', 'id numero_factura fecha total enviada_verifactu cliente_nombre')
+ResumenVehiculo = namedtuple('ResumenVehiculo', 'intervenciones importe ultima_fecha ultimo_km')
+TotalesCliente = namedtuple(
+    'TotalesCliente',
+    'intervenciones importe horas sin_facturar primera_fecha ultima_fecha facturas'
+)
+FilaFacturaCliente = namedtuple('FilaFacturaCliente', 'id numero_factura fecha total enviada_verifactu pagado')
+
+
+class Pagina(namedtuple('Pagina', 'filas numero tamaño total')):
+    """Una página de filas de una sección, con lo necesario para los enlaces de paginación"""
+    
+    @property
+    def paginas(self):
+        return max(1, -(-self.total // self.tamaño))
+
+
+def _acotar_pagina(numero, tamaño, total):
+    """Número de página entre 1 y la última, para que el OFFSET no se salga del total"""
+    return min(max(numero, 1), max(1, -(-total // tamaño)))
+
+
+def _filas(tipo, consulta):
+    return [tipo._make(fila) for fila in db.session.execute(consulta)]
+
+
+def consulta_clientes():
+    return select(
+        Cliente.id, Cliente.nombre, Cliente.dni, Cliente.telefono, Cliente.email,
+        Cliente.total_facturado, Cliente.total_pagado
+    ).order_by(Cliente.nombre)
+
+
+def filas_clientes():
+    """Clientes ordenados por nombre"""
+    return _filas(FilaCliente, consulta_clientes())
+
+
+def consulta_coches():
+    return select(
+        Coche.id, Coche.matricula, Coche.marca, Coche.modelo, Coche.tipo, Coche.año, Coche.color,
+        Cliente.nombre
+    ).outerjoin(Cliente, Coche.cliente_id == Cliente.id).order_by(Coche.matricula)
+
+
+def filas_coches():
+    """Vehículos ordenados por matrícula, con el nombre de su cliente"""
+    return _filas(FilaCoche, consulta_coches())
+
+
+def consulta_intervenciones(sin_facturar=False, coche_id=None, ids=None, cliente_id=None):
+    consulta = select(
+        Intervencion.id, Intervencion.fecha, Intervencion.km, Intervencion.descripcion,
+        Intervencion.precio, Intervencion.horas_trabajo, Intervencion.factura_id,
+        Intervencion.coche_id, Coche.matricula, Cliente.nombre
+    ).join(Coche, Intervencion.coche_id == Coche.id).outerjoin(
+        Cliente, Intervencion.cliente_id == Cliente.id
+    ).order_by(Intervencion.fecha.desc())
+    if sin_facturar:
+        consulta = consulta.where(Intervencion.factura_id.is_(None))
+    if coche_id is not None:
+        consulta = consulta.where(Intervencion.coche_id == coche_id)
+    if ids is not None:
+        consulta = consulta.where(Intervencion.id.in_(ids))
+    if cliente_id is not None:
+        consulta = consulta.where(Intervencion.cliente_id == cliente_id)
+    return consulta
+
+
+def filas_intervenciones(sin_facturar=False, coche_id=None, ids=None):
+    """Intervenciones de la más reciente a la más antigua, con matrícula y cliente"""
+    return _filas(FilaIntervencion, consulta_intervenciones(sin_facturar, coche_id, ids))
+
+
+def iterar_intervenciones(coche_id=None, cliente_id=None, lote=500):
+    """
+    Como filas_intervenciones, pero generando las filas de `lote` en `lote` en
+    lugar de cargarlas todas en una lista. Para plantillas renderizadas por partes.
+
+    Cada lote es una consulta aparte que continúa tras la última (fecha, id) leída
+    y se lee entera antes de entregar sus filas: un cursor abierto mientras la
+    respuesta sale hacia el cliente mantendría el bloqueo de lectura de SQLite y
+    los COMMIT de las demás conexiones fallarían con "database is locked".
+    """
+    consulta = consulta_intervenciones(coche_id=coche_id, cliente_id=cliente_id).order_by(
+        Intervencion.id.desc()).limit(lote)
+    siguiente = consulta
+    while True:
+        filas = db.session.execute(siguiente).all()
+        yield from (FilaIntervencion._make(fila) for fila in filas)
+        if len(filas) < lote:
+            return
+        ultima = filas[-1]
+        siguiente = consulta.where(tuple_(Intervencion.fecha, Intervencion.id) < (ultima.fecha, ultima.id))
+
+
+def consulta_facturas():
+    return select(
+        Factura.id, Factura.numero_factura, Factura.fecha, Factura.total, Factura.enviada_verifactu,
+        Cliente.nombre
+    ).join(Cliente, Factura.cliente_id == Cliente.id).order_by(Factura.fecha.desc())
+
+
+def filas_facturas():
+    """Facturas de la más reciente a la más antigua, con el nombre del cliente"""
+    return _filas(FilaFactura, consulta_facturas())
+
+
+# ========== FICHA DE CLIENTE ==========
+# La ficha se compone con un número fijo de consultas, tenga el cliente 1 o 500
+# vehículos: el cliente con sus vehículos (selectinload, 2 consultas), los agregados
+# por vehículo, los totales del cliente y una página de intervenciones y otra de
+# facturas. Nada de la plantilla recorre relaciones perezosas.
+
+def _condicion_historial(cliente_id):
+    """Intervenciones del cliente: las suyas y las de sus vehículos (aunque figuren a nombre de otro)"""
+    coches = select(Coche.id).where(Coche.cliente_id == cliente_id)
+    return or_(Intervencion.cliente_id == cliente_id, Intervencion.coche_id.in_(coches))
+
+
+def cliente_con_vehiculos(cliente_id):
+    """Cliente con sus vehículos cargados en una segunda consulta, o None"""
+    return db.session.execute(
+        select(Cliente).options(selectinload(Cliente.vehiculos)).where(Cliente.id == cliente_id)
+    ).scalar_one_or_none()
+
+
+def resumen_vehiculos(cliente_id):
+    """Número de intervenciones, importe y última visita de cada vehículo del cliente, en una consulta"""
+    filas = db.session.execute(
+        select(Intervencion.coche_id, func.count(), func.sum(Intervencion.precio), func.max(Intervencion.fecha),
+               func.max(Intervencion.km))
+        .join(Coche, Intervencion.coche_id == Coche.id)
+        .where(Coche.cliente_id == cliente_id)
+        .group_by(Intervencion.coche_id)
+    )
+    return {coche_id: ResumenVehiculo(*resto) for coche_id, *resto in filas}
+
+
+def totales_cliente(cliente_id):
+    """Agregados del historial del cliente y número de facturas, en una consulta"""
+    sin_facturar = case((Intervencion.factura_id.is_(None), Intervencion.precio), else_=0)
+    facturas = select(func.count()).where(Factura.cliente_id == cliente_id).scalar_subquery()
+    fila = db.session.execute(
+        select(func.count(), func.coalesce(func.sum(Intervencion.precio), 0),
+               func.coalesce(func.sum(Intervencion.horas_trabajo), 0.0),
+               func.coalesce(func.sum(sin_facturar), 0),
+               func.min(Intervencion.fecha), func.max(Intervencion.fecha), facturas)
+        .where(_condicion_historial(cliente_id))
+    ).one()
+    return TotalesCliente._make(fila)
+
+
+def pagina_intervenciones_cliente(cliente_id, numero, tamaño, total):
+    """Una página del historial del cliente, de la intervención más reciente a la más antigua"""
+    numero = _acotar_pagina(numero, tamaño, total)
+    consulta = (consulta_intervenciones().where(_condicion_historial(cliente_id))
+                .order_by(Intervencion.id.desc()).limit(tamaño).offset((numero - 1) * tamaño))
+    return Pagina(_filas(FilaIntervencion, consulta), numero, tamaño, total)
+
+
+def pagina_facturas_cliente(cliente_id, numero, tamaño, total):
+    """Una página de las facturas del cliente con lo cobrado de cada una"""
+    numero = _acotar_pagina(numero, tamaño, total)
+    pagado = (select(func.coalesce(func.sum(Pago.importe), 0)).where(Pago.factura_id == Factura.id)
+              .scalar_subquery())
+    consulta = (
+        select(Factura.id, Factura.numero_factura, Factura.fecha, Factura.total, Factura.enviada_verifactu, pagado)
+        .where(Factura.cliente_id == cliente_id)
+        .order_by(Factura.fecha.desc(), Factura.id.desc()).limit(tamaño).offset((numero - 1) * tamaño)
+    )
+    return Pagina(_filas(FilaFacturaCliente, consulta), numero, tamaño, total)
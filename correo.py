@@ -0,0 +1,355 @@
+"""
+Envío de facturas por correo electrónico.
+
+Las peticiones solo encolan: cada envío es una fila de `envios_factura` que guarda
+también el estado de la entrega (pendiente, enviando, enviado o error). El worker
+de correo (`flask --app app enviar-correos`, un proceso aparte) procesa la cola
+por lotes:
+    - reclama el lote con un único UPDATE ... RETURNING que lo pasa a "enviando"
+      con un plazo; si el worker muere, al vencer el plazo otro lo vuelve a tomar;
+    - genera los PDF en su hilo principal (con `generar_pdf_factura`, como la
+      descarga) y los entrega desde unos pocos hilos que comparten `PoolSMTP`;
+    - guarda el resultado de todo el lote en una sola transacción.
+
+`PoolSMTP` mantiene abiertas y reutiliza las conexiones (saludo, STARTTLS y login
+una vez por conexión, no por mensaje) y respeta los límites habituales de los
+servidores: conexiones simultáneas, mensajes por conexión y mensajes por minuto.
+Los rechazos definitivos (5xx) dejan el envío en error; los temporales (4xx,
+conexión caída) se reintentan con espera exponencial hasta `max_intentos`.
+"""
+import smtplib
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from email.message import EmailMessage
+from email.utils import formatdate, make_msgid
+
+from flask import render_template
+from sqlalchemy import exists, func, insert, or_, select, update
+from sqlalchemy.orm import joinedload, selectinload
+
+from models import db, Cliente, EnvioFactura, Factura, Intervencion
+
+ResultadoEncolado = namedtuple('ResultadoEncolado', 'encoladas sin_email repetidas')
+FilaEnvioFactura = namedtuple('FilaEnvioFactura', 'id numero_factura fecha cliente email total '
+                                                  'estado intentos enviado_en error')
+
+ESTADOS = {'pendiente': 'Pendiente', 'enviando': 'Enviando', 'enviado': 'Enviado', 'error': 'Error'}
+EN_CURSO = ('pendiente', 'enviando')
+
+_envios = EnvioFactura.__table__
+
+
+def email_valido(email):
+    email = (email or '').strip()
+    return email if '@' in email else None
+
+
+def encolar(*condiciones, reenviar=False):
+    """
+    Encola el envío de las facturas que cumplen `condiciones` al email de su
+    cliente. Se omiten las que ya tienen un envío en curso y, salvo con
+    `reenviar`, las ya enviadas. No confirma la transacción.
+
+    Returns:
+        ResultadoEncolado
+    """
+    omitidos = EN_CURSO if reenviar else EN_CURSO + ('enviado',)
+    repetida = exists().where(EnvioFactura.factura_id == Factura.id, EnvioFactura.estado.in_(omitidos))
+    filas = db.session.execute(
+        select(Factura.id, Cliente.email, repetida).join(Cliente, Factura.cliente_id == Cliente.id)
+        .where(*condiciones)
+    ).all()
+
+    nuevos, sin_email, repetidas = [], 0, 0
+    ahora = datetime.utcnow()
+    for factura_id, email, ya_enviada in filas:
+        email = email_valido(email)
+        if ya_enviada:
+            repetidas += 1
+        elif not email:
+            sin_email += 1
+        else:
+            nuevos.append({'factura_id': factura_id, 'destinatario': email, 'estado': 'pendiente',
+                           'intentos': 0, 'proximo_intento': ahora, 'creado_en': ahora})
+    if nuevos:
+        db.session.execute(insert(EnvioFactura), nuevos)
+    return ResultadoEncolado(len(nuevos), sin_email, repetidas)
+
+
+def estado_facturas(inicio, fin):
+    """Facturas emitidas entre `inicio` y `fin` con el último envío de cada una"""
+    ultimo = (select(func.max(EnvioFactura.id).label('id')).group_by(EnvioFactura.factura_id)
+              .join(Factura, EnvioFactura.factura_id == Factura.id)
+              .where(Factura.fecha >= inicio, Factura.fecha < fin).subquery())
+    envio = (select(EnvioFactura).join(ultimo, EnvioFactura.id == ultimo.c.id).subquery())
+    filas = db.session.execute(
+        select(Factura.id, Factura.numero_factura, Factura.fecha, Cliente.nombre, Cliente.email, Factura.total,
+               envio.c.estado, envio.c.intentos, envio.c.enviado_en, envio.c.error)
+        .join(Cliente, Factura.cliente_id == Cliente.id)
+        .outerjoin(envio, envio.c.factura_id == Factura.id)
+        .where(Factura.fecha >= inicio, Factura.fecha < fin)
+        .order_by(Factura.fecha, Factura.id)
+    )
+    return [FilaEnvioFactura(*fila) for fila in filas]
+
+
+def envios_de_factura(factura_id):
+    return db.session.execute(
+        select(EnvioFactura).where(EnvioFactura.factura_id == factura_id).order_by(EnvioFactura.id.desc())
+    ).scalars().all()
+
+
+class Limitador:
+    """Reparte los envíos para no pasar de `por_minuto` mensajes por minuto (0: sin límite)."""
+
+    def __init__(self, por_minuto):
+        self.intervalo = 60.0 / por_minuto if por_minuto else 0.0
+        self._siguiente = 0.0
+        self._lock = threading.Lock()
+
+    def esperar(self):
+        if not self.intervalo:
+            return
+        with self._lock:
+            ahora = time.monotonic()
+            turno = max(ahora, self._siguiente)
+            self._siguiente = turno + self.intervalo
+        if turno > ahora:
+            time.sleep(turno - ahora)
+
+
+class _Conexion:
+    def __init__(self, smtp):
+        self.smtp = smtp
+        self.mensajes = 0
+        self.ultimo_uso = time.monotonic()
+
+
+class PoolSMTP:
+    """Conexiones SMTP abiertas que se reutilizan entre mensajes; seguro entre hilos."""
+
+    def __init__(self, servidor, puerto=25, usuario=None, clave=None, cifrado='', conexiones=2,
+                 mensajes_por_conexion=100, timeout=30.0, inactividad=30.0, metricas=None):
+        """
+        `cifrado` es '' (sin cifrar), 'starttls' o 'ssl'. Las conexiones que llevan
+        más de `inactividad` segundos sin usarse se comprueban con NOOP antes de
+        reutilizarlas (los servidores cierran las sesiones ociosas).
+        """
+        self.servidor = servidor
+        self.puerto = puerto
+        self.usuario = usuario
+        self.clave = clave
+        self.cifrado = cifrado
+        self.mensajes_por_conexion = mensajes_por_conexion
+        self.timeout = timeout
+        self.inactividad = inactividad
+        self.metricas = metricas
+        self._libres = []
+        self._huecos = threading.BoundedSemaphore(conexiones)
+        self._lock = threading.Lock()
+
+    def _abrir(self):
+        clase = smtplib.SMTP_SSL if self.cifrado == 'ssl' else smtplib.SMTP
+        smtp = clase(self.servidor, self.puerto, timeout=self.timeout)
+        try:
+            if self.cifrado == 'starttls':
+                smtp.starttls()
+            if self.usuario:
+                smtp.login(self.usuario, self.clave or '')
+        except Exception:
+            smtp.close()
+            raise
+        if self.metricas:
+            self.metricas.incrementar('taller_correo_conexiones_total')
+        return _Conexion(smtp)
+
+    @staticmethod
+    def _cerrar(conexion):
+        try:
+            conexion.smtp.quit()
+        except OSError:
+            conexion.smtp.close()
+
+    def _libre(self):
+        """Conexión ociosa que sigue viva, o None"""
+        while True:
+            with self._lock:
+                if not self._libres:
+                    return None
+                conexion = self._libres.pop()
+            if time.monotonic() - conexion.ultimo_uso < self.inactividad:
+                return conexion
+            try:
+                if conexion.smtp.noop()[0] == 250:
+                    return conexion
+            except OSError:
+                pass
+            conexion.smtp.close()
+
+    def _devolver(self, conexion):
+        conexion.ultimo_uso = time.monotonic()
+        if conexion.smtp.sock is None:
+            return
+        if conexion.mensajes >= self.mensajes_por_conexion:
+            self._cerrar(conexion)
+            return
+        with self._lock:
+            self._libres.append(conexion)
+
+    def enviar(self, mensaje):
+        """
+        Entrega `mensaje` por una conexión del pool. Si una conexión reutilizada
+        resulta estar cerrada (o el servidor responde 421 y la cierra), se repite
+        una vez con una conexión nueva. Las excepciones de smtplib se propagan.
+        """
+        with self._huecos:
+            conexion = self._libre()
+            reutilizada = conexion is not None
+            while True:
+                if conexion is None:
+                    conexion = self._abrir()
+                try:
+                    conexion.mensajes += 1
+                    conexion.smtp.send_message(mensaje)
+                    return
+                except OSError as e:
+                    # SMTPException hereda de OSError: los OSError que no son de smtplib son fallos del socket
+                    cerrada = (isinstance(e, smtplib.SMTPServerDisconnected) or conexion.smtp.sock is None
+                               or not isinstance(e, smtplib.SMTPException))
+                    if not (reutilizada and cerrada):
+                        raise
+                    conexion.smtp.close()
+                    conexion, reutilizada = None, False
+                finally:
+                    if conexion is not None:
+                        self._devolver(conexion)
+
+    def cerrar(self):
+        with self._lock:
+            libres, self._libres = self._libres, []
+        for conexion in libres:
+            self._cerrar(conexion)
+
+
+def es_definitivo(error):
+    """Rechazo 5xx del servidor: reintentar no servirá de nada"""
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(codigo >= 500 for codigo, _ in error.recipients.values())
+    return isinstance(error, smtplib.SMTPResponseException) and error.smtp_code >= 500
+
+
+class TrabajadorCorreo:
+    """Procesa la cola de envíos de facturas del taller activo por lotes."""
+
+    def __init__(self, pool, remitente, generar_pdf, limitador=None, hilos=2, lote=50, max_intentos=5,
+                 reintento=60.0, metricas=None):
+        """
+        `generar_pdf(factura)` devuelve el PDF (un BytesIO). `reintento` son los
+        segundos de espera tras el primer fallo temporal; se duplican en cada intento.
+        """
+        self.pool = pool
+        self.remitente = remitente
+        self.generar_pdf = generar_pdf
+        self.limitador = limitador or Limitador(0)
+        self.lote = lote
+        self.max_intentos = max_intentos
+        self.reintento = reintento
+        self.metricas = metricas
+        self._hilos = ThreadPoolExecutor(max_workers=hilos, thread_name_prefix='correo')
+
+    def _plazo(self):
+        """Tiempo que se reserva un lote: el que tardaría a ritmo del limitador, con holgura"""
+        return timedelta(seconds=600 + 2 * self.lote * self.limitador.intervalo)
+
+    def reclamar(self):
+        """Pasa a "enviando" hasta un lote de envíos listos y confirma. Devuelve sus ids."""
+        ahora = datetime.utcnow()
+        listos = (select(_envios.c.id)
+                  .where(or_(_envios.c.estado == 'pendiente', _envios.c.estado == 'enviando'),
+                         _envios.c.proximo_intento <= ahora)
+                  .order_by(_envios.c.proximo_intento, _envios.c.id).limit(self.lote))
+        ids = db.session.execute(
+            update(_envios).where(_envios.c.id.in_(listos.scalar_subquery()))
+            .values(estado='enviando', intentos=_envios.c.intentos + 1, proximo_intento=ahora + self._plazo())
+            .returning(_envios.c.id)
+        ).scalars().all()
+        db.session.commit()
+        return ids
+
+    def componer(self, envio, pdf):
+        factura = envio.factura
+        mensaje = EmailMessage()
+        mensaje['Subject'] = f'Factura {factura.numero_factura}'
+        mensaje['From'] = self.remitente
+        mensaje['To'] = envio.destinatario
+        mensaje['Date'] = formatdate(localtime=True)
+        mensaje['Message-ID'] = make_msgid(f'factura{factura.id}.envio{envio.id}')
+        mensaje.set_content(render_template('correo/factura.txt', factura=factura))
+        mensaje.add_attachment(pdf, maintype='application', subtype='pdf',
+                               filename=f"factura_{factura.numero_factura.replace('/', '_')}.pdf")
+        return mensaje
+
+    def _entregar(self, mensaje):
+        self.limitador.esperar()
+        inicio = time.perf_counter()
+        self.pool.enviar(mensaje)
+        if self.metricas:
+            self.metricas.observar('taller_correo_envio_segundos', time.perf_counter() - inicio)
+
+    def procesar_lote(self):
+        """
+        Reclama, envía y anota un lote.
+
+        Returns:
+            dict: Envíos del lote por resultado (enviado, reintento, error)
+        """
+        ids = self.reclamar()
+        if not ids:
+            return {}
+        envios = db.session.execute(
+            select(EnvioFactura).where(EnvioFactura.id.in_(ids)).order_by(EnvioFactura.id)
+            .options(joinedload(EnvioFactura.factura).joinedload(Factura.cliente),
+                     joinedload(EnvioFactura.factura).selectinload(Factura.intervenciones)
+                     .joinedload(Intervencion.coche))
+        ).scalars().all()
+
+        # El PDF se genera aquí (usa la sesión); los hilos solo hablan con el servidor
+        pendientes = []
+        for envio in envios:
+            try:
+                mensaje = self.componer(envio, self.generar_pdf(envio.factura).getvalue())
+            except Exception as e:
+                pendientes.append((envio, None, e))
+                continue
+            pendientes.append((envio, self._hilos.submit(self._entregar, mensaje), None))
+
+        resultados = {}
+        ahora = datetime.utcnow()
+        for envio, futuro, error in pendientes:
+            if futuro is not None:
+                try:
+                    futuro.result()
+                except Exception as e:
+                    error = e
+            if error is None:
+                resultado = 'enviado'
+                envio.estado, envio.enviado_en, envio.error = 'enviado', ahora, None
+            elif es_definitivo(error) or envio.intentos >= self.max_intentos:
+                resultado = 'error'
+                envio.estado, envio.error = 'error', f'{type(error).__name__}: {error}'
+            else:
+                resultado = 'reintento'
+                envio.estado, envio.error = 'pendiente', f'{type(error).__name__}: {error}'
+                envio.proximo_intento = ahora + timedelta(seconds=self.reintento * 2 ** (envio.intentos - 1))
+            resultados[resultado] = resultados.get(resultado, 0) + 1
+            if self.metricas:
+                self.metricas.incrementar('taller_correo_envios_total', resultado=resultado)
+        db.session.commit()
+        return resultados
+
+    def cerrar(self):
+        self._hilos.shutdown()
+        self.pool.cerrar()
@@ -0,0 +1,83 @@
+"""
+Importes monetarios.
+
+En la base de datos se guardan como enteros (céntimos), de modo que SUM() en SQL
+es exacto; en Python se trabaja con Decimal redondeado a céntimos.
+"""
+from decimal import Decimal, ROUND_HALF_UP, InvalidOperation
+
+from sqlalchemy.types import Integer, TypeDecorator
+
+CENTIMO = Decimal('0.01')
+CERO = Decimal('0.00')
+
+
+def a_decimal(valor):
+    """
+    Convierte un importe (Decimal, int, float o texto con coma o punto) a Decimal
+    redondeado a céntimos. Los valores vacíos se convierten en 0.
+    """
+    if valor is None:
+        return CERO
+    if isinstance(valor, str):
+        valor = valor.strip().replace(',', '.')
+        if not valor:
+            return CERO
+    elif isinstance(valor, float):
+        # repr() da el decimal más corto que representa el float (0.1 -> '0.1')
+        valor = repr(valor)
+    try:
+        importe = Decimal(valor).quantize(CENTIMO, rounding=ROUND_HALF_UP)
+    except InvalidOperation:
+        raise ValueError(f'Importe no válido: {valor}')
+    # quantize() deja pasar NaN sin error
+    if not importe.is_finite():
+        raise ValueError(f'Importe no válido: {valor}')
+    return importe
+
+
+def porcentaje(base, tanto_por_ciento):
+    """Aplica un porcentaje a una base y redondea a céntimos"""
+    return (base * a_decimal(tanto_por_ciento) / 100).quantize(CENTIMO, rounding=ROUND_HALF_UP)
+
+
+class Dinero(TypeDecorator):
+    """Columna de importe: entero en céntimos en la base de datos, Decimal en Python"""
+    impl = Integer
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return int(a_decimal(value) * 100)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        # round() por si la columna aún conserva afinidad REAL (valores 1234.0)
+        return (Decimal(int(round(value))) / 100).quantize(CENTIMO)
+
+
+def calcular_totales(importes, descuento_porcentaje=0, iva_porcentaje=21):
+    """
+    Calcula los totales de una factura a partir de los importes de sus líneas.
+    Es el único sitio donde se calculan descuento, IVA y total.
+
+    Args:
+        importes: Importes de las líneas (Decimal, float o texto)
+        descuento_porcentaje: Porcentaje de descuento sobre la base imponible
+        iva_porcentaje: Porcentaje de IVA sobre la base después del descuento
+
+    Returns:
+        dict: base_imponible, descuento_importe, iva_importe y total (Decimal)
+    """
+    base_imponible = sum((a_decimal(importe) for importe in importes), CERO)
+    descuento_importe = porcentaje(base_imponible, descuento_porcentaje or 0)
+    base_despues_descuento = base_imponible - descuento_importe
+    iva_importe = porcentaje(base_despues_descuento, iva_porcentaje or 0)
+    return {
+        'base_imponible': base_imponible,
+        'descuento_importe': descuento_importe,
+        'iva_importe': iva_importe,
+        'total': base_despues_descuento + iva_importe,
+    }
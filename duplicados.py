@@ -0,0 +1,188 @@
+"""
+Clientes duplicados: búsqueda de candidatos y fusión.
+
+Cada cliente guarda dos claves normalizadas e indexadas, que se calculan al
+guardarlo con el ORM:
+    - `clave_dni`: el DNI en mayúsculas y sin espacios, puntos ni guiones
+      ("12.345.678-a" y "12345678A" dan la misma clave);
+    - `clave_nombre`: el nombre en minúsculas, sin tildes ni signos y con las
+      palabras ordenadas ("López García, Juan" y "juan lopez garcia" coinciden).
+Los candidatos son los clientes que comparten alguna de las dos claves; se buscan
+con un GROUP BY sobre los índices, sin comparar los clientes entre sí.
+
+`fusionar()` pasa al cliente que se conserva los vehículos, intervenciones y
+facturas de los duplicados con un UPDATE por tabla, en una sola transacción, y
+después borra los duplicados. Las actualizaciones masivas no disparan los eventos
+del ORM, así que la propia fusión anota el registro de cambios, marca updated_at
+(sincronización de las tablets), incrementa las versiones (ediciones abiertas) y
+recalcula los saldos; la caché de fragmentos se invalida al confirmar.
+"""
+import re
+import unicodedata
+from collections import namedtuple
+from datetime import datetime
+
+from sqlalchemy import bindparam, event, func, select, update
+
+import cambios
+import saldos
+from models import db, Cliente, Coche, Intervencion, Factura
+
+CandidatoDuplicado = namedtuple('CandidatoDuplicado', 'id nombre dni telefono poblacion fecha_registro '
+                                                      'coches intervenciones facturas')
+
+# Tablas que apuntan a clientes y se trasladan al fusionar
+TABLAS_CLIENTE = (Coche.__table__, Intervencion.__table__, Factura.__table__)
+# Datos de contacto que el cliente conservado toma de los duplicados si no los tiene
+CAMPOS_CONTACTO = ('dni', 'telefono', 'email', 'direccion', 'codigo_postal', 'poblacion', 'provincia')
+
+_clientes = Cliente.__table__
+
+
+def clave_nombre(nombre):
+    texto = unicodedata.normalize('NFKD', nombre or '').lower()
+    texto = ''.join(c for c in texto if not unicodedata.combining(c))
+    return ' '.join(sorted(re.findall(r'[a-z0-9]+', texto))) or None
+
+
+def clave_dni(dni):
+    return re.sub(r'[^0-9A-Z]', '', (dni or '').upper()) or None
+
+
+def registrar_eventos_claves():
+    """Calcula las claves normalizadas de cada cliente al insertarlo o modificarlo"""
+    def asignar(mapper, connection, target):
+        target.clave_nombre = clave_nombre(target.nombre)
+        target.clave_dni = clave_dni(target.dni)
+
+    event.listen(Cliente, 'before_insert', asignar)
+    event.listen(Cliente, 'before_update', asignar)
+
+
+def rellenar_claves(connection):
+    """Calcula las claves de los clientes que no las tienen (datos anteriores o insertados sin el ORM)"""
+    filas = connection.execute(select(_clientes.c.id, _clientes.c.nombre, _clientes.c.dni)
+                               .where(_clientes.c.clave_nombre.is_(None))).all()
+    if filas:
+        connection.execute(
+            update(_clientes).where(_clientes.c.id == bindparam('_id'))
+            .values(clave_nombre=bindparam('_nombre'), clave_dni=bindparam('_dni')),
+            [{'_id': id, '_nombre': clave_nombre(nombre), '_dni': clave_dni(dni)} for id, nombre, dni in filas]
+        )
+    return len(filas)
+
+
+def _contar(tabla, ids):
+    return dict(db.session.execute(
+        select(tabla.c.cliente_id, func.count()).where(tabla.c.cliente_id.in_(ids)).group_by(tabla.c.cliente_id)
+    ).all())
+
+
+def candidatos(limite=200):
+    """
+    Grupos de clientes que comparten DNI o nombre normalizados, con cuántos
+    vehículos, intervenciones y facturas tiene cada uno. Los grupos que comparten
+    algún cliente se unen (A y B con el mismo DNI, B y C con el mismo nombre).
+
+    Returns:
+        list[list[CandidatoDuplicado]]: el cliente más antiguo primero en cada grupo
+    """
+    padres = {}
+
+    def raiz(id):
+        while padres.setdefault(id, id) != id:
+            padres[id] = padres[padres[id]]
+            id = padres[id]
+        return id
+
+    for columna in (_clientes.c.clave_dni, _clientes.c.clave_nombre):
+        repetidas = select(columna).where(columna.isnot(None)).group_by(columna).having(func.count() > 1)
+        filas = db.session.execute(
+            select(columna, _clientes.c.id).where(columna.in_(repetidas)).order_by(columna, _clientes.c.id)
+        ).all()
+        primero = {}
+        for clave, id in filas:
+            padres[raiz(id)] = raiz(primero.setdefault(clave, id))
+
+    grupos = {}
+    for id in padres:
+        grupos.setdefault(raiz(id), []).append(id)
+    grupos = sorted((sorted(ids) for ids in grupos.values()), key=lambda ids: ids[0])[:limite]
+    if not grupos:
+        return []
+
+    ids = [id for grupo in grupos for id in grupo]
+    recuentos = [_contar(tabla, ids) for tabla in TABLAS_CLIENTE]
+    clientes = {
+        fila.id: fila for fila in db.session.execute(
+            select(Cliente.id, Cliente.nombre, Cliente.dni, Cliente.telefono, Cliente.poblacion,
+                   Cliente.fecha_registro).where(Cliente.id.in_(ids)))
+    }
+    return [
+        [CandidatoDuplicado(*clientes[id], *(recuento.get(id, 0) for recuento in recuentos)) for id in grupo]
+        for grupo in grupos
+    ]
+
+
+def fusionar(destino_id, duplicado_ids):
+    """
+    Fusiona los duplicados en el cliente `destino_id` dentro de la transacción de
+    `db.session` (la confirma quien llama). Lanza ValueError si algún cliente no existe.
+
+    Returns:
+        dict: Filas trasladadas por tabla
+    """
+    duplicado_ids = sorted(set(duplicado_ids) - {destino_id})
+    if not duplicado_ids:
+        raise ValueError('No hay clientes que fusionar')
+    conexion = db.session.connection()
+    marca = datetime.utcnow()
+
+    # Primera escritura: toma el bloqueo de escritura de SQLite, así que las lecturas
+    # siguientes ya no pueden cambiar antes del commit. La nueva versión hace que los
+    # formularios de edición abiertos de estos clientes den conflicto.
+    afectados = conexion.execute(
+        update(_clientes).where(_clientes.c.id.in_([destino_id, *duplicado_ids]))
+        .values(version=_clientes.c.version + 1)
+    ).rowcount
+    if afectados != len(duplicado_ids) + 1:
+        raise ValueError('Alguno de los clientes ya no existe')
+
+    trasladadas = {}
+    for tabla in TABLAS_CLIENTE:
+        valores = {'cliente_id': destino_id, 'updated_at': marca}
+        if 'version' in tabla.c:
+            valores['version'] = tabla.c.version + 1
+        filas = conexion.execute(select(tabla).where(tabla.c.cliente_id.in_(duplicado_ids))).mappings().all()
+        if not filas:
+            continue
+        conexion.execute(update(tabla).where(tabla.c.cliente_id.in_(duplicado_ids)).values(valores))
+        cambios.anotar_cambios(conexion, tabla.name, 'update', [
+            {**fila, 'cliente_id': destino_id, 'updated_at': marca,
+             **({'version': fila['version'] + 1} if 'version' in fila else {})}
+            for fila in filas
+        ])
+        trasladadas[tabla.name] = len(filas)
+
+    # Los objetos de la sesión no han visto los UPDATE
+    db.session.expire_all()
+    destino = db.session.get(Cliente, destino_id)
+    duplicados = db.session.execute(select(Cliente).where(Cliente.id.in_(duplicado_ids))
+                                    .order_by(Cliente.id)).scalars().all()
+    contacto = {}
+    for duplicado in duplicados:
+        for campo in CAMPOS_CONTACTO:
+            if not getattr(destino, campo) and getattr(duplicado, campo):
+                contacto.setdefault(campo, getattr(duplicado, campo))
+        # Borrado con el ORM: anota la baja para las tablets y el registro de cambios
+        db.session.delete(duplicado)
+    # El DNI es único: primero se borran los duplicados y después se copia
+    db.session.flush()
+    for campo, valor in contacto.items():
+        setattr(destino, campo, valor)
+
+    saldos.recalcular(conexion, [destino_id])
+    db.session.flush()
+    db.session.expire(destino)
+    return trasladadas
+
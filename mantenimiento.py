@@ -0,0 +1,234 @@
+"""
+Previsión de mantenimientos a partir del historial de intervenciones.
+
+Para cada vehículo se estiman los km que recorre al día (regresión lineal sobre
+sus últimas lecturas de km) y, para cada tipo de servicio reconocido en las
+descripciones (cambio de aceite, ITV, correa de distribución...), se calcula la
+fecha del próximo: la primera entre "última vez + intervalo de tiempo" y "día
+en que se alcanzarán los km de la última vez + intervalo de km".
+
+Los resultados se guardan en la tabla `vencimientos`, indexada por fecha, de modo
+que "qué vence este mes" es una consulta por rango. La tabla se mantiene de forma
+incremental: los eventos de Intervencion y Coche anotan en la sesión qué vehículos
+han cambiado y, justo antes del commit, se recalculan solo esos vehículos dentro
+de la misma transacción.
+"""
+import re
+import unicodedata
+from collections import namedtuple
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import delete, event, select
+from sqlalchemy.orm import Session, object_session
+
+from models import db, Cliente, Coche, Intervencion, Vencimiento
+
+# Lecturas de km que se usan para estimar el ritmo de uso
+LECTURAS_RITMO = 12
+# Mínimo de días entre la primera y la última lectura para fiarse de la estimación
+DIAS_MINIMOS_RITMO = 30
+# Con ritmos muy bajos la fecha por km puede quedar a siglos vista (o siglos atrás) y salirse de datetime
+HORIZONTE_DIAS = 50 * 365
+
+Servicio = namedtuple('Servicio', 'tipo nombre patron intervalo_km intervalo_meses')
+
+
+def _meses_itv(coche, fecha):
+    """Periodicidad de la ITV de turismos: cada 2 años hasta los 10 de antigüedad, después anual"""
+    if coche.año and fecha.year - coche.año < 10:
+        return 24
+    return 12
+
+
+SERVICIOS = [
+    Servicio('aceite', 'Cambio de aceite', re.compile(r'\baceite\b'), 15000, 12),
+    Servicio('itv', 'ITV', re.compile(r'\bitv\b'), None, _meses_itv),
+    Servicio('distribucion', 'Correa de distribución', re.compile(r'\bdistribucion\b'), 120000, 72),
+    Servicio('frenos', 'Pastillas de freno', re.compile(r'\bpastillas\b|\bfrenos?\b'), 40000, None),
+    Servicio('neumaticos', 'Neumáticos', re.compile(r'\bneumaticos?\b|\bruedas\b'), 40000, 60),
+    Servicio('aire_acondicionado', 'Revisión de aire acondicionado', re.compile(r'\baire acondicionado\b|\bclimatizacion\b'), None, 24),
+]
+NOMBRES_SERVICIOS = {servicio.tipo: servicio.nombre for servicio in SERVICIOS}
+
+
+def normalizar(texto):
+    """Minúsculas y sin tildes, para buscar los servicios en las descripciones"""
+    texto = unicodedata.normalize('NFKD', texto or '').lower()
+    return ''.join(c for c in texto if not unicodedata.combining(c))
+
+
+def sumar_meses(fecha, meses):
+    """Suma meses ajustando el día al último del mes; se queda en date.min/date.max si se sale del calendario"""
+    mes = fecha.month - 1 + meses
+    año = fecha.year + mes // 12
+    mes = mes % 12 + 1
+    if año > date.max.year:
+        return date.max
+    if año < date.min.year:
+        return date.min
+    dias_mes = [31, 29 if año % 4 == 0 and (año % 100 != 0 or año % 400 == 0) else 28,
+                31, 30, 31, 30, 31, 31, 30, 31, 30, 31][mes - 1]
+    return date(año, mes, min(fecha.day, dias_mes))
+
+
+def estimar_km_diarios(lecturas):
+    """
+    Km por día según una regresión lineal de las lecturas (fecha, km), o None si
+    no hay suficientes lecturas o no cubren DIAS_MINIMOS_RITMO.
+    """
+    lecturas = sorted((fecha, km) for fecha, km in lecturas if km is not None)[-LECTURAS_RITMO:]
+    if len(lecturas) < 2:
+        return None
+    origen = lecturas[0][0]
+    dias = [(fecha - origen).total_seconds() / 86400 for fecha, _ in lecturas]
+    if dias[-1] < DIAS_MINIMOS_RITMO:
+        return None
+    kms = [km for _, km in lecturas]
+    media_dias = sum(dias) / len(dias)
+    media_km = sum(kms) / len(kms)
+    varianza = sum((d - media_dias) ** 2 for d in dias)
+    pendiente = sum((d - media_dias) * (k - media_km) for d, k in zip(dias, kms)) / varianza
+    return pendiente if pendiente > 0 else None
+
+
+def calcular_vencimientos(coche, intervenciones):
+    """
+    Próximos mantenimientos de un vehículo.
+
+    Args:
+        coche: Objeto Coche
+        intervenciones: Tuplas (fecha, km, descripcion) de sus intervenciones
+
+    Returns:
+        list[dict]: Una entrada por tipo de servicio con historial
+    """
+    km_diarios = estimar_km_diarios((fecha, km) for fecha, km, _ in intervenciones)
+    lecturas = [(fecha, km) for fecha, km, _ in intervenciones if km is not None]
+    referencia = max(lecturas) if lecturas else None
+
+    ultimos = {}
+    for fecha, km, descripcion in intervenciones:
+        texto = normalizar(descripcion)
+        for servicio in SERVICIOS:
+            if servicio.patron.search(texto) and (servicio.tipo not in ultimos or fecha > ultimos[servicio.tipo][0]):
+                ultimos[servicio.tipo] = (fecha, km)
+
+    vencimientos = []
+    for servicio in SERVICIOS:
+        if servicio.tipo not in ultimos:
+            continue
+        ultima_fecha, ultimo_km = ultimos[servicio.tipo]
+        candidatas = []
+        if servicio.intervalo_meses:
+            meses = servicio.intervalo_meses
+            if callable(meses):
+                meses = meses(coche, ultima_fecha)
+            candidatas.append(sumar_meses(ultima_fecha.date(), meses))
+        km_previstos = None
+        if servicio.intervalo_km and ultimo_km is not None:
+            km_previstos = ultimo_km + servicio.intervalo_km
+            if km_diarios and referencia:
+                fecha_ref, km_ref = referencia
+                dias = (km_previstos - km_ref) / km_diarios
+                if abs(dias) <= HORIZONTE_DIAS:
+                    candidatas.append((fecha_ref + timedelta(days=dias)).date())
+                elif dias < 0:
+                    # Con un uso casi nulo y los km ya superados, la fecha estimada saldría
+                    # de los límites de datetime: vencido como muy tarde en la última lectura
+                    candidatas.append(fecha_ref.date())
+        if not candidatas:
+            continue
+        vencimientos.append({
+            'coche_id': coche.id,
+            'tipo': servicio.tipo,
+            'fecha_prevista': min(candidatas),
+            'km_previstos': km_previstos,
+            'ultima_fecha': ultima_fecha,
+            'ultimo_km': ultimo_km,
+            'km_diarios': round(km_diarios, 1) if km_diarios else None,
+            'calculado_en': datetime.utcnow(),
+        })
+    return vencimientos
+
+
+def recalcular(sesion, coche_ids):
+    """Sustituye los vencimientos de los vehículos indicados (en la transacción de `sesion`)"""
+    coche_ids = list(coche_ids)
+    if not coche_ids:
+        return
+    sesion.execute(delete(Vencimiento).where(Vencimiento.coche_id.in_(coche_ids)))
+    historial = {}
+    for coche_id, fecha, km, descripcion in sesion.execute(
+        select(Intervencion.coche_id, Intervencion.fecha, Intervencion.km, Intervencion.descripcion)
+        .where(Intervencion.coche_id.in_(coche_ids))
+    ):
+        historial.setdefault(coche_id, []).append((fecha, km, descripcion))
+    filas = []
+    for coche in sesion.execute(select(Coche).where(Coche.id.in_(coche_ids))).scalars():
+        filas.extend(calcular_vencimientos(coche, historial.get(coche.id, [])))
+    if filas:
+        sesion.execute(Vencimiento.__table__.insert(), filas)
+
+
+def recalcular_todos(sesion, lote=500):
+    """Reconstruye la tabla de vencimientos completa, por lotes de vehículos"""
+    sesion.execute(delete(Vencimiento))
+    coche_ids = sesion.execute(select(Coche.id).order_by(Coche.id)).scalars().all()
+    for inicio in range(0, len(coche_ids), lote):
+        recalcular(sesion, coche_ids[inicio:inicio + lote])
+    return len(coche_ids)
+
+
+def registrar_eventos_vencimientos():
+    """Recalcula, antes de cada commit, los vencimientos de los vehículos modificados"""
+    def marcar(sesion, *coche_ids):
+        sesion.info.setdefault('coches_vencimientos', set()).update(c for c in coche_ids if c is not None)
+
+    def intervencion_modificada(mapper, connection, target):
+        sesion = object_session(target)
+        if sesion is None:
+            return
+        historial = db.inspect(target).attrs.coche_id.history
+        marcar(sesion, target.coche_id, *(historial.deleted or ()))
+
+    def coche_modificado(mapper, connection, target):
+        sesion = object_session(target)
+        if sesion is not None:
+            marcar(sesion, target.id)
+
+    for evento in ('after_insert', 'after_update', 'after_delete'):
+        event.listen(Intervencion, evento, intervencion_modificada)
+        event.listen(Coche, evento, coche_modificado)
+
+    @event.listens_for(Session, 'before_commit')
+    def recalcular_antes_de_commit(sesion):
+        if not sesion.info.get('coches_vencimientos') and not (sesion.new or sesion.dirty or sesion.deleted):
+            return
+        # Vaciar primero lo pendiente para que sus eventos marquen los vehículos y el cálculo lo vea
+        sesion.flush()
+        coche_ids = sesion.info.pop('coches_vencimientos', None)
+        if coche_ids:
+            recalcular(sesion, coche_ids)
+
+    @event.listens_for(Session, 'after_rollback')
+    def descartar_tras_rollback(sesion):
+        sesion.info.pop('coches_vencimientos', None)
+
+
+def vencimientos_entre(desde, hasta):
+    """
+    Vencimientos con fecha prevista en [desde, hasta), con matrícula y cliente.
+    Es una consulta por rango sobre el índice de fecha_prevista; `desde` None no pone límite inferior.
+    """
+    consulta = (
+        select(Vencimiento.tipo, Vencimiento.fecha_prevista, Vencimiento.km_previstos, Vencimiento.ultima_fecha,
+               Vencimiento.ultimo_km, Vencimiento.km_diarios, Coche.id.label('coche_id'), Coche.matricula,
+               Coche.marca, Coche.modelo, Cliente.nombre.label('cliente_nombre'), Cliente.telefono)
+        .join(Coche, Vencimiento.coche_id == Coche.id)
+        .outerjoin(Cliente, Coche.cliente_id == Cliente.id)
+        .where(Vencimiento.fecha_prevista < hasta)
+        .order_by(Vencimiento.fecha_prevista, Coche.matricula)
+    )
+    if desde is not None:
+        consulta = consulta.where(Vencimiento.fecha_prevista >= desde)
+    return db.session.execute(consulta).all()
@@ -0,0 +1,258 @@
+"""
+Métricas en formato de texto de Prometheus.
+
+Los contadores, histogramas e indicadores se acumulan en memoria (un dict y un
+lock por proceso, sin E/S en el camino de cada petición). Si se configura un
+directorio compartido, cada proceso vuelca periódicamente su estado a un fichero
+JSON propio y el endpoint /metrics suma los ficheros de todos los workers:
+
+    - contadores e histogramas se suman (incluidos los de workers ya terminados,
+      para que los totales no retrocedan al reciclar procesos);
+    - los indicadores (gauges) se suman solo para los procesos vivos.
+
+Al exportar, los ficheros de procesos ya terminados se pliegan en uno solo
+(`terminados.json`, con sus contadores e histogramas) y se borran, para que el
+directorio y el coste de cada /metrics no crezcan al reciclar workers. El
+plegado lo hace un único proceso a la vez (bloqueo exclusivo sobre `.bloqueo`)
+mientras los demás leen con bloqueo compartido, y `terminados.json` anota qué
+ficheros incluye, de modo que uno ya plegado no se cuenta dos veces aunque el
+proceso se interrumpa antes de borrarlo.
+"""
+import atexit
+import bisect
+import fcntl
+import json
+import os
+import tempfile
+import threading
+import time
+
+BUCKETS_SEGUNDOS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BUCKETS_BYTES = (4096, 16384, 32768, 65536, 131072, 262144, 524288, 1048576)
+TERMINADOS = 'terminados.json'
+
+
+class Metricas:
+    """Registro de métricas de un proceso."""
+
+    def __init__(self, directorio=None, intervalo_volcado=5.0):
+        self.directorio = directorio
+        self.intervalo_volcado = intervalo_volcado
+        self._definiciones = {}  # nombre -> (tipo, ayuda, buckets)
+        self._valores = {}       # (nombre, etiquetas) -> float | [buckets..., suma, cuenta]
+        self._lock = threading.Lock()
+        self._ultimo_volcado = 0.0
+        self._fichero = None
+        if directorio:
+            self.usar_directorio(directorio)
+
+    def usar_directorio(self, directorio):
+        """Empieza a volcar en `directorio`; se llama antes de crear los workers."""
+        if not self.directorio:
+            atexit.register(self.volcar)
+        self.directorio = directorio
+        self._fichero = None
+        os.makedirs(directorio, exist_ok=True)
+
+    # ----- Definición -----
+
+    def contador(self, nombre, ayuda):
+        self._definiciones[nombre] = ('counter', ayuda, None)
+
+    def indicador(self, nombre, ayuda):
+        self._definiciones[nombre] = ('gauge', ayuda, None)
+
+    def histograma(self, nombre, ayuda, buckets=BUCKETS_SEGUNDOS):
+        self._definiciones[nombre] = ('histogram', ayuda, tuple(buckets))
+
+    # ----- Actualización (camino caliente) -----
+
+    @staticmethod
+    def _clave(nombre, etiquetas):
+        return (nombre, tuple(sorted(etiquetas.items())) if etiquetas else ())
+
+    def incrementar(self, nombre, valor=1, **etiquetas):
+        clave = self._clave(nombre, etiquetas)
+        with self._lock:
+            self._valores[clave] = self._valores.get(clave, 0) + valor
+
+    def fijar(self, nombre, valor, **etiquetas):
+        with self._lock:
+            self._valores[self._clave(nombre, etiquetas)] = valor
+
+    def observar(self, nombre, valor, **etiquetas):
+        buckets = self._definiciones[nombre][2]
+        clave = self._clave(nombre, etiquetas)
+        with self._lock:
+            serie = self._valores.get(clave)
+            if serie is None:
+                # Un hueco por bucket (no acumulado), más +Inf, suma y cuenta
+                serie = self._valores[clave] = [0] * (len(buckets) + 1) + [0.0, 0]
+            serie[bisect.bisect_left(buckets, valor)] += 1
+            serie[-2] += valor
+            serie[-1] += 1
+
+    # ----- Volcado entre procesos -----
+
+    def _ruta_fichero(self):
+        if self._fichero is None:
+            # pid + instante de arranque para no mezclar procesos que reutilizan un pid
+            self._fichero = os.path.join(self.directorio, f'{os.getpid()}-{int(time.time() * 1000)}.json')
+        return self._fichero
+
+    def _instantanea(self):
+        with self._lock:
+            return [[nombre, list(etiquetas), valor if not isinstance(valor, list) else list(valor)]
+                    for (nombre, etiquetas), valor in self._valores.items()]
+
+    def volcar(self):
+        """Escribe el estado del proceso en su fichero del directorio compartido."""
+        if not self.directorio:
+            return
+        datos = {'pid': os.getpid(), 'valores': self._instantanea()}
+        fd, tmp = tempfile.mkstemp(dir=self.directorio, prefix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(datos, f)
+        os.replace(tmp, self._ruta_fichero())
+        self._ultimo_volcado = time.monotonic()
+
+    def tal_vez_volcar(self):
+        """Vuelca el estado si ha pasado el intervalo desde el último volcado."""
+        if self.directorio and time.monotonic() - self._ultimo_volcado >= self.intervalo_volcado:
+            self.volcar()
+
+    def _leer(self, nombre):
+        try:
+            with open(os.path.join(self.directorio, nombre)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _ficheros_procesos(self):
+        """{nombre: datos} de los ficheros por proceso que no están plegados en TERMINADOS"""
+        terminados = self._leer(TERMINADOS) or {'incluidos': []}
+        plegados = set(terminados['incluidos'])
+        ficheros = {}
+        for entrada in os.scandir(self.directorio):
+            nombre = entrada.name
+            if nombre.startswith('.') or not nombre.endswith('.json') or nombre == TERMINADOS or nombre in plegados:
+                continue
+            datos = self._leer(nombre)
+            if datos is not None:
+                ficheros[nombre] = datos
+        return terminados, ficheros
+
+    def _plegar_terminados(self):
+        """Suma los contadores e histogramas de los procesos terminados en TERMINADOS y borra sus ficheros"""
+        terminados, ficheros = self._ficheros_procesos()
+        muertos = [nombre for nombre, datos in ficheros.items() if not _proceso_vivo(datos['pid'])]
+        if not muertos:
+            return
+        agregado = {(nombre, tuple(tuple(e) for e in etiquetas)): valor
+                    for nombre, etiquetas, valor in terminados.get('valores', [])}
+        for fichero in muertos:
+            for nombre, etiquetas, valor in ficheros[fichero]['valores']:
+                definicion = self._definiciones.get(nombre)
+                if definicion is None or definicion[0] == 'gauge':
+                    continue
+                clave = (nombre, tuple(tuple(e) for e in etiquetas))
+                if isinstance(valor, list):
+                    actual = agregado.setdefault(clave, [0] * len(valor))
+                    for i, v in enumerate(valor):
+                        actual[i] += v
+                else:
+                    agregado[clave] = agregado.get(clave, 0) + valor
+        existentes = set(os.listdir(self.directorio))
+        datos = {
+            'pid': None,
+            'incluidos': [n for n in terminados['incluidos'] if n in existentes] + muertos,
+            'valores': [[nombre, [list(e) for e in etiquetas], valor] for (nombre, etiquetas), valor in agregado.items()],
+        }
+        fd, tmp = tempfile.mkstemp(dir=self.directorio, prefix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(datos, f)
+        os.replace(tmp, os.path.join(self.directorio, TERMINADOS))
+        for fichero in muertos:
+            try:
+                os.unlink(os.path.join(self.directorio, fichero))
+            except FileNotFoundError:
+                pass
+
+    def _estados(self):
+        """Estados de todos los procesos: el propio en memoria y el resto desde disco."""
+        if not self.directorio:
+            return [(True, self._instantanea())]
+        self.volcar()
+        with open(os.path.join(self.directorio, '.bloqueo'), 'a') as bloqueo:
+            try:
+                fcntl.flock(bloqueo, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                self._plegar_terminados()
+            except BlockingIOError:
+                # Otro proceso está plegando: se lee cuando termine
+                fcntl.flock(bloqueo, fcntl.LOCK_SH)
+            terminados, ficheros = self._ficheros_procesos()
+        estados = [(False, terminados.get('valores', []))]
+        estados.extend((_proceso_vivo(datos['pid']), datos['valores']) for datos in ficheros.values())
+        return estados
+
+    # ----- Exportación -----
+
+    def exportar(self):
+        """Devuelve todas las métricas agregadas en formato de texto de Prometheus."""
+        agregado = {}
+        for vivo, valores in self._estados():
+            for nombre, etiquetas, valor in valores:
+                definicion = self._definiciones.get(nombre)
+                if definicion is None or (definicion[0] == 'gauge' and not vivo):
+                    continue
+                clave = (nombre, tuple(tuple(e) for e in etiquetas))
+                if isinstance(valor, list):
+                    actual = agregado.setdefault(clave, [0] * len(valor))
+                    for i, v in enumerate(valor):
+                        actual[i] += v
+                else:
+                    agregado[clave] = agregado.get(clave, 0) + valor
+
+        lineas = []
+        for nombre, (tipo, ayuda, buckets) in sorted(self._definiciones.items()):
+            lineas.append(f'# HELP {nombre} {ayuda}')
+            lineas.append(f'# TYPE {nombre} {tipo}')
+            series = sorted((etq, v) for (n, etq), v in agregado.items() if n == nombre)
+            for etiquetas, valor in series:
+                if tipo != 'histogram':
+                    lineas.append(f'{nombre}{_etiquetas(etiquetas)} {_numero(valor)}')
+                    continue
+                acumulado = 0
+                for limite, cuenta in zip(buckets + (float('inf'),), valor):
+                    acumulado += cuenta
+                    le = '+Inf' if limite == float('inf') else _numero(limite)
+                    lineas.append(f'{nombre}_bucket{_etiquetas(etiquetas + (("le", le),))} {acumulado}')
+                lineas.append(f'{nombre}_sum{_etiquetas(etiquetas)} {_numero(valor[-2])}')
+                lineas.append(f'{nombre}_count{_etiquetas(etiquetas)} {valor[-1]}')
+        return '\n'.join(lineas) + '\n'
+
+
+def _proceso_vivo(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
+
+
+def _etiquetas(etiquetas):
+    if not etiquetas:
+        return ''
+    partes = []
+    for clave, valor in etiquetas:
+        valor = str(valor).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        partes.append(f'{clave}="{valor}"')
+    return '{' + ','.join(partes) + '}'
+
+
+def _numero(valor):
+    if isinstance(valor, float) and valor.is_integer():
+        return str(int(valor)) if abs(valor) < 1e15 else repr(valor)
+    return repr(valor) if isinstance(valor, float) else str(valor)
@@ -1,7 +1,8 @@
 from datetime import datetime
-from flask_sqlalchemy import SQLAlchemy
+from talleres import SQLAlchemyTalleres
+from dinero import Dinero
 
-db = SQLAlchemy()
+db = SQLAlchemyTalleres()
 
 class Cliente(db.Model):
     __tablename__ = 'clientes'
@@ -16,9 +17,23 @@ class Cliente(db.Model):
     poblacion = db.Column(db.String(100))
     provincia = db.Column(db.String(100))
     fecha_registro = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
+    # Saldos acumulados; los mantiene saldos.py en la misma transacción que facturas y pagos
+    total_facturado = db.Column(Dinero, nullable=False, default=0)
+    total_pagado = db.Column(Dinero, nullable=False, default=0)
+    # Nombre y DNI normalizados para buscar duplicados; los calcula duplicados.py al guardar
+    clave_nombre = db.Column(db.String(100), index=True)
+    clave_dni = db.Column(db.String(20), index=True)
+    # Control de concurrencia optimista: cada UPDATE exige la versión leída y la incrementa
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+    __mapper_args__ = {'version_id_col': version}
     
     facturas = db.relationship('Factura', backref='cliente', lazy=True)
     
+    @property
+    def pendiente(self):
+        return self.total_facturado - self.total_pagado
+    
     def __repr__(self):
         return f'<Cliente {self.nombre}>'
 
@@ -34,9 +49,14 @@ class Coche(db.Model):
     color = db.Column(db.String(30))
     cliente_id = db.Column(db.Integer, db.ForeignKey('clientes.id'), nullable=True)
     fecha_registro = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
+    # Concurrencia optimista, como en Cliente
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+    __mapper_args__ = {'version_id_col': version}
     
     cliente = db.relationship('Cliente', backref='vehiculos', lazy=True)
     intervenciones = db.relationship('Intervencion', backref='coche', lazy=True, cascade='all, delete-orphan')
+    adjuntos = db.relationship('Adjunto', lazy=True, cascade='all, delete-orphan')
     
     def __repr__(self):
         return f'<Vehiculo {self.matricula}>'
@@ -46,16 +66,21 @@ class Intervencion(db.Model):
     
     id = db.Column(db.Integer, primary_key=True)
     coche_id = db.Column(db.Integer, db.ForeignKey('coches.id'), nullable=False)
-    cliente_id = db.Column(db.Integer, db.ForeignKey('clientes.id'), nullable=True)
+    cliente_id = db.Column(db.Integer, db.ForeignKey('clientes.id'), nullable=True, index=True)
     fecha = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
     km = db.Column(db.Integer, nullable=True)
     descripcion = db.Column(db.Text, nullable=False)
-    precio = db.Column(db.Float, nullable=False, default=0.0)
+    precio = db.Column(Dinero, nullable=False, default=0)
     horas_trabajo = db.Column(db.Float, default=0.0)
     
     factura_id = db.Column(db.Integer, db.ForeignKey('facturas.id'), nullable=True)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
+    # Concurrencia optimista, como en Cliente
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+    __mapper_args__ = {'version_id_col': version}
     
     cliente = db.relationship('Cliente', backref='intervenciones', lazy=True)
+    adjuntos = db.relationship('Adjunto', lazy=True, cascade='all, delete-orphan')
     
     def __repr__(self):
         return f'<Intervencion {self.id} - {self.descripcion[:30]}>'
@@ -64,20 +89,196 @@ class Factura(db.Model):
     __tablename__ = 'facturas'
     
     id = db.Column(db.Integer, primary_key=True)
-    cliente_id = db.Column(db.Integer, db.ForeignKey('clientes.id'), nullable=False)
-    fecha = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    cliente_id = db.Column(db.Integer, db.ForeignKey('clientes.id'), nullable=False, index=True)
+    fecha = db.Column(db.DateTime, default=datetime.utcnow, nullable=False, index=True)
     numero_factura = db.Column(db.String(50), unique=True, nullable=False)
-    base_imponible = db.Column(db.Float, nullable=False, default=0.0)
+    base_imponible = db.Column(Dinero, nullable=False, default=0)
     descuento_porcentaje = db.Column(db.Float, nullable=False, default=0.0)
-    descuento_importe = db.Column(db.Float, nullable=False, default=0.0)
+    descuento_importe = db.Column(Dinero, nullable=False, default=0)
     iva_porcentaje = db.Column(db.Float, nullable=False, default=21.0)  # IVA por defecto 21%
-    iva_importe = db.Column(db.Float, nullable=False, default=0.0)
-    total = db.Column(db.Float, nullable=False, default=0.0)
+    iva_importe = db.Column(Dinero, nullable=False, default=0)
+    total = db.Column(Dinero, nullable=False, default=0)
     enviada_verifactu = db.Column(db.Boolean, default=False)
     fecha_envio_verifactu = db.Column(db.DateTime, nullable=True)
+    # Registro de facturación encadenado de Verifactu; lo calcula verifactu.py al crear la factura
+    emisor_nif = db.Column(db.String(20), index=True)
+    huella = db.Column(db.String(64))
+    huella_anterior = db.Column(db.String(64))
+    registro_generado = db.Column(db.String(30))  # FechaHoraHusoGenRegistro, tal como entra en la huella
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
     
     intervenciones = db.relationship('Intervencion', backref='factura', lazy=True)
+    pagos = db.relationship('Pago', backref='factura', lazy=True, cascade='all, delete-orphan',
+                            order_by='Pago.fecha')
     
     def __repr__(self):
         return f'<Factura {self.numero_factura}>'
 
+class Pago(db.Model):
+    __tablename__ = 'pagos'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    factura_id = db.Column(db.Integer, db.ForeignKey('facturas.id'), nullable=False, index=True)
+    fecha = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    importe = db.Column(Dinero, nullable=False)
+    metodo = db.Column(db.String(20), nullable=False, default='efectivo')  # efectivo, tarjeta, transferencia
+    notas = db.Column(db.String(200))
+    
+    def __repr__(self):
+        return f'<Pago {self.id} - {self.importe}>'
+
+class Eliminacion(db.Model):
+    """Registro de borrado (tombstone) para la sincronización incremental de las tablets"""
+    __tablename__ = 'eliminaciones'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    tabla = db.Column(db.String(50), nullable=False)
+    registro_id = db.Column(db.Integer, nullable=False)
+    eliminado_en = db.Column(db.DateTime, default=datetime.utcnow, nullable=False, index=True)
+    
+    def __repr__(self):
+        return f'<Eliminacion {self.tabla} {self.registro_id}>'
+
+class Cambio(db.Model):
+    """Entrada del registro de cambios (outbox) que leen los consumidores externos"""
+    __tablename__ = 'cambios'
+    # AUTOINCREMENT: la secuencia no reutiliza números aunque se compacte la cola
+    __table_args__ = (
+        db.Index('ix_cambios_tabla_registro', 'tabla', 'registro_id'),
+        {'sqlite_autoincrement': True},
+    )
+    
+    secuencia = db.Column(db.Integer, primary_key=True)
+    tabla = db.Column(db.String(50), nullable=False)
+    registro_id = db.Column(db.Integer, nullable=False)
+    operacion = db.Column(db.String(10), nullable=False)  # insert, update, delete
+    datos = db.Column(db.Text, nullable=False)  # JSON con la fila completa
+    creado_en = db.Column(db.DateTime, default=datetime.utcnow, nullable=False, index=True)
+    
+    def __repr__(self):
+        return f'<Cambio {self.secuencia} {self.operacion} {self.tabla} {self.registro_id}>'
+
+class PuntoControl(db.Model):
+    """Última secuencia del registro de cambios procesada por cada consumidor"""
+    __tablename__ = 'puntos_control'
+    
+    consumidor = db.Column(db.String(100), primary_key=True)
+    secuencia = db.Column(db.Integer, nullable=False, default=0)
+    actualizado_en = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<PuntoControl {self.consumidor} {self.secuencia}>'
+
+class Vencimiento(db.Model):
+    """Próximo mantenimiento previsto de un vehículo por tipo de servicio (lo mantiene mantenimiento.py)"""
+    __tablename__ = 'vencimientos'
+    __table_args__ = (db.UniqueConstraint('coche_id', 'tipo'),)
+    
+    id = db.Column(db.Integer, primary_key=True)
+    coche_id = db.Column(db.Integer, db.ForeignKey('coches.id'), nullable=False)
+    tipo = db.Column(db.String(30), nullable=False)
+    fecha_prevista = db.Column(db.Date, nullable=False, index=True)
+    km_previstos = db.Column(db.Integer, nullable=True)
+    ultima_fecha = db.Column(db.DateTime, nullable=False)
+    ultimo_km = db.Column(db.Integer, nullable=True)
+    km_diarios = db.Column(db.Float, nullable=True)
+    calculado_en = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    
+    coche = db.relationship('Coche')
+    
+    def __repr__(self):
+        return f'<Vencimiento {self.coche_id} {self.tipo} {self.fecha_prevista}>'
+
+class ArticuloCatalogo(db.Model):
+    """Trabajo o pieza habitual con precio y horas por defecto (lo usa catalogo.py para sugerir líneas)"""
+    __tablename__ = 'catalogo'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    tipo = db.Column(db.String(20), nullable=False, default='mano_obra')  # mano_obra, pieza
+    descripcion = db.Column(db.String(200), unique=True, nullable=False)
+    precio = db.Column(Dinero, nullable=False, default=0)
+    horas = db.Column(db.Float, nullable=False, default=0.0)
+    usos = db.Column(db.Integer, nullable=False, default=0)  # veces que aparece en el histórico
+    activo = db.Column(db.Boolean, nullable=False, default=True)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<ArticuloCatalogo {self.descripcion}>'
+
+class EnvioFactura(db.Model):
+    """Envío de una factura por correo: cola del worker de correo y estado de la entrega (lo gestiona correo.py)"""
+    __tablename__ = 'envios_factura'
+    __table_args__ = (db.Index('ix_envios_factura_estado_proximo', 'estado', 'proximo_intento'),)
+    
+    id = db.Column(db.Integer, primary_key=True)
+    factura_id = db.Column(db.Integer, db.ForeignKey('facturas.id'), nullable=False, index=True)
+    destinatario = db.Column(db.String(100), nullable=False)
+    estado = db.Column(db.String(20), nullable=False, default='pendiente')  # pendiente, enviando, enviado, error
+    intentos = db.Column(db.Integer, nullable=False, default=0)
+    # Pendiente: cuándo puede reintentarse; enviando: cuándo se da por perdido el worker que lo reclamó
+    proximo_intento = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    error = db.Column(db.Text)
+    creado_en = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    enviado_en = db.Column(db.DateTime, nullable=True)
+    
+    factura = db.relationship('Factura')
+    
+    def __repr__(self):
+        return f'<EnvioFactura {self.factura_id} {self.estado}>'
+
+class CadenaVerifactu(db.Model):
+    """Cabeza de la cadena de registros Verifactu de un emisor y hasta dónde se ha verificado (lo mantiene verifactu.py)"""
+    __tablename__ = 'cadenas_verifactu'
+    
+    emisor_nif = db.Column(db.String(20), primary_key=True)
+    factura_id = db.Column(db.Integer, db.ForeignKey('facturas.id'), nullable=False)
+    huella = db.Column(db.String(64), nullable=False)
+    registros = db.Column(db.Integer, nullable=False, default=0)
+    actualizado_en = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    # Último registro comprobado por una verificación completa o incremental sin errores
+    verificado_hasta = db.Column(db.Integer, nullable=True)
+    huella_verificada = db.Column(db.String(64), nullable=True)
+    registros_verificados = db.Column(db.Integer, nullable=False, default=0)
+    
+    def __repr__(self):
+        return f'<CadenaVerifactu {self.emisor_nif} {self.registros}>'
+
+class DatosTaller(db.Model):
+    """Datos fiscales del taller: una sola fila en cada base de datos (con varios talleres, una por taller)"""
+    __tablename__ = 'datos_taller'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    nif = db.Column(db.String(20), nullable=True)  # NIF del emisor de las facturas y de su cadena Verifactu
+    actualizado_en = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<DatosTaller {self.nif}>'
+
+class Archivo(db.Model):
+    """Contenido de uno o varios adjuntos, guardado una sola vez por su hash (lo gestiona adjuntos.py)"""
+    __tablename__ = 'archivos'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    hash = db.Column(db.String(64), unique=True, nullable=False)  # SHA-256 del contenido
+    tamaño = db.Column(db.Integer, nullable=False)
+    tipo = db.Column(db.String(50), nullable=False)  # tipo MIME reconocido por el contenido
+    creado_en = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    
+    def __repr__(self):
+        return f'<Archivo {self.hash[:12]}>'
+
+class Adjunto(db.Model):
+    """Foto o documento adjunto a un vehículo o a una intervención"""
+    __tablename__ = 'adjuntos'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    archivo_id = db.Column(db.Integer, db.ForeignKey('archivos.id'), nullable=False, index=True)
+    coche_id = db.Column(db.Integer, db.ForeignKey('coches.id'), nullable=True, index=True)
+    intervencion_id = db.Column(db.Integer, db.ForeignKey('intervenciones.id'), nullable=True, index=True)
+    nombre = db.Column(db.String(200), nullable=False)  # nombre del fichero subido
+    subido_en = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    
+    archivo = db.relationship('Archivo', lazy='joined')
+    
+    def __repr__(self):
+        return f'<Adjunto {self.nombre}>'
@@ -0,0 +1,165 @@
+"""
+Perfilado bajo demanda de peticiones individuales.
+
+Una petición autorizada se ejecuta con un perfilador por muestreo (un hilo que
+lee la pila del hilo de la petición cada milisegundo) y con tracemalloc activo.
+Al terminar se guardan en el directorio de perfiles:
+
+    <nombre>.cpu.folded   pilas muestreadas, formato "a;b;c N" (flamegraph.pl, speedscope)
+    <nombre>.mem.folded   memoria reservada por pila, en bytes, mismo formato
+    <nombre>.json         datos de la petición y resumen
+
+Solo se perfila una petición a la vez por proceso; tracemalloc es global, así
+que la memoria puede incluir reservas de otros hilos que se ejecuten a la vez.
+"""
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime
+
+_en_curso = threading.Lock()
+
+
+def _nombre_marco(codigo):
+    return f'{codigo.co_name} ({os.path.basename(codigo.co_filename)})'
+
+
+class PerfiladorMuestreo:
+    """Muestrea periódicamente la pila de un hilo desde un hilo auxiliar."""
+
+    def __init__(self, hilo_id, intervalo=0.001):
+        self.hilo_id = hilo_id
+        self.intervalo = intervalo
+        self.pilas = Counter()
+        self.muestras = 0
+        self._parar = threading.Event()
+        self._hilo = threading.Thread(target=self._muestrear, name='perfilador', daemon=True)
+
+    def _muestrear(self):
+        while not self._parar.wait(self.intervalo):
+            marco = sys._current_frames().get(self.hilo_id)
+            if marco is None:
+                continue
+            pila = []
+            while marco is not None:
+                pila.append(_nombre_marco(marco.f_code))
+                marco = marco.f_back
+            self.pilas[';'.join(reversed(pila))] += 1
+            self.muestras += 1
+
+    def iniciar(self):
+        self._hilo.start()
+
+    def detener(self):
+        self._parar.set()
+        self._hilo.join()
+
+
+class PerfilPeticion:
+    """Perfil de una petición: CPU por muestreo más instantánea de tracemalloc."""
+
+    def __init__(self, directorio, metodo, ruta, endpoint):
+        self.directorio = directorio
+        self.metodo = metodo
+        self.ruta = ruta
+        self.endpoint = endpoint
+        self.estado = None
+        # Se fija al empezar para poder enviarlo en la cabecera antes de que termine
+        # una respuesta generada por partes
+        self.nombre = f"{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}-{endpoint or 'desconocido'}"
+        self._perfilador = PerfiladorMuestreo(threading.get_ident())
+        self._tracemalloc_propio = False
+
+    @classmethod
+    def iniciar(cls, directorio, metodo, ruta, endpoint):
+        """Empieza a perfilar, o devuelve None si ya hay otra petición perfilándose."""
+        if not _en_curso.acquire(blocking=False):
+            return None
+        perfil = cls(directorio, metodo, ruta, endpoint)
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(25)
+            perfil._tracemalloc_propio = True
+        perfil._inicio = time.perf_counter()
+        perfil._perfilador.iniciar()
+        return perfil
+
+    def terminar(self):
+        """Detiene el perfilado y guarda los ficheros. Devuelve el nombre base."""
+        try:
+            self._perfilador.detener()
+            duracion = time.perf_counter() - self._inicio
+            instantanea = tracemalloc.take_snapshot().filter_traces((
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, __file__),
+            ))
+            if self._tracemalloc_propio:
+                tracemalloc.stop()
+            return self._guardar(duracion, instantanea)
+        finally:
+            _en_curso.release()
+
+    def _guardar(self, duracion, instantanea):
+        os.makedirs(self.directorio, exist_ok=True)
+        base = os.path.join(self.directorio, self.nombre)
+
+        with open(base + '.cpu.folded', 'w') as f:
+            for pila, cuenta in self._perfilador.pilas.most_common():
+                f.write(f'{pila} {cuenta}\n')
+
+        estadisticas = instantanea.statistics('traceback')
+        with open(base + '.mem.folded', 'w') as f:
+            for estadistica in estadisticas:
+                pila = ';'.join(_nombre_marco_tb(marco) for marco in estadistica.traceback)
+                f.write(f'{pila} {estadistica.size}\n')
+
+        resumen = {
+            'fecha': datetime.now().isoformat(timespec='seconds'),
+            'metodo': self.metodo,
+            'ruta': self.ruta,
+            'endpoint': self.endpoint,
+            'estado': self.estado,
+            'duracion_ms': round(duracion * 1000, 2),
+            'muestras': self._perfilador.muestras,
+            'memoria_bytes': sum(e.size for e in estadisticas),
+            'top_memoria': [
+                {'lugar': str(e.traceback[-1]), 'bytes': e.size, 'bloques': e.count}
+                for e in instantanea.statistics('lineno')[:10]
+            ],
+        }
+        with open(base + '.json', 'w') as f:
+            json.dump(resumen, f, ensure_ascii=False, indent=2)
+        return self.nombre
+
+
+def _nombre_marco_tb(marco):
+    return f'{os.path.basename(marco.filename)}:{marco.lineno}'
+
+
+def listar_perfiles(directorio, limite=50):
+    """Resúmenes de los perfiles guardados, del más reciente al más antiguo."""
+    try:
+        nombres = sorted((e.name[:-5] for e in os.scandir(directorio) if e.name.endswith('.json')), reverse=True)
+    except FileNotFoundError:
+        return []
+    perfiles = []
+    for nombre in nombres[:limite]:
+        try:
+            with open(os.path.join(directorio, nombre + '.json')) as f:
+                perfiles.append(dict(json.load(f), nombre=nombre))
+        except (OSError, ValueError):
+            continue
+    return perfiles
+
+
+def purgar_perfiles(directorio, maximo=200):
+    """Borra los perfiles más antiguos para no guardar más de `maximo`."""
+    for perfil in listar_perfiles(directorio, limite=None)[maximo:]:
+        for extension in ('.json', '.cpu.folded', '.mem.folded'):
+            try:
+                os.remove(os.path.join(directorio, perfil['nombre'] + extension))
+            except OSError:
+                pass
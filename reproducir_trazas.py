@@ -0,0 +1,168 @@
+"""
+Reproduce trazas capturadas en producción (TRAZAS_DIR, ver trazas.py) y compara
+la distribución de latencias con la de la captura, en total y por endpoint.
+
+Por defecto las peticiones se ejecutan dentro de este proceso contra una copia
+temporal de la base de datos indicada, que no se modifica. Con --url se envían a
+un servidor en marcha, que debe estar usando una copia de la base de datos.
+
+    python reproducir_trazas.py instance/trazas --base-datos instance/taller.db
+    python reproducir_trazas.py trazas-*.jsonl --base-datos copia.db --velocidad 2
+    python reproducir_trazas.py instance/trazas --url http://127.0.0.1:8000
+
+--velocidad 2 reproduce el doble de rápido (las llegadas se acercan a la mitad);
+--velocidad 0 envía las peticiones sin esperas, tan rápido como se pueda.
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from trazas import leer_trazas
+
+
+def percentil(valores, p):
+    if not valores:
+        return 0.0
+    valores = sorted(valores)
+    return valores[min(int(len(valores) * p), len(valores) - 1)]
+
+
+class SinRedirecciones(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+def peticion_http(base):
+    abridor = urllib.request.build_opener(SinRedirecciones)
+
+    def enviar(traza):
+        url = base + traza['p']
+        if traza.get('q'):
+            url += '?' + urllib.parse.urlencode(traza['q'], doseq=True)
+        datos = urllib.parse.urlencode(traza['f'], doseq=True).encode() if 'f' in traza else None
+        try:
+            with abridor.open(urllib.request.Request(url, data=datos, method=traza['m']), timeout=120) as respuesta:
+                respuesta.read()
+                return respuesta.status
+        except urllib.error.HTTPError as e:
+            return e.code
+    return enviar
+
+
+def peticion_local(app):
+    # Plantillas ya compiladas, como en un worker que lleva tiempo en marcha
+    for nombre in app.jinja_env.list_templates(extensions=['html']):
+        app.jinja_env.get_template(nombre)
+    clientes = threading.local()
+
+    def enviar(traza):
+        if not hasattr(clientes, 'cliente'):
+            clientes.cliente = app.test_client()
+        respuesta = clientes.cliente.open(traza['p'], method=traza['m'], query_string=traza.get('q'),
+                                          data=traza.get('f'))
+        respuesta.get_data()
+        respuesta.close()
+        return respuesta.status_code
+    return enviar
+
+
+def reproducir(trazas, enviar, velocidad, concurrencia):
+    """Lanza cada traza en su instante (escalado) y mide latencia y estado"""
+    resultados = [None] * len(trazas)
+    retrasos = []
+    t0 = trazas[0]['t']
+
+    def ejecutar(i, traza):
+        inicio = time.perf_counter()
+        try:
+            estado = enviar(traza)
+        except Exception as e:
+            estado = type(e).__name__
+        resultados[i] = ((time.perf_counter() - inicio) * 1000, estado)
+
+    inicio = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrencia) as ejecutor:
+        for i, traza in enumerate(trazas):
+            if velocidad:
+                objetivo = inicio + (traza['t'] - t0) / velocidad
+                espera = objetivo - time.monotonic()
+                if espera > 0:
+                    time.sleep(espera)
+                else:
+                    retrasos.append(-espera * 1000)
+            ejecutor.submit(ejecutar, i, traza)
+    return resultados, time.monotonic() - inicio, retrasos
+
+
+def informe(trazas, resultados, duracion, retrasos):
+    por_endpoint = defaultdict(lambda: ([], []))
+    distintos = Counter()
+    for traza, (latencia, estado) in zip(trazas, resultados):
+        for clave in ('(total)', traza.get('e') or '?'):
+            por_endpoint[clave][0].append(traza['d'])
+            por_endpoint[clave][1].append(latencia)
+        if estado != traza['s']:
+            distintos[(traza.get('e'), traza['s'], estado)] += 1
+
+    captura = trazas[-1]['t'] - trazas[0]['t']
+    print(f"{len(trazas)} peticiones: captura en {captura:.1f} s, reproducción en {duracion:.1f} s")
+    if retrasos:
+        print(f"{len(retrasos)} peticiones salieron tarde (p95 {percentil(retrasos, 0.95):.0f} ms): "
+              f"aumente --concurrencia o reduzca --velocidad")
+    print(f"\n{'Endpoint':34} {'n':>6} {'cap p50':>8} {'rep p50':>8} {'cap p95':>8} {'rep p95':>8} "
+          f"{'cap p99':>8} {'rep p99':>8} {'p95 ×':>6}")
+    orden = sorted(por_endpoint.items(), key=lambda e: (e[0] != '(total)', -len(e[1][0])))
+    for endpoint, (capturadas, reproducidas) in orden:
+        c95, r95 = percentil(capturadas, 0.95), percentil(reproducidas, 0.95)
+        print(f"{endpoint[:34]:34} {len(capturadas):6d} {percentil(capturadas, 0.5):8.1f} "
+              f"{percentil(reproducidas, 0.5):8.1f} {c95:8.1f} {r95:8.1f} {percentil(capturadas, 0.99):8.1f} "
+              f"{percentil(reproducidas, 0.99):8.1f} {r95 / c95 if c95 else 0:6.2f}")
+    if distintos:
+        print('\nEstados distintos de los capturados (endpoint, capturado, reproducido: veces):')
+        for (endpoint, capturado, reproducido), veces in distintos.most_common(20):
+            print(f"  {endpoint}, {capturado}, {reproducido}: {veces}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Reproduce trazas capturadas y compara latencias.')
+    parser.add_argument('trazas', nargs='+', help='Ficheros .jsonl o directorios de trazas')
+    parser.add_argument('--base-datos', help='Base de datos SQLite de la que se hace una copia temporal')
+    parser.add_argument('--url', help='Servidor contra el que reproducir en lugar de hacerlo en este proceso')
+    parser.add_argument('--velocidad', type=float, default=1.0, help='Factor de velocidad (0: sin esperas)')
+    parser.add_argument('--concurrencia', type=int, default=32, help='Peticiones simultáneas como máximo')
+    parser.add_argument('--limite', type=int, help='Reproducir solo las primeras N trazas')
+    args = parser.parse_args()
+    if not args.url and not args.base_datos:
+        parser.error('indique --base-datos (reproducción local) o --url')
+
+    trazas = leer_trazas(args.trazas)[:args.limite]
+    if not trazas:
+        sys.exit('No hay trazas que reproducir')
+
+    directorio = None
+    if args.url:
+        enviar = peticion_http(args.url.rstrip('/'))
+    else:
+        directorio = tempfile.mkdtemp()
+        copia = os.path.join(directorio, 'reproduccion.db')
+        shutil.copyfile(args.base_datos, copia)
+        os.environ['DATABASE_URL'] = 'sqlite:///' + copia
+        os.environ.pop('TRAZAS_DIR', None)  # la reproducción no se captura a sí misma
+        from app import app
+        enviar = peticion_local(app)
+
+    try:
+        resultados, duracion, retrasos = reproducir(trazas, enviar, args.velocidad, args.concurrencia)
+        informe(trazas, resultados, duracion, retrasos)
+    finally:
+        if directorio:
+            shutil.rmtree(directorio, ignore_errors=True)
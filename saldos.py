@@ -0,0 +1,157 @@
+"""
+Saldos de clientes: total facturado, total pagado y pendiente.
+
+`Cliente.total_facturado` y `Cliente.total_pagado` se actualizan desde los eventos
+de Factura y Pago con un UPDATE ... SET columna = columna + diferencia en la misma
+conexión (y transacción) que el propio cambio, así que el listado de clientes los
+lee sin agregar facturas ni pagos por fila.
+
+Cuando no se conoce el valor anterior (atributo no cargado) o una factura o un
+pago cambia de cliente, se recalculan desde cero los saldos de los clientes
+afectados. `conciliar()` compara los saldos guardados con la suma de facturas y
+pagos y, si se le pide, corrige las diferencias.
+"""
+from collections import namedtuple
+
+from sqlalchemy import event, func, inspect, or_, select
+
+from models import db, Cliente, Factura, Pago
+
+Descuadre = namedtuple('Descuadre', 'cliente_id nombre facturado_guardado facturado_real pagado_guardado pagado_real')
+
+_clientes = Cliente.__table__
+_facturas = Factura.__table__
+_pagos = Pago.__table__
+
+
+def _sumar(connection, cliente_id, columna, diferencia):
+    if cliente_id is None or not diferencia:
+        return
+    connection.execute(_clientes.update().where(_clientes.c.id == cliente_id)
+                       .values({columna: _clientes.c[columna] + diferencia}))
+
+
+def _cliente_de_factura(factura_id):
+    return select(_facturas.c.cliente_id).where(_facturas.c.id == factura_id).scalar_subquery()
+
+
+def _facturado_real():
+    return select(func.coalesce(func.sum(_facturas.c.total), 0)).where(
+        _facturas.c.cliente_id == _clientes.c.id).scalar_subquery()
+
+
+def _pagado_real():
+    return select(func.coalesce(func.sum(_pagos.c.importe), 0)).select_from(
+        _pagos.join(_facturas, _pagos.c.factura_id == _facturas.c.id)
+    ).where(_facturas.c.cliente_id == _clientes.c.id).scalar_subquery()
+
+
+def recalcular(connection, cliente_ids):
+    """Recalcula desde facturas y pagos los saldos de los clientes indicados"""
+    cliente_ids = [cliente_id for cliente_id in cliente_ids if cliente_id is not None]
+    if cliente_ids:
+        connection.execute(_clientes.update().where(_clientes.c.id.in_(cliente_ids))
+                           .values(total_facturado=_facturado_real(), total_pagado=_pagado_real()))
+
+
+def _anterior(target, atributo):
+    """(cambiado, valor anterior o None si no se conoce)"""
+    historial = inspect(target).attrs[atributo].history
+    if not historial.has_changes():
+        return False, None
+    return True, historial.deleted[0] if historial.deleted else None
+
+
+# ========== EVENTOS ==========
+
+def _alta_factura(mapper, connection, target):
+    _sumar(connection, target.cliente_id, 'total_facturado', target.total)
+
+
+def _modificacion_factura(mapper, connection, target):
+    cambio_cliente, cliente_anterior = _anterior(target, 'cliente_id')
+    cambio_total, total_anterior = _anterior(target, 'total')
+    if cambio_cliente:
+        # También se mueven sus pagos: se recalculan ambos clientes
+        recalcular(connection, {cliente_anterior, target.cliente_id})
+    elif cambio_total:
+        if total_anterior is None:
+            recalcular(connection, [target.cliente_id])
+        else:
+            _sumar(connection, target.cliente_id, 'total_facturado', target.total - total_anterior)
+
+
+def _baja_factura(mapper, connection, target):
+    # Los pagos (cascade) se borran antes que la factura y ya han restado lo suyo
+    if 'total' in inspect(target).dict:
+        _sumar(connection, target.cliente_id, 'total_facturado', -target.total)
+    else:
+        recalcular(connection, [target.cliente_id])
+
+
+def _sumar_pago(connection, factura_id, diferencia):
+    if not diferencia:
+        return
+    connection.execute(_clientes.update().where(_clientes.c.id == _cliente_de_factura(factura_id))
+                       .values(total_pagado=_clientes.c.total_pagado + diferencia))
+
+
+def _alta_pago(mapper, connection, target):
+    _sumar_pago(connection, target.factura_id, target.importe)
+
+
+def _modificacion_pago(mapper, connection, target):
+    cambio_factura, factura_anterior = _anterior(target, 'factura_id')
+    cambio_importe, importe_anterior = _anterior(target, 'importe')
+    if cambio_factura or (cambio_importe and importe_anterior is None):
+        facturas = [f for f in (factura_anterior, target.factura_id) if f is not None]
+        clientes = connection.execute(select(_facturas.c.cliente_id).where(_facturas.c.id.in_(facturas))).scalars()
+        recalcular(connection, set(clientes))
+    elif cambio_importe:
+        _sumar_pago(connection, target.factura_id, target.importe - importe_anterior)
+
+
+def _baja_pago(mapper, connection, target):
+    if 'importe' in inspect(target).dict:
+        _sumar_pago(connection, target.factura_id, -target.importe)
+    else:
+        cliente_id = connection.execute(select(_facturas.c.cliente_id)
+                                        .where(_facturas.c.id == target.factura_id)).scalar()
+        recalcular(connection, [cliente_id])
+
+
+def registrar_eventos_saldos():
+    """Mantiene los saldos de Cliente con cada alta, modificación o baja de facturas y pagos"""
+    for modelo, alta, modificacion, baja in (
+        (Factura, _alta_factura, _modificacion_factura, _baja_factura),
+        (Pago, _alta_pago, _modificacion_pago, _baja_pago),
+    ):
+        event.listen(modelo, 'after_insert', alta)
+        event.listen(modelo, 'after_update', modificacion)
+        event.listen(modelo, 'after_delete', baja)
+
+
+# ========== CONCILIACIÓN ==========
+
+def conciliar(corregir=False):
+    """
+    Compara los saldos guardados de cada cliente con la suma de sus facturas y pagos.
+
+    Args:
+        corregir: Si es True, recalcula los saldos de los clientes descuadrados
+
+    Returns:
+        list[Descuadre]: Clientes cuyo saldo guardado no coincide
+    """
+    facturado = _facturado_real()
+    pagado = _pagado_real()
+    consulta = select(
+        Cliente.id, Cliente.nombre,
+        Cliente.total_facturado, facturado.label('facturado_real'),
+        Cliente.total_pagado, pagado.label('pagado_real'),
+    ).where(or_(Cliente.total_facturado != facturado, Cliente.total_pagado != pagado)).order_by(Cliente.id)
+    descuadres = [Descuadre._make(fila) for fila in db.session.execute(consulta)]
+    if corregir and descuadres:
+        recalcular(db.session.connection(), [d.cliente_id for d in descuadres])
+        db.session.commit()
+    return descuadres
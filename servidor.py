@@ -0,0 +1,338 @@
+"""
+Servidor de producción con workers preforkados (`flask --app app serve`).
+
+El proceso maestro carga la aplicación una sola vez, abre el socket de escucha y
+crea los workers con fork: arrancan al instante y comparten el código ya cargado.
+Cada worker atiende las conexiones con un número fijo de hilos y solo acepta una
+conexión nueva cuando tiene un hilo libre; las demás esperan en la cola del socket
+hasta que las recoge cualquier worker.
+
+Señales del maestro:
+    TERM, INT   parada ordenada: los workers dejan de aceptar, terminan lo que tienen
+                en curso (como mucho `gracia` segundos) y salen.
+    HUP         reinicio sin cortes: el maestro se vuelve a ejecutar (exec) con el mismo
+                socket, carga el código nuevo, crea los workers nuevos y entonces para
+                ordenadamente los antiguos. El socket no se cierra en ningún momento, así
+                que no se rechaza ninguna conexión.
+    TTIN, TTOU  un worker más o uno menos.
+
+Cada worker se recicla tras `max_peticiones` peticiones (más una variación aleatoria
+para que no se reinicien todos a la vez), lo que acota el crecimiento de memoria.
+"""
+import logging
+import os
+import random
+import select
+import signal
+import socket
+import sys
+import threading
+import time
+
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+
+logger = logging.getLogger(__name__)
+
+# Variables de entorno con las que el maestro se pasa el estado a sí mismo al reiniciarse
+ENTORNO_SOCKET = 'TALLER_SERVE_FD'
+ENTORNO_ANTIGUOS = 'TALLER_SERVE_WORKERS_ANTIGUOS'
+
+
+def abrir_socket(direccion, cola=2048):
+    """Socket de escucha para `host:puerto`, o el heredado del maestro anterior"""
+    fd = os.environ.pop(ENTORNO_SOCKET, None)
+    if fd is not None:
+        sock = socket.socket(fileno=int(fd))
+    else:
+        host, _, puerto = direccion.rpartition(':')
+        host = host.strip('[]') or '0.0.0.0'
+        sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((host, int(puerto)))
+        sock.listen(cola)
+    # No bloqueante: varios workers esperan en el mismo socket y solo uno se lleva cada conexión
+    sock.setblocking(False)
+    return sock
+
+
+class ManejadorPeticion(WSGIRequestHandler):
+    # Segundos que una conexión keep-alive puede ocupar un hilo sin enviar nada
+    timeout = 5
+
+
+class ServidorWorker(BaseWSGIServer):
+    """Servidor WSGI de un worker: cada conexión en un hilo, como mucho `hilos` a la vez."""
+
+    multithread = True
+    daemon_threads = True
+
+    def __init__(self, app, sock, hilos):
+        host, puerto = sock.getsockname()[:2]
+        super().__init__(host, puerto, app, handler=ManejadorPeticion, fd=sock.fileno())
+        self.socket.setblocking(False)
+        self._huecos = threading.BoundedSemaphore(hilos)
+        self._en_curso = 0
+        self._condicion = threading.Condition()
+
+    def _handle_request_noblock(self):
+        # Se espera un hilo libre antes de aceptar: mientras tanto la conexión
+        # sigue en la cola del socket y la puede recoger otro worker
+        self._huecos.acquire()
+        self._hueco_pendiente = True
+        try:
+            super()._handle_request_noblock()
+        finally:
+            if self._hueco_pendiente:
+                self._huecos.release()
+
+    def process_request(self, request, client_address):
+        self._hueco_pendiente = False
+        with self._condicion:
+            self._en_curso += 1
+        threading.Thread(target=self._atender, args=(request, client_address), daemon=True).start()
+
+    def _atender(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self._huecos.release()
+            with self._condicion:
+                self._en_curso -= 1
+                self._condicion.notify_all()
+
+    def esperar_en_curso(self, plazo):
+        """Espera a que terminen las conexiones en curso; devuelve cuántas quedan"""
+        limite = time.monotonic() + plazo
+        with self._condicion:
+            while self._en_curso and time.monotonic() < limite:
+                self._condicion.wait(limite - time.monotonic())
+            return self._en_curso
+
+
+class Worker:
+    """Proceso hijo: atiende peticiones hasta que se le pide parar o llega a su máximo."""
+
+    def __init__(self, app, sock, hilos, max_peticiones, gracia, al_salir=None, aviso=None):
+        self.app = app
+        self.sock = sock
+        self.aviso = aviso
+        self.hilos = hilos
+        self.max_peticiones = max_peticiones
+        self.gracia = gracia
+        self.al_salir = al_salir
+        self.peticiones = 0
+        self._parando = threading.Event()
+        self._lock = threading.Lock()
+
+    def _contar(self, environ, start_response):
+        with self._lock:
+            self.peticiones += 1
+            agotado = self.max_peticiones and self.peticiones == self.max_peticiones
+        if agotado:
+            logger.info('Worker %s: %s peticiones atendidas, se recicla', os.getpid(), self.peticiones)
+            self._avisar_maestro()
+            self.parar()
+        return self.app(environ, start_response)
+
+    def _avisar_maestro(self):
+        # El maestro crea el sustituto sin esperar a que este worker termine lo que tiene en curso
+        if self.aviso is not None:
+            try:
+                os.write(self.aviso, f'{os.getpid()}\n'.encode('ascii'))
+            except OSError:
+                pass  # el maestro se ha reiniciado y ya no lee este aviso
+
+    def parar(self, *args):
+        if not self._parando.is_set():
+            self._parando.set()
+            # shutdown() espera a que termine serve_forever: no puede llamarse desde su hilo
+            threading.Thread(target=self.servidor.shutdown, daemon=True).start()
+
+    def ejecutar(self):
+        self.servidor = ServidorWorker(self._contar, self.sock, self.hilos)
+        signal.signal(signal.SIGTERM, self.parar)
+        # Ctrl+C llega a todo el grupo de procesos: el maestro es quien para a los workers
+        for senal in (signal.SIGINT, signal.SIGHUP, signal.SIGTTIN, signal.SIGTTOU):
+            signal.signal(senal, signal.SIG_IGN)
+        try:
+            self.servidor.serve_forever(poll_interval=0.5)
+        finally:
+            pendientes = self.servidor.esperar_en_curso(self.gracia)
+            if pendientes:
+                logger.warning('Worker %s: se cierran %s conexiones sin terminar', os.getpid(), pendientes)
+            if self.al_salir is not None:
+                self.al_salir()
+
+
+class Maestro:
+    """Proceso que crea, vigila y recicla los workers."""
+
+    def __init__(self, app, direccion='127.0.0.1:8000', workers=2, hilos=4, max_peticiones=1000,
+                 variacion=100, gracia=30, antes_de_bifurcar=None, al_salir_worker=None):
+        """
+        Args:
+            app: Aplicación WSGI, ya cargada
+            direccion: `host:puerto` de escucha
+            workers: Número de procesos
+            hilos: Conexiones simultáneas por proceso
+            max_peticiones: Peticiones tras las que se recicla un worker (0: nunca)
+            variacion: Máximo aleatorio que se suma a `max_peticiones` en cada worker
+            gracia: Segundos que se espera a las peticiones en curso al parar
+            antes_de_bifurcar: Función llamada en el maestro antes de cada fork (cerrar conexiones)
+            al_salir_worker: Función llamada en cada worker antes de salir (volcar métricas)
+        """
+        self.app = app
+        self.direccion = direccion
+        self.num_workers = workers
+        self.hilos = hilos
+        self.max_peticiones = max_peticiones
+        self.variacion = variacion
+        self.gracia = gracia
+        self.antes_de_bifurcar = antes_de_bifurcar
+        self.al_salir_worker = al_salir_worker
+        self.workers = {}  # pid -> instante de arranque
+        self.retirados = set()  # workers que están terminando lo que tienen en curso
+        self._senales = []
+
+    # ----- Workers -----
+
+    def _crear_worker(self):
+        if self.antes_de_bifurcar is not None:
+            self.antes_de_bifurcar()
+        maximo = self.max_peticiones + random.randint(0, self.variacion) if self.max_peticiones else 0
+        pid = os.fork()
+        if pid:
+            self.workers[pid] = time.monotonic()
+            return pid
+        codigo = 0
+        try:
+            os.close(self._avisos)
+            random.seed()  # que cada worker no repita la secuencia del maestro
+            Worker(self.app, self.sock, self.hilos, maximo, self.gracia, self.al_salir_worker,
+                   aviso=self._aviso_worker).ejecutar()
+        except BaseException:
+            logger.exception('Worker %s: error', os.getpid())
+            codigo = 1
+        finally:
+            # Sin pasar por el apagado del intérprete heredado del maestro
+            os._exit(codigo)
+
+    def _recoger(self):
+        """Retira los workers que han terminado"""
+        while True:
+            try:
+                pid, estado = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if not pid:
+                return
+            self.retirados.discard(pid)
+            if self.workers.pop(pid, None) is not None and estado:
+                logger.warning('Worker %s terminó con estado %s', pid, estado)
+
+    def _retirar(self, pid):
+        if self.workers.pop(pid, None) is not None:
+            self.retirados.add(pid)
+
+    def _leer_avisos(self, espera):
+        """Espera como mucho `espera` segundos a los avisos de los workers que se reciclan"""
+        if not select.select([self._avisos], [], [], espera)[0]:
+            return
+        try:
+            datos = os.read(self._avisos, 4096)
+        except BlockingIOError:
+            return
+        for pid in datos.split():
+            self._retirar(int(pid))
+
+    def _parar_workers(self, pids):
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def _esperar(self, pids, plazo):
+        """Espera a que salgan los procesos indicados; mata los que sigan vivos tras el plazo"""
+        pendientes = set(pids)
+        limite = time.monotonic() + plazo
+        while pendientes and time.monotonic() < limite:
+            for pid in list(pendientes):
+                try:
+                    if os.waitpid(pid, os.WNOHANG)[0]:
+                        pendientes.discard(pid)
+                except ChildProcessError:
+                    pendientes.discard(pid)
+            time.sleep(0.1)
+        for pid in pendientes:
+            logger.warning('Worker %s no ha terminado a tiempo, se mata', pid)
+            try:
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+            except (ProcessLookupError, ChildProcessError):
+                pass
+
+    # ----- Maestro -----
+
+    def _anotar_senal(self, senal, marco):
+        self._senales.append(senal)
+
+    def ejecutar(self):
+        self.sock = abrir_socket(self.direccion)
+        self._avisos, self._aviso_worker = os.pipe()
+        os.set_blocking(self._avisos, False)
+        antiguos = [int(pid) for pid in os.environ.pop(ENTORNO_ANTIGUOS, '').split(',') if pid]
+        for senal in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGTTIN, signal.SIGTTOU):
+            signal.signal(senal, self._anotar_senal)
+        logger.info('Maestro %s escuchando en %s:%s con %s workers de %s hilos',
+                    os.getpid(), *self.sock.getsockname()[:2], self.num_workers, self.hilos)
+
+        for _ in range(self.num_workers):
+            self._crear_worker()
+        if antiguos:
+            # Reinicio: los workers nuevos ya aceptan conexiones, los antiguos terminan lo suyo
+            logger.info('Parando los workers anteriores: %s', antiguos)
+            self._parar_workers(antiguos)
+            self._esperar(antiguos, self.gracia)
+
+        while True:
+            while self._senales:
+                senal = self._senales.pop(0)
+                if senal in (signal.SIGTERM, signal.SIGINT):
+                    return self._detener()
+                if senal == signal.SIGHUP:
+                    return self._reiniciar()
+                if senal == signal.SIGTTIN:
+                    self.num_workers += 1
+                elif senal == signal.SIGTTOU and self.num_workers > 1:
+                    self.num_workers -= 1
+                    pid = max(self.workers, key=self.workers.get)
+                    self._parar_workers([pid])
+                    self._retirar(pid)
+            self._recoger()
+            while len(self.workers) < self.num_workers:
+                self._crear_worker()
+            self._leer_avisos(0.2)
+
+    def _detener(self):
+        todos = list(self.workers) + list(self.retirados)
+        logger.info('Parando %s workers', len(todos))
+        self._parar_workers(todos)
+        self._esperar(todos, self.gracia)
+        self.sock.close()
+
+    def _reiniciar(self):
+        logger.info('Reiniciando el maestro %s con el código actual', os.getpid())
+        self._recoger()
+        os.set_inheritable(self.sock.fileno(), True)
+        entorno = dict(os.environ)
+        entorno[ENTORNO_SOCKET] = str(self.sock.fileno())
+        entorno[ENTORNO_ANTIGUOS] = ','.join(str(pid) for pid in list(self.workers) + list(self.retirados))
+        sys.stdout.flush()
+        sys.stderr.flush()
+        # exec conserva el pid: los workers antiguos siguen siendo hijos del nuevo maestro
+        argumentos = getattr(sys, 'orig_argv', None) or [sys.executable] + sys.argv
+        os.execve(sys.executable, argumentos, entorno)
@@ -0,0 +1,146 @@
+"""
+Sincronización incremental para las tablets del taller.
+
+Cada tabla sincronizada tiene una columna `updated_at` y los borrados se anotan
+en la tabla `eliminaciones`. El token que recibe la tablet guarda, por tabla, la
+posición (updated_at, id) de la última fila enviada; la siguiente petición solo
+devuelve filas posteriores, paginadas por tabla.
+
+Solo se envían filas con `updated_at` anterior a "ahora - margen": la marca de
+tiempo se asigna antes de que la transacción consiga el bloqueo de escritura y se
+confirme, y sin ese margen una transacción lenta podría confirmar filas con una
+marca ya superada por el token de una tablet.
+
+La tablet debe aplicar primero los eliminados y después los cambios, y repetir
+la petición con el nuevo token mientras `mas` sea verdadero.
+"""
+import base64
+import json
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from sqlalchemy import and_, event, or_, select
+
+from models import db, Cliente, Coche, Intervencion, Factura, Eliminacion
+
+# Tabla -> (modelo, columnas enviadas). Solo lo que necesitan las tablets.
+TABLAS = {
+    'clientes': (Cliente, ('id', 'nombre', 'dni', 'telefono', 'email', 'direccion',
+                           'codigo_postal', 'poblacion', 'provincia')),
+    'coches': (Coche, ('id', 'matricula', 'marca', 'modelo', 'tipo', 'año', 'color', 'cliente_id')),
+    'intervenciones': (Intervencion, ('id', 'coche_id', 'cliente_id', 'fecha', 'km', 'descripcion',
+                                      'precio', 'horas_trabajo', 'factura_id')),
+    'facturas': (Factura, ('id', 'cliente_id', 'fecha', 'numero_factura', 'total', 'enviada_verifactu')),
+}
+
+
+def registrar_eliminaciones(*modelos):
+    """Anota en `eliminaciones`, dentro de la misma transacción, cada borrado de los modelos"""
+    def anotar(mapper, connection, target):
+        connection.execute(Eliminacion.__table__.insert().values(
+            tabla=mapper.local_table.name,
+            registro_id=target.id,
+            eliminado_en=datetime.utcnow()
+        ))
+
+    for modelo in modelos:
+        event.listen(modelo, 'after_delete', anotar)
+
+
+def crear_token(estado):
+    datos = json.dumps(estado, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(datos).decode('ascii').rstrip('=')
+
+
+def leer_token(token):
+    """Decodifica el token de la tablet. Lanza ValueError si no es válido."""
+    try:
+        datos = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        estado = json.loads(datos)
+        cursores = {tabla: (datetime.fromisoformat(ts), int(ultimo_id))
+                    for tabla, (ts, ultimo_id) in estado['c'].items()}
+        return cursores, bool(estado.get('i'))
+    except (ValueError, KeyError, TypeError, AttributeError):
+        raise ValueError('Token de sincronización no válido')
+
+
+def _valor(valor):
+    if isinstance(valor, datetime):
+        return valor.isoformat()
+    if isinstance(valor, Decimal):
+        return str(valor)
+    return valor
+
+
+def _despues_de(columna_ts, columna_id, cursor):
+    ts, ultimo_id = cursor
+    return or_(columna_ts > ts, and_(columna_ts == ts, columna_id > ultimo_id))
+
+
+def cambios_desde(token, limite=500, margen=15):
+    """
+    Cambios posteriores al token (o todos, en la primera sincronización).
+
+    En la primera sincronización solo se envían las intervenciones sin facturar;
+    después se envían todas las modificadas para que la tablet pueda retirar las
+    que se facturen.
+
+    Args:
+        token: Token devuelto por la petición anterior, o None
+        limite: Máximo de filas por tabla en esta página
+        margen: Segundos de retraso respecto a ahora (ver docstring del módulo)
+
+    Returns:
+        dict: token, mas, eliminados {tabla: [ids]} y cambios {tabla: {columnas, filas}}
+    """
+    if token:
+        cursores, inicial = leer_token(token)
+    else:
+        cursores, inicial = {}, True
+    hasta = datetime.utcnow() - timedelta(seconds=margen)
+    respuesta = {'mas': False, 'eliminados': {}, 'cambios': {}}
+    # Los borrados anteriores al inicio de la primera sincronización no interesan
+    cursores.setdefault('eliminaciones', (hasta, 0))
+
+    for nombre, (modelo, columnas) in TABLAS.items():
+        consulta = select(modelo.updated_at, *(getattr(modelo, c) for c in columnas)).where(modelo.updated_at <= hasta)
+        if nombre in cursores:
+            consulta = consulta.where(_despues_de(modelo.updated_at, modelo.id, cursores[nombre]))
+        if inicial and modelo is Intervencion:
+            consulta = consulta.where(Intervencion.factura_id.is_(None))
+        filas = db.session.execute(consulta.order_by(modelo.updated_at, modelo.id).limit(limite + 1)).all()
+        if len(filas) > limite:
+            respuesta['mas'] = True
+            filas = filas[:limite]
+        if filas:
+            cursores[nombre] = (filas[-1][0], filas[-1][1])
+            respuesta['cambios'][nombre] = {
+                'columnas': list(columnas),
+                'filas': [[_valor(v) for v in fila[1:]] for fila in filas],
+            }
+
+    if not inicial:
+        consulta = select(Eliminacion.eliminado_en, Eliminacion.id, Eliminacion.tabla, Eliminacion.registro_id).where(
+            Eliminacion.eliminado_en <= hasta)
+        if 'eliminaciones' in cursores:
+            consulta = consulta.where(_despues_de(Eliminacion.eliminado_en, Eliminacion.id, cursores['eliminaciones']))
+        filas = db.session.execute(consulta.order_by(Eliminacion.eliminado_en, Eliminacion.id).limit(limite + 1)).all()
+        if len(filas) > limite:
+            respuesta['mas'] = True
+            filas = filas[:limite]
+        for eliminado_en, id, tabla, registro_id in filas:
+            respuesta['eliminados'].setdefault(tabla, []).append(registro_id)
+            cursores['eliminaciones'] = (eliminado_en, id)
+
+    if not respuesta['mas']:
+        # Sincronización completa hasta `hasta`: todas las tablas avanzan a ese punto
+        for nombre in TABLAS:
+            if nombre not in cursores or cursores[nombre][0] < hasta:
+                cursores[nombre] = (hasta, 0)
+        inicial = False
+
+    estado = {'c': {tabla: [ts.isoformat(), ultimo_id] for tabla, (ts, ultimo_id) in cursores.items()}}
+    if inicial:
+        estado['i'] = 1
+    respuesta['token'] = crear_token(estado)
+    return respuesta
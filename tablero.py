@@ -0,0 +1,204 @@
+"""
+Tablero en vivo de intervenciones sin facturar (Server-Sent Events).
+
+Un único hilo difusor por proceso lee el registro de cambios (`cambios`) cada
+`intervalo` segundos, convierte las entradas de intervenciones, vehículos y
+clientes en eventos del tablero y los reparte a la cola de cada pantalla
+conectada. La carga en la base de datos no depende del número de pantallas.
+
+Eventos (el `id` es la secuencia del registro de cambios):
+    alta, modificacion   {"id": ..., "html": "<tr ...>"}  la pantalla inserta o sustituye la fila
+    baja                 {"id": ...}                      la intervención se ha facturado o borrado
+    recargar             {}                               la pantalla se ha quedado atrás y debe recargar
+
+Los últimos lotes se guardan en memoria para que una pantalla que se reconecta
+(Last-Event-ID) o que acaba de cargar la página reciba lo que se ha perdido.
+"""
+import json
+import logging
+import queue
+import threading
+from collections import deque
+
+from flask import render_template
+from sqlalchemy import or_, select
+
+import consultas
+from cambios import ultima_secuencia
+from models import db, Cambio, Intervencion
+
+logger = logging.getLogger(__name__)
+
+
+def _evento(tipo, datos, secuencia):
+    return f'id: {secuencia}\nevent: {tipo}\ndata: {json.dumps(datos, ensure_ascii=False)}\n\n'
+
+
+class Suscripcion:
+    """Pantalla conectada: cola de lotes de eventos ya serializados."""
+
+    def __init__(self, desde, maximo):
+        self.desde = desde
+        self.cola = queue.Queue(maxsize=maximo)
+        self.desbordada = False
+
+    def entregar(self, secuencia, texto):
+        if secuencia <= self.desde:
+            return True
+        try:
+            self.cola.put_nowait(texto)
+            return True
+        except queue.Full:
+            self.desbordada = True
+            return False
+
+    def eventos(self, latido=15.0):
+        """Generador con el cuerpo de la respuesta SSE"""
+        yield 'retry: 3000\n\n'
+        while True:
+            if self.desbordada and self.cola.empty():
+                yield _evento('recargar', {}, self.desde)
+                return
+            try:
+                yield self.cola.get(timeout=latido)
+            except queue.Empty:
+                yield ': latido\n\n'
+
+
+class DifusorTablero:
+    """Hilo que lee el registro de cambios y reparte eventos a las pantallas."""
+
+    def __init__(self, app, intervalo=1.0, historial=200, cola_pantalla=100, metricas=None, contexto=None):
+        """
+        `contexto` devuelve el contexto de petición en el que se lee el registro de
+        cambios (por defecto, uno vacío de `app`; con varios talleres, el del taller).
+        """
+        self.app = app
+        self.intervalo = intervalo
+        self.cola_pantalla = cola_pantalla
+        self.metricas = metricas
+        self.contexto = contexto or (lambda: app.test_request_context('/'))
+        self._suscripciones = set()
+        self._pantallas_medidas = 0
+        self._historial = deque(maxlen=historial)  # (secuencia, texto) por lote
+        self._cubierto_desde = None  # el historial contiene todo lo posterior a esta secuencia
+        self._ultima = None
+        self._condicion = threading.Condition()
+        self._hilo = None
+
+    # ----- Pantallas -----
+
+    def suscribir(self, desde):
+        """
+        Conecta una pantalla que ya conoce el estado hasta la secuencia `desde`.
+        Devuelve la suscripción con lo pendiente ya encolado.
+        """
+        suscripcion = Suscripcion(desde, self.cola_pantalla)
+        actual = ultima_secuencia()
+        with self._condicion:
+            if not self._suscripciones:
+                # Sin pantallas el difusor no lee: se empieza desde la primera que se conecta
+                # (o desde el final si viene de muy atrás y tendrá que recargar de todos modos)
+                self._ultima = self._cubierto_desde = desde if actual - desde <= 1000 else actual
+                self._historial.clear()
+            if self._hilo is None:
+                self._hilo = threading.Thread(target=self._bucle, name='difusor-tablero', daemon=True)
+                self._hilo.start()
+            if desde < self._cubierto_desde:
+                suscripcion.desbordada = True
+                return suscripcion
+            for secuencia, texto in self._historial:
+                suscripcion.entregar(secuencia, texto)
+            self._suscripciones.add(suscripcion)
+            self._actualizar_metricas()
+            self._condicion.notify()
+        return suscripcion
+
+    def cancelar(self, suscripcion):
+        with self._condicion:
+            self._suscripciones.discard(suscripcion)
+            self._actualizar_metricas()
+
+    def _actualizar_metricas(self):
+        # Como diferencia: puede haber un difusor por taller en el mismo proceso
+        if self.metricas:
+            self.metricas.incrementar('taller_tablero_pantallas', len(self._suscripciones) - self._pantallas_medidas)
+        self._pantallas_medidas = len(self._suscripciones)
+
+    # ----- Hilo difusor -----
+
+    def _bucle(self):
+        while True:
+            with self._condicion:
+                while not self._suscripciones:
+                    self._condicion.wait()
+            try:
+                self._sondear()
+            except Exception:
+                logger.exception('Error al leer el registro de cambios para el tablero')
+            with self._condicion:
+                self._condicion.wait(self.intervalo)
+
+    def _sondear(self):
+        with self._condicion:
+            desde = self._ultima
+        with self.contexto():
+            try:
+                entradas = db.session.execute(
+                    select(Cambio.secuencia, Cambio.tabla, Cambio.registro_id, Cambio.operacion)
+                    .where(Cambio.secuencia > desde)
+                    .order_by(Cambio.secuencia)
+                    .limit(1000)
+                ).all()
+                if not entradas:
+                    return
+                secuencia = entradas[-1].secuencia
+                texto = ''.join(self._eventos(entradas, secuencia))
+            finally:
+                db.session.remove()
+
+        with self._condicion:
+            if self._ultima != desde:
+                return  # suscribir() ha reiniciado el difusor mientras se leía
+            self._ultima = secuencia
+            if texto:
+                if len(self._historial) == self._historial.maxlen:
+                    self._cubierto_desde = self._historial[0][0]
+                self._historial.append((secuencia, texto))
+                for suscripcion in list(self._suscripciones):
+                    if not suscripcion.entregar(secuencia, texto):
+                        self._suscripciones.discard(suscripcion)
+                self._actualizar_metricas()
+                if self.metricas:
+                    self.metricas.incrementar('taller_tablero_lotes_total')
+
+    def _eventos(self, entradas, secuencia):
+        altas, afectadas, coches, clientes = set(), set(), set(), set()
+        for entrada in entradas:
+            if entrada.tabla == 'intervenciones':
+                afectadas.add(entrada.registro_id)
+                if entrada.operacion == 'insert':
+                    altas.add(entrada.registro_id)
+            elif entrada.tabla == 'coches' and entrada.operacion == 'update':
+                coches.add(entrada.registro_id)
+            elif entrada.tabla == 'clientes' and entrada.operacion == 'update':
+                clientes.add(entrada.registro_id)
+
+        # Un cambio de matrícula o de nombre de cliente modifica las filas que los muestran
+        if coches or clientes:
+            afectadas.update(db.session.execute(
+                select(Intervencion.id).where(
+                    Intervencion.factura_id.is_(None),
+                    or_(Intervencion.coche_id.in_(coches), Intervencion.cliente_id.in_(clientes))
+                )
+            ).scalars())
+        if not afectadas:
+            return
+
+        visibles = set()
+        for fila in consultas.filas_intervenciones(sin_facturar=True, ids=afectadas):
+            visibles.add(fila.id)
+            html = render_template('facturas/_fila_sin_facturar.html', intervencion=fila)
+            yield _evento('alta' if fila.id in altas else 'modificacion', {'id': fila.id, 'html': html}, secuencia)
+        for intervencion_id in afectadas - visibles:
+            yield _evento('baja', {'id': intervencion_id}, secuencia)
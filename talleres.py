@@ -0,0 +1,197 @@
+"""
+Varios talleres en un mismo despliegue, cada uno con su propia base de datos SQLite.
+
+El taller de cada petición se resuelve por el nombre de host (`<taller>.dominio`)
+o por un prefijo de ruta (`/t/<taller>/...`) y se guarda en `g.taller`. La base de
+datos por defecto de Flask-SQLAlchemy pasa a ser la de ese taller: `db.session`,
+`db.engine` y el resto del código funcionan igual que con un único taller.
+
+Los engines se abren bajo demanda y se guardan en un pool LRU con un máximo de
+engines abiertos por proceso; los que llevan un tiempo sin usarse (y los menos
+usados recientemente, cuando se supera el máximo) se cierran, salvo que alguna
+petición los esté usando. Así cientos de talleres con poco movimiento comparten
+unos pocos workers sin tener abiertas cientos de bases de datos.
+"""
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from flask import g, has_app_context
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import create_engine
+
+# Nombres válidos: se usan como nombre de fichero y como subdominio
+PATRON_NOMBRE = re.compile(r'^[a-z0-9](?:[a-z0-9-]{0,38}[a-z0-9])?$')
+# Prefijo de ruta en el modo 'ruta'
+PATRON_RUTA = re.compile(r'^/t/([^/]+)(/.*)?$')
+
+
+def nombre_valido(nombre):
+    return bool(nombre) and PATRON_NOMBRE.match(nombre) is not None
+
+
+class EntradaTaller:
+    __slots__ = ('engine', 'en_uso', 'ultimo_uso')
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.en_uso = 0
+        self.ultimo_uso = time.monotonic()
+
+
+class PoolTalleres:
+    """Engines por taller abiertos bajo demanda, con límite LRU y cierre por inactividad."""
+
+    def __init__(self, directorio, opciones_engine=None, maximo=32, inactividad=300,
+                 inicializar=None, metricas=None):
+        """
+        Args:
+            directorio: Directorio con un fichero `<taller>.db` por taller
+            opciones_engine: Argumentos para create_engine (pool, connect_args...)
+            maximo: Engines abiertos como máximo en el proceso
+            inactividad: Segundos sin uso tras los que se cierra un engine
+            inicializar: Función llamada, con el taller ya activo, la primera vez que
+                el proceso abre cada taller (creación de tablas y migraciones)
+            metricas: Registro de métricas opcional
+        """
+        self.directorio = directorio
+        self.opciones_engine = dict(opciones_engine or {})
+        self.maximo = maximo
+        self.inactividad = inactividad
+        self.inicializar = inicializar
+        self.metricas = metricas
+        self._engines = OrderedDict()
+        self._inicializados = set()
+        # Reentrante: inicializar() vuelve a pedir el engine del taller que se está abriendo
+        self._lock = threading.RLock()
+
+    def ruta(self, nombre):
+        return os.path.join(self.directorio, f'{nombre}.db')
+
+    def existe(self, nombre):
+        return nombre_valido(nombre) and os.path.exists(self.ruta(nombre))
+
+    def talleres(self):
+        """Nombres de los talleres dados de alta en el directorio"""
+        try:
+            ficheros = os.listdir(self.directorio)
+        except FileNotFoundError:
+            return []
+        return sorted(f[:-3] for f in ficheros if f.endswith('.db') and nombre_valido(f[:-3]))
+
+    def engine(self, nombre):
+        """Engine del taller, abriéndolo si hace falta"""
+        with self._lock:
+            entrada = self._engines.get(nombre)
+            if entrada is None:
+                entrada = self._abrir(nombre)
+            else:
+                self._engines.move_to_end(nombre)
+            entrada.ultimo_uso = time.monotonic()
+            if nombre not in self._inicializados and self.inicializar is not None:
+                self._inicializados.add(nombre)
+                try:
+                    self.inicializar()
+                except Exception:
+                    self._inicializados.discard(nombre)
+                    raise
+            return entrada.engine
+
+    def _abrir(self, nombre):
+        self._cerrar_sobrantes()
+        engine = create_engine(f'sqlite:///{self.ruta(nombre)}', **self.opciones_engine)
+        entrada = self._engines[nombre] = EntradaTaller(engine)
+        if self.metricas:
+            self.metricas.incrementar('taller_talleres_aperturas_total')
+            self.metricas.fijar('taller_talleres_abiertos', len(self._engines))
+        return entrada
+
+    def adquirir(self, nombre):
+        """Marca el taller en uso (su engine no se cierra hasta `liberar`)"""
+        with self._lock:
+            self.engine(nombre)
+            self._engines[nombre].en_uso += 1
+
+    def liberar(self, nombre):
+        with self._lock:
+            entrada = self._engines.get(nombre)
+            if entrada is not None:
+                entrada.en_uso -= 1
+                entrada.ultimo_uso = time.monotonic()
+            self._cerrar_sobrantes(nuevos=0)
+
+    def _cerrar_sobrantes(self, nuevos=1):
+        """Cierra los engines inactivos y, por orden LRU, los que sobran para abrir `nuevos` más"""
+        limite = time.monotonic() - self.inactividad
+        sobran = len(self._engines) + nuevos - self.maximo
+        for nombre, entrada in list(self._engines.items()):
+            if entrada.en_uso:
+                continue
+            if sobran > 0 or entrada.ultimo_uso < limite:
+                self._cerrar(nombre)
+                sobran -= 1
+
+    def cerrar_todos(self):
+        with self._lock:
+            for nombre in list(self._engines):
+                self._cerrar(nombre)
+
+    def _cerrar(self, nombre):
+        self._engines.pop(nombre).engine.dispose()
+        if self.metricas:
+            self.metricas.incrementar('taller_talleres_cierres_total')
+            self.metricas.fijar('taller_talleres_abiertos', len(self._engines))
+
+
+class SQLAlchemyTalleres(SQLAlchemy):
+    """
+    SQLAlchemy cuyo engine por defecto es el del taller activo (`g.taller`, o
+    `taller_por_defecto` fuera de las peticiones). Sin pool de talleres se comporta
+    como SQLAlchemy normal.
+    """
+
+    pool_talleres = None
+    taller_por_defecto = None
+
+    def taller_activo(self):
+        """Nombre del taller activo, o None con un único taller"""
+        if self.pool_talleres is None:
+            return None
+        return (g.get('taller') if has_app_context() else None) or self.taller_por_defecto
+
+    @property
+    def engines(self):
+        engines = super().engines
+        taller = self.taller_activo()
+        if taller is None:
+            return engines
+        return {**engines, None: self.pool_talleres.engine(taller)}
+
+
+class PrefijoTaller:
+    """
+    Middleware WSGI del modo 'ruta': `/t/<taller>/resto` se atiende como `/resto` con
+    `/t/<taller>` en SCRIPT_NAME, de modo que url_for() genera enlaces del mismo taller.
+    """
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        coincidencia = PATRON_RUTA.match(environ.get('PATH_INFO', ''))
+        if coincidencia:
+            environ['taller.nombre'] = coincidencia.group(1)
+            environ['SCRIPT_NAME'] = environ.get('SCRIPT_NAME', '') + f'/t/{coincidencia.group(1)}'
+            environ['PATH_INFO'] = coincidencia.group(2) or '/'
+        return self.wsgi_app(environ, start_response)
+
+
+def taller_de_host(host, dominio=None):
+    """Taller a partir del nombre de host: `<taller>.<dominio>` (o la primera etiqueta si no hay dominio)"""
+    host = host.split(':', 1)[0].lower()
+    if dominio:
+        sufijo = '.' + dominio.lower()
+        return host[:-len(sufijo)] if host.endswith(sufijo) else None
+    return host.split('.', 1)[0] if '.' in host else None
@@ -0,0 +1,159 @@
+"""
+Captura de trazas de peticiones reales para reproducirlas después
+(`reproducir_trazas.py`) contra una copia de la base de datos.
+
+Cada petición capturada se guarda como una línea JSON con claves cortas:
+
+    {"t": 1760871234.123, "m": "GET", "p": "/clientes", "q": {"pagina": "2"},
+     "e": "listar_clientes", "s": 200, "d": 12.4, "db": 3.1}
+
+    t   instante de llegada (epoch, segundos)     e   endpoint
+    m   método                                    s   estado HTTP
+    p   ruta (con el prefijo del taller, si hay)  d   duración total en ms
+    q   parámetros de la URL                      db  tiempo de base de datos en ms
+    f   campos del formulario (solo POST)
+
+Los valores de parámetros y formularios se sanean por el nombre del campo, no por
+su contenido: solo se conservan los de una lista de campos sin datos personales,
+los de ids, km, importes, fechas y páginas si además tienen forma de número o
+fecha, y los de parámetros con valores cerrados (formato, método de pago...).
+Todo lo demás (nombre, DNI, teléfono, email, dirección, matrícula, descripciones,
+campos nuevos que aún no estén en la lista) se sustituye por 'x' de la misma
+longitud. No se guardan cabeceras, cookies ni cuerpos que no sean formularios.
+
+Cada proceso escribe en su propio fichero (`trazas-<pid>-<inicio>.jsonl`) y pasa a
+uno nuevo al superar el tamaño máximo.
+"""
+import json
+import os
+import random
+import re
+import threading
+import time
+
+from flask import g, request
+
+# Forma que deben tener los valores de CAMPOS_NUMERICOS para guardarse: números, fechas, horas e importes
+PATRON_LITERAL = re.compile(r'^[0-9][0-9.,:/ +-]{0,31}$')
+# Campos de ids, km, importes, fechas y paginación (también `<campo>_id`, `pagina_<...>` y las
+# líneas `nueva_intervencion_<n>_<campo>` o `<campo>[]` de la factura)
+CAMPOS_NUMERICOS = {'id', 'km', 'precio', 'importe', 'horas', 'horas_trabajo', 'iva_porcentaje',
+                    'descuento_porcentaje', 'fecha', 'año', 'pagina', 'limite', 'version', 'intervenciones',
+                    'duplicados', 'destino'}
+# Parámetros con valores cerrados que no contienen datos personales
+PARAMETROS_LITERALES = {'formato', 'metodo', 'orden', 'sin_facturar', 'anio', 'trimestre', 'mes', 'desde',
+                        'activo', 'reenviar'}
+# Parámetros que no se guardan nunca
+PARAMETROS_EXCLUIDOS = {'_perfil'}
+
+
+def campo_numerico(clave):
+    campo = re.sub(r'^.*_\d+_', '', clave.removesuffix('[]'))
+    return campo in CAMPOS_NUMERICOS or campo.endswith('_id') or campo.startswith('pagina_')
+
+
+def sanear(valores):
+    """Diccionario con los valores de un MultiDict saneados (listas si el campo se repite)"""
+    saneados = {}
+    for clave in valores:
+        if clave in PARAMETROS_EXCLUIDOS:
+            continue
+        literal = clave in PARAMETROS_LITERALES
+        numerico = not literal and campo_numerico(clave)
+        lista = [
+            v if not v or literal or (numerico and PATRON_LITERAL.match(v)) else 'x' * len(v)
+            for v in valores.getlist(clave)
+        ]
+        saneados[clave] = lista[0] if len(lista) == 1 else lista
+    return saneados
+
+
+class CapturaTrazas:
+    """Registra en ficheros JSON Lines una muestra de las peticiones atendidas."""
+
+    def __init__(self, app, directorio, muestreo=1.0, max_bytes=50 * 1024 * 1024, excluir=()):
+        """
+        Args:
+            app: Aplicación Flask
+            directorio: Directorio de los ficheros de trazas
+            muestreo: Fracción de peticiones que se capturan (0 a 1)
+            max_bytes: Tamaño a partir del cual el proceso empieza un fichero nuevo
+            excluir: Endpoints que no se capturan (métricas, flujos de eventos...)
+        """
+        self.directorio = directorio
+        self.muestreo = muestreo
+        self.max_bytes = max_bytes
+        self.excluir = set(excluir)
+        self._fichero = None
+        self._pid = None
+        self._lock = threading.Lock()
+        os.makedirs(directorio, exist_ok=True)
+        app.before_request(self._iniciar)
+        app.after_request(self._anotar_estado)
+        app.teardown_request(self._terminar)
+
+    def _iniciar(self):
+        if request.endpoint in self.excluir or random.random() >= self.muestreo:
+            return
+        g.traza = {
+            't': round(time.time(), 3),
+            'm': request.method,
+            'p': request.script_root + request.path,
+        }
+        if request.args:
+            g.traza['q'] = sanear(request.args)
+        if request.method == 'POST' and request.form:
+            g.traza['f'] = sanear(request.form)
+        g.traza_inicio = time.perf_counter()
+
+    def _anotar_estado(self, response):
+        traza = g.get('traza')
+        if traza is not None:
+            traza['s'] = response.status_code
+        return response
+
+    def _terminar(self, error=None):
+        # En teardown para que las respuestas en flujo cuenten hasta el último byte
+        traza = g.pop('traza', None)
+        if traza is None:
+            return
+        traza['e'] = request.endpoint
+        traza.setdefault('s', 500)
+        traza['d'] = round((time.perf_counter() - g.traza_inicio) * 1000, 2)
+        traza['db'] = round(g.get('tiempo_db', 0.0) * 1000, 2)
+        self._escribir(json.dumps(traza, ensure_ascii=False, separators=(',', ':')) + '\n')
+
+    def _escribir(self, linea):
+        with self._lock:
+            # Tras un fork el worker abre su propio fichero
+            if self._fichero is None or self._pid != os.getpid() or self._fichero.tell() > self.max_bytes:
+                if self._fichero is not None and self._pid == os.getpid():
+                    self._fichero.close()
+                self._pid = os.getpid()
+                nombre = f'trazas-{self._pid}-{int(time.time() * 1000)}.jsonl'
+                self._fichero = open(os.path.join(self.directorio, nombre), 'a', encoding='utf-8')
+            self._fichero.write(linea)
+            self._fichero.flush()
+
+
+def leer_trazas(rutas):
+    """
+    Trazas de uno o varios ficheros (o directorios), ordenadas por instante de llegada.
+
+    Returns:
+        list[dict]
+    """
+    ficheros = []
+    for ruta in rutas:
+        if os.path.isdir(ruta):
+            ficheros.extend(os.path.join(ruta, f) for f in sorted(os.listdir(ruta)) if f.endswith('.jsonl'))
+        else:
+            ficheros.append(ruta)
+
+    trazas = []
+    for fichero in ficheros:
+        with open(fichero, encoding='utf-8') as f:
+            trazas.extend(json.loads(linea) for linea in f if linea.strip())
+    # Se escriben al terminar cada petición: se ordenan por llegada
+    trazas.sort(key=lambda traza: traza['t'])
+    return trazas
@@ -0,0 +1,161 @@
+"""
+Registros de facturación encadenados de Verifactu.
+
+Al crearse, cada factura guarda su registro de alta con la huella (SHA-256 en
+hexadecimal y mayúsculas) de
+    IDEmisorFactura=<NIF>&NumSerieFactura=<número>&FechaExpedicionFactura=<dd-mm-aaaa>
+    &TipoFactura=F1&CuotaTotal=<IVA>&ImporteTotal=<total>&Huella=<huella anterior>
+    &FechaHoraHusoGenRegistro=<fecha y hora ISO 8601 con huso>
+(todo seguido), donde la huella anterior es la del registro previo del mismo
+emisor y va vacía en el primero.
+
+El NIF del emisor es el del taller (`datos_taller`, uno por base de datos) y sin
+él no se encadena ninguna factura.
+
+Añadir un registro no recorre la cadena: `cadenas_verifactu` guarda por emisor la
+huella y el id del último registro (la cabeza) y se actualiza en la misma
+transacción que la factura. `encadenar()` se llama después del INSERT de la
+factura, que ya tiene el bloqueo de escritura de SQLite, así que dos facturas no
+pueden leer la misma cabeza.
+
+`verificar()` recorre la cadena de un emisor en orden de id con un cursor por
+lotes y sin objetos del ORM, así que la memoria no crece con el historial: recalcula
+cada huella, comprueba que enlaza con la anterior y al final que la cabeza apunta
+al último registro. Se detiene en el primer eslabón roto. La verificación
+incremental empieza donde terminó la última verificación sin errores.
+"""
+import hashlib
+import re
+from collections import namedtuple
+from datetime import datetime
+
+from sqlalchemy import Integer, cast, func, select
+
+from dinero import a_decimal
+from models import db, CadenaVerifactu, DatosTaller, Factura
+
+TIPO_FACTURA = 'F1'  # factura completa
+# NIF o NIE: 9 letras o dígitos (el dígito de control no se comprueba)
+PATRON_NIF = re.compile(r'^[A-Z0-9]{9}$')
+
+EslabonRoto = namedtuple('EslabonRoto', 'factura_id numero_factura motivo')
+ResultadoVerificacion = namedtuple('ResultadoVerificacion', 'emisor registros comprobados roto')
+
+
+def _importe(centimos):
+    signo = '-' if centimos < 0 else ''
+    euros, resto = divmod(abs(centimos), 100)
+    return f'{signo}{euros}.{resto:02d}'
+
+
+def calcular_huella(emisor, numero, fecha, cuota, total, anterior, generado):
+    """`fecha` en dd-mm-aaaa, `cuota` y `total` en céntimos, `anterior` vacía en el primer registro"""
+    registro = (f'IDEmisorFactura={emisor.strip()}&NumSerieFactura={numero.strip()}'
+                f'&FechaExpedicionFactura={fecha}&TipoFactura={TIPO_FACTURA}'
+                f'&CuotaTotal={_importe(cuota)}&ImporteTotal={_importe(total)}'
+                f'&Huella={anterior}&FechaHoraHusoGenRegistro={generado}')
+    return hashlib.sha256(registro.encode('utf-8')).hexdigest().upper()
+
+
+def nif_emisor():
+    """NIF del taller activo, o None si aún no se ha indicado"""
+    return db.session.execute(select(DatosTaller.nif).order_by(DatosTaller.id).limit(1)).scalar() or None
+
+
+def guardar_nif(nif):
+    """
+    Guarda el NIF del taller activo (sin espacios ni guiones y en mayúsculas). No
+    confirma la transacción.
+
+    Raises:
+        ValueError: Si no tiene forma de NIF
+    """
+    nif = re.sub(r'[\s.-]', '', nif or '').upper()
+    if not PATRON_NIF.match(nif):
+        raise ValueError('El NIF debe tener 9 letras o dígitos')
+    datos = db.session.execute(select(DatosTaller).order_by(DatosTaller.id).limit(1)).scalar()
+    if datos is None:
+        datos = DatosTaller()
+        db.session.add(datos)
+    datos.nif = nif
+    return nif
+
+
+def encadenar(factura, emisor=None):
+    """
+    Calcula el registro encadenado de `factura`, que ya debe estar insertada y con
+    sus totales definitivos, y avanza la cabeza de la cadena del emisor (por
+    defecto, el NIF del taller). No confirma la transacción.
+
+    Raises:
+        ValueError: Si el taller no tiene NIF
+    """
+    emisor = emisor or nif_emisor()
+    if not emisor:
+        raise ValueError('El taller no tiene NIF: indíquelo en Datos del taller antes de crear facturas')
+    cabeza = db.session.get(CadenaVerifactu, emisor, populate_existing=True)
+    if cabeza is None:
+        cabeza = CadenaVerifactu(emisor_nif=emisor, registros=0, registros_verificados=0)
+        db.session.add(cabeza)
+    anterior = cabeza.huella or ''
+    generado = datetime.now().astimezone().isoformat(timespec='seconds')
+
+    factura.emisor_nif = emisor
+    factura.huella_anterior = anterior or None
+    factura.registro_generado = generado
+    factura.huella = calcular_huella(emisor, factura.numero_factura, factura.fecha.strftime('%d-%m-%Y'),
+                                     int(a_decimal(factura.iva_importe) * 100), int(a_decimal(factura.total) * 100),
+                                     anterior, generado)
+    cabeza.factura_id = factura.id
+    cabeza.huella = factura.huella
+    cabeza.registros += 1
+
+
+def emisores():
+    return db.session.execute(select(CadenaVerifactu.emisor_nif).order_by(CadenaVerifactu.emisor_nif)).scalars().all()
+
+
+def verificar(emisor, incremental=False, lote=2000):
+    """
+    Comprueba la cadena de `emisor` y, si está bien, anota hasta dónde se ha
+    verificado (no confirma la transacción).
+
+    Returns:
+        ResultadoVerificacion: `roto` es el primer EslabonRoto, o None
+    """
+    cabeza = db.session.get(CadenaVerifactu, emisor, populate_existing=True)
+    if cabeza is None:
+        return ResultadoVerificacion(emisor, 0, 0, None)
+    desde, anterior, previos = 0, '', 0
+    if incremental and cabeza.verificado_hasta:
+        desde, anterior, previos = cabeza.verificado_hasta, cabeza.huella_verificada, cabeza.registros_verificados
+
+    filas = db.session.execute(
+        select(Factura.id, Factura.numero_factura, func.strftime('%d-%m-%Y', Factura.fecha),
+               cast(Factura.iva_importe, Integer), cast(Factura.total, Integer),
+               Factura.huella_anterior, Factura.registro_generado, Factura.huella)
+        .where(Factura.emisor_nif == emisor, Factura.id > desde)
+        .order_by(Factura.id)
+        .execution_options(yield_per=lote)
+    )
+    ultimo, comprobados, roto = desde, 0, None
+    try:
+        for id, numero, fecha, cuota, total, huella_anterior, generado, huella in filas:
+            if (huella_anterior or '') != anterior:
+                roto = EslabonRoto(id, numero, 'no enlaza con el registro anterior (falta, sobra o ha cambiado alguno)')
+                break
+            if calcular_huella(emisor, numero, fecha, cuota, total, anterior, generado) != huella:
+                roto = EslabonRoto(id, numero, 'los datos de la factura no coinciden con su huella')
+                break
+            anterior, ultimo = huella, id
+            comprobados += 1
+    finally:
+        filas.close()
+
+    if roto is None and (ultimo != cabeza.factura_id or anterior != cabeza.huella
+                         or previos + comprobados != cabeza.registros):
+        roto = EslabonRoto(cabeza.factura_id, None, 'la cabeza de la cadena no coincide con el último registro')
+    if roto is None:
+        cabeza.verificado_hasta, cabeza.huella_verificada = ultimo, anterior
+        cabeza.registros_verificados = previos + comprobados
+    return ResultadoVerificacion(emisor, previos + comprobados, comprobados, roto)